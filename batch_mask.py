@@ -1,294 +1,876 @@
 import cv2
 import numpy as np
-from ultralytics import SAM
+from pipeline import MaskPipeline, image_prompts
+from image_sources import list_images, open_source, source_kind
+from parallel_runner import parse_shard, run_parallel, select_shard
+from manifest import RunManifest, describe_prompt_fn
+from mask_combine import COMBINE_MODES, combine_masks, extract_masks
+from mask_sinks import OUTPUT_FORMATS, make_sink
+from mask_writer import AsyncMaskWriter
+from image_io import read_image
+from sequence_tracker import TRACK_LOST, TRACK_REUSED, SequenceTracker
+from tiled_inference import TiledSegmenter
+from prompt_journal import JournalPrompts, journal_inputs, load_journal
+from watch_folder import WATCH_STATUS_NAME, FolderWatcher, WatchQueue
+from sam_backends import BACKENDS, PRECISIONS, model_variant, open_session
+from run_report import PROFILE_NAME, STATS_LOG_NAME, StageRecorder, profiled, save_report
 import os
-from pathlib import Path
+import threading
+import time
+from contextlib import nullcontext
+from functools import partial
 
 class BatchMaskGenerator:
-    def __init__(self, model_path="mobile_sam.pt"):
-        """初始化批量mask生成器"""
-        print(f"正在加载模型: {model_path}")
-        self.model = SAM(model_path)
-        print(f"✓ 模型已加载\n")
+    def __init__(self, model_path="mobile_sam.pt", batch_size=4, num_readers=2, num_writers=2,
+                 cache_dir=None, cache_size_mb=4096, combine="union", session=None,
+                 output_format="png", shard_size=1000, png_compression=None, tile_size=None,
+                 tile_overlap=128, precision="fp32", channels_last=False, autotune=False,
+                 backend="ultralytics", onnx_dir=None):
+        """
+        初始化批量mask生成器
+
+        参数:
+            model_path: 模型文件路径
+            batch_size: 每次编码器调用处理的图片数
+            num_readers: 读取/预处理线程数
+            num_writers: PNG写入线程数
+            cache_dir: 磁盘embedding缓存目录（None 表示不使用缓存）
+            cache_size_mb: 磁盘embedding缓存的大小上限 (MB)
+            combine: 多个mask的合并方式 union / label / best，见 mask_combine
+            session: 已创建的推理会话（例如 stub_model.StubSession），传入时不再加载模型
+            output_format: 输出格式 png / rle / npz，见 mask_sinks
+            shard_size: rle / npz 格式每个分片的mask数
+            png_compression: PNG 压缩级别 0-9（None 使用 OpenCV 默认值）
+            tile_size: 分块推理的块边长，超大图片按块编码后拼接（None 表示整张编码），见 tiled_inference
+            tile_overlap: 相邻块重叠的像素数
+            precision: 图像编码器的精度 fp32 / bf16 / int8，见 cpu_fastpath
+            channels_last: 图像编码器使用 channels_last 内存布局
+            autotune: 启动时自动选择 torch 线程数（结果按机器缓存）
+            backend: 推理后端 ultralytics / onnx，见 sam_backends
+            onnx_dir: onnx 后端的导出目录（默认为模型旁边的 <模型名>_onnx/）
+        """
+        self.model_path = model_path
+        self.variant = model_variant(precision, backend)
+        self.combine = combine
+        self.output_format = output_format
+        self.shard_size = shard_size
+        self.png_compression = png_compression
+        start = time.perf_counter()
+        if session is None:
+            print(f"正在加载模型: {model_path}")
+            session = open_session(model_path, backend, precision, channels_last, autotune, onnx_dir,
+                                   cache_dir, cache_size_mb)
+        self.model = session.model
+        self.cache = session.cache
+        self.session = session
+        self.pipeline = MaskPipeline(self.session, batch_size=batch_size,
+                                     num_readers=num_readers, num_writers=num_writers,
+                                     combine=combine)
+        self.tiler = TiledSegmenter(self.session, tile_size, tile_overlap, batch_size) if tile_size else None
+        print(f"✓ 模型已加载 ({time.perf_counter() - start:.1f}s)\n")
     
-    def process_folder_auto(self, input_folder, output_folder="batch_masks", 
-                           use_center_point=True, grid_points=None):
+    def _run(self, input_folder, output_folder, prompt_fn, resume=True):
+        """用流水线处理文件夹中的所有图片"""
+        image_files = list_images(input_folder)
+        
+        if len(image_files) == 0:
+            print(f"错误: 在 {input_folder} 中没有找到图片文件")
+            return
+        
+        print(f"找到 {len(image_files)} 张图片")
+        print(f"输出目录: {output_folder}")
+        
+        manifest = RunManifest(output_folder, self.model_path,
+                               manifest_key(prompt_fn, self.combine, self.output_format,
+                                            variant=self.variant))
+        if resume:
+            image_files, _ = skip_done(manifest, image_files)
+        print(f"{'='*60}\n")
+        
+        stats = self.process_files(image_files, output_folder, prompt_fn, manifest=manifest)
+        print_summary(stats, stats['total'])
+        if self.cache is not None:
+            print(self.cache.stats_line() + "\n")
+    
+    def process_files(self, image_files, output_folder, prompt_fn, on_result=None, manifest=None,
+                      recorder=None):
         """
-        自动批量处理文件夹中的图片
+        处理给定的图片列表
         
         参数:
-            input_folder: 输入图片文件夹路径
+            image_files: 图片路径列表，或逐个产生输入项的可迭代对象（见 image_sources.open_source）
             output_folder: 输出mask文件夹路径
-            use_center_point: 是否使用中心点作为提示（默认True）
-            grid_points: 使用网格点数量，例如 (3, 3) 表示3x3网格
+            prompt_fn: prompt_fn(w, h) -> dict，例如 auto_prompts / box_prompts 的 partial；
+                       也可以是逐图的提示函数（例如 prompt_journal.JournalPrompts），见 pipeline.image_prompts
+            on_result: 每张图片的结果回调，见 MaskPipeline.run
+            manifest: RunManifest，每保存一个mask追加一条完成记录
+            recorder: run_report.StageRecorder，记录每张图片各阶段的耗时
+        
+        返回:
+            统计字典 {'success', 'total', 'decode_count', 'decode_seconds'}
         """
         # 创建输出文件夹
         os.makedirs(output_folder, exist_ok=True)
         
-        # 支持的图片格式
-        image_extensions = ['.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp']
-        
-        # 获取所有图片文件
-        image_files = []
-        for ext in image_extensions:
-            image_files.extend(Path(input_folder).glob(f'*{ext}'))
-            image_files.extend(Path(input_folder).glob(f'*{ext.upper()}'))
+        if self.tiler is not None:
+            return self.process_tiled(image_files, output_folder, prompt_fn, on_result, manifest, recorder)
         
-        image_files = sorted(list(set(image_files)))  # 去重并排序
+        on_saved = manifest.record if manifest is not None else None
+        sink = make_sink(self.output_format, output_folder, self.shard_size,
+                         png_compression=self.png_compression)
+        success_count = self.pipeline.run(image_files, output_folder, prompt_fn, on_result, on_saved,
+                                          recorder, sink)
+        return {
+            'success': success_count,
+            'total': self.pipeline.input_count,
+            'decode_count': self.pipeline.decode_count,
+            'decode_seconds': self.pipeline.decode_seconds,
+        }
+    
+    def process_tiled(self, image_files, output_folder, prompt_fn, on_result=None, manifest=None,
+                      recorder=None):
+        """
+        分块推理: 每张图片按块编码和解码，拼接后按条带写出，见 tiled_inference
         
-        if len(image_files) == 0:
-            print(f"错误: 在 {input_folder} 中没有找到图片文件")
-            return
+        只编码与提示相交的块；PNG 输出逐条压缩写入，不在内存中组装整张mask。
+        参数和返回值同 process_files。
+        """
+        total = len(image_files) if hasattr(image_files, '__len__') else None
+        on_saved = manifest.record if manifest is not None else None
+        sink = make_sink(self.output_format, output_folder, self.shard_size,
+                         png_compression=self.png_compression)
+        stats = {'success': 0, 'total': 0, 'decode_count': 0, 'decode_seconds': 0.0}
         
-        print(f"找到 {len(image_files)} 张图片")
-        print(f"输出目录: {output_folder}")
-        print(f"{'='*60}\n")
+        def report(idx, image_path, ok, message):
+            stats['success'] += ok
+            if recorder is not None:
+                recorder.finish(image_path, ok, message)
+            if on_result is not None:
+                on_result(idx, image_path, ok, message)
+            else:
+                progress = f"{idx}/{total}" if total is not None else idx
+                print(f"[{progress}] {image_path.name}  {message}")
         
-        # 处理每张图片
-        success_count = 0
         for idx, image_path in enumerate(image_files, 1):
+            stats['total'] = idx
             try:
-                print(f"[{idx}/{len(image_files)}] 处理: {image_path.name}")
-                
-                # 读取图像获取尺寸
-                img = cv2.imread(str(image_path))
-                if img is None:
-                    print(f"  ✗ 无法读取图片，跳过")
+                image, seconds = read_image(image_path)
+                if recorder is not None:
+                    recorder.add(image_path, "read", seconds)
+                if image is None:
+                    report(idx, image_path, False, "✗ 无法读取图片，跳过")
                     continue
+                stats['decode_count'] += 1
+                stats['decode_seconds'] += seconds
                 
-                h, w = img.shape[:2]
+                h, w = image.shape[:2]
+                tiled = self.tiler.segment(image, image_prompts(prompt_fn, image_path, w, h))
+                del image
+                if recorder is not None:
+                    recorder.add(image_path, "encode", tiled.encode_seconds)
+                    recorder.add(image_path, "decode", tiled.decode_seconds)
                 
-                # 生成提示点
-                points = []
-                if use_center_point:
-                    # 使用中心点
-                    points = [[w // 2, h // 2]]
-                elif grid_points:
-                    # 使用网格点
-                    rows, cols = grid_points
-                    for i in range(rows):
-                        for j in range(cols):
-                            x = int((j + 1) * w / (cols + 1))
-                            y = int((i + 1) * h / (rows + 1))
-                            points.append([x, y])
+                start = time.perf_counter()
+                mask_pixels = 0
                 
-                # 生成mask
-                if points:
-                    labels = [1] * len(points)  # 所有点都是前景点
-                    results = self.model.predict(
-                        str(image_path),
-                        points=points,
-                        labels=labels,
-                        save=False,
-                        verbose=False
-                    )
-                else:
-                    # 没有点提示，使用整图
-                    results = self.model.predict(
-                        str(image_path),
-                        save=False,
-                        verbose=False
-                    )
+                def strips():
+                    nonlocal mask_pixels
+                    for y0, strip in tiled.strips(self.combine):
+                        mask_pixels += int(np.count_nonzero(strip))
+                        yield y0, strip
                 
-                # 提取并保存二值mask
-                if results and len(results) > 0:
-                    result = results[0]
-                    if result.masks is not None and len(result.masks) > 0:
-                        # 获取mask
-                        mask_data = result.masks.data[0].cpu().numpy()
-                        binary_mask = (mask_data * 255).astype(np.uint8)
-                        
-                        # 保存
-                        output_name = image_path.stem + '.png'
-                        output_path = os.path.join(output_folder, output_name)
-                        cv2.imwrite(output_path, binary_mask)
-                        
-                        print(f"  ✓ 已保存: {output_name}")
-                        success_count += 1
-                    else:
-                        print(f"  ✗ 未检测到mask")
+                if hasattr(sink, 'write_strips'):
+                    output_name = sink.write_strips(image_path, w, h, strips(), on_saved)
                 else:
-                    print(f"  ✗ 处理失败")
-                    
+                    # 分片格式需要整张mask（uint8，不是 float32 累加器）
+                    output_name = sink.write(image_path, np.concatenate([s for _, s in strips()]), on_saved)
+                if recorder is not None:
+                    recorder.add(image_path, "write", time.perf_counter() - start)
+                    recorder.set(image_path, masks=tiled.num_prompts, mask_pixels=mask_pixels)
+                report(idx, image_path, True,
+                       f"✓ 已保存: {output_name} (编码 {tiled.encoded_tiles}/{len(tiled.tiles)} 块)")
             except Exception as e:
-                print(f"  ✗ 错误: {e}")
+                report(idx, image_path, False, f"✗ 错误: {e}")
         
-        print(f"\n{'='*60}")
-        print(f"处理完成！成功: {success_count}/{len(image_files)}")
-        print(f"{'='*60}\n")
+        sink.close()
+        return stats
     
-    def process_folder_with_boxes(self, input_folder, output_folder="batch_masks", 
-                                  box_config=None):
+    def process_sequence(self, image_files, output_folder, prompt_fn, manifest=None, recorder=None,
+                         **tracker_kwargs):
         """
-        使用固定框批量处理
+        按顺序处理连续帧，后一帧的提示由前一帧的mask得到，见 sequence_tracker
+
+        第一帧和跟踪丢失的帧使用 prompt_fn 重新提示；与参考帧几乎相同的帧直接复用mask，
+        不运行编码器和解码器。帧之间有依赖，所以逐帧处理，不使用流水线的批量编码。
         
         参数:
-            input_folder: 输入图片文件夹路径
+            image_files: 按帧顺序排列的图片列表或输入项生成器（例如视频）
             output_folder: 输出mask文件夹路径
-            box_config: 框配置，格式:
-                - "full": 使用整个图片作为框
-                - "center_80": 使用中心80%区域
-                - [x1, y1, x2, y2]: 固定坐标
-                - "ratio": [[0.1, 0.1, 0.9, 0.9]] 相对坐标(0-1)
+            prompt_fn: 第一帧和重新提示时使用的提示函数，同 process_files
+            manifest: RunManifest，每保存一个mask追加一条完成记录
+            recorder: run_report.StageRecorder，记录每帧各阶段的耗时
+            tracker_kwargs: 传给 SequenceTracker 的参数（reuse_diff、min_iou、area_jump 等）
+        
+        返回:
+            统计字典 {'success', 'total', 'decode_count', 'decode_seconds',
+                      'reused', 'tracked', 'prompted', 'encoded'}
         """
-        # 创建输出文件夹
         os.makedirs(output_folder, exist_ok=True)
+        total = len(image_files) if hasattr(image_files, '__len__') else None
+        on_saved = manifest.record if manifest is not None else None
+        writer = AsyncMaskWriter(make_sink(self.output_format, output_folder, self.shard_size,
+                                           png_compression=self.png_compression),
+                                 workers=self.pipeline.num_writers)
+        tracker = SequenceTracker(self.session, **tracker_kwargs)
+        stats = {'success': 0, 'total': 0, 'decode_count': 0, 'decode_seconds': 0.0,
+                 'reused': 0, 'tracked': 0, 'prompted': 0, 'encoded': 0}
         
-        # 支持的图片格式
-        image_extensions = ['.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp']
-        
-        # 获取所有图片文件
-        image_files = []
-        for ext in image_extensions:
-            image_files.extend(Path(input_folder).glob(f'*{ext}'))
-            image_files.extend(Path(input_folder).glob(f'*{ext.upper()}'))
-        
-        image_files = sorted(list(set(image_files)))
-        
-        if len(image_files) == 0:
-            print(f"错误: 在 {input_folder} 中没有找到图片文件")
-            return
-        
-        print(f"找到 {len(image_files)} 张图片")
-        print(f"输出目录: {output_folder}")
-        print(f"{'='*60}\n")
+        def report(idx, image_path, ok, message):
+            if recorder is not None:
+                recorder.finish(image_path, ok, message)
+            progress = f"{idx}/{total}" if total is not None else idx
+            print(f"[{progress}] {image_path.name}  {message}")
         
-        # 处理每张图片
-        success_count = 0
         for idx, image_path in enumerate(image_files, 1):
+            stats['total'] = idx
+            image, seconds = read_image(image_path)
+            if recorder is not None:
+                recorder.add(image_path, "read", seconds)
+            if image is None:
+                report(idx, image_path, False, "✗ 无法读取图片，跳过")
+                continue
+            stats['decode_count'] += 1
+            stats['decode_seconds'] += seconds
+            
+            embedding = None
+            encode_seconds = 0.0
+            
+            def get_embedding():
+                # 只在需要解码时编码，复用mask的帧不运行编码器
+                nonlocal embedding, encode_seconds
+                if embedding is None:
+                    start = time.perf_counter()
+                    embedding = self.session.encode(image, image_path)
+                    encode_seconds = time.perf_counter() - start
+                    stats['encoded'] += 1
+                return embedding
+            
             try:
-                print(f"[{idx}/{len(image_files)}] 处理: {image_path.name}")
-                
-                # 读取图像获取尺寸
-                img = cv2.imread(str(image_path))
-                if img is None:
-                    print(f"  ✗ 无法读取图片，跳过")
-                    continue
-                
-                h, w = img.shape[:2]
-                
-                # 计算框
-                if box_config == "full":
-                    boxes = [[0, 0, w, h]]
-                elif box_config == "center_80":
-                    margin = 0.1
-                    x1 = int(w * margin)
-                    y1 = int(h * margin)
-                    x2 = int(w * (1 - margin))
-                    y2 = int(h * (1 - margin))
-                    boxes = [[x1, y1, x2, y2]]
-                elif isinstance(box_config, list) and len(box_config) == 4:
-                    # 检查是否是相对坐标
-                    if all(0 <= x <= 1 for x in box_config):
-                        # 相对坐标，转换为绝对坐标
-                        x1 = int(box_config[0] * w)
-                        y1 = int(box_config[1] * h)
-                        x2 = int(box_config[2] * w)
-                        y2 = int(box_config[3] * h)
-                        boxes = [[x1, y1, x2, y2]]
-                    else:
-                        # 绝对坐标
-                        boxes = [box_config]
+                start = time.perf_counter()
+                result = tracker.track(image, get_embedding) if tracker.active else None
+                if result is None or result.status == TRACK_LOST:
+                    h, w = image.shape[:2]
+                    results = self.session.decode(get_embedding(), **image_prompts(prompt_fn, image_path, w, h))
+                    masks, scores = extract_masks(results[0]) if results else (None, None)
+                    if masks is None:
+                        tracker.reset()
+                        report(idx, image_path, False, "✗ 未检测到mask")
+                        continue
+                    stats['prompted'] += 1
+                    label = "跟踪丢失，重新提示" if result is not None else "提示"
                 else:
-                    # 默认使用整图
-                    boxes = [[0, 0, w, h]]
-                
-                # 生成mask
-                results = self.model.predict(
-                    str(image_path),
-                    bboxes=boxes,
-                    save=False,
-                    verbose=False
-                )
+                    masks, scores = result.masks, result.scores
+                    reused = result.status == TRACK_REUSED
+                    stats['reused' if reused else 'tracked'] += 1
+                    label = f"复用上一帧 (差异 {result.diff:.1f})" if reused else "跟踪"
+                if result is None or result.status != TRACK_REUSED:
+                    tracker.set_reference(image, masks, scores)
+                if recorder is not None:
+                    if encode_seconds:
+                        recorder.add(image_path, "encode", encode_seconds)
+                    recorder.add(image_path, "decode", time.perf_counter() - start - encode_seconds)
                 
-                # 提取并保存二值mask
-                if results and len(results) > 0:
-                    result = results[0]
-                    if result.masks is not None and len(result.masks) > 0:
-                        # 获取mask
-                        mask_data = result.masks.data[0].cpu().numpy()
-                        binary_mask = (mask_data * 255).astype(np.uint8)
-                        
-                        # 保存
-                        output_name = image_path.stem + '.png'
-                        output_path = os.path.join(output_folder, output_name)
-                        cv2.imwrite(output_path, binary_mask)
-                        
-                        print(f"  ✓ 已保存: {output_name}")
-                        success_count += 1
-                    else:
-                        print(f"  ✗ 未检测到mask")
-                else:
-                    print(f"  ✗ 处理失败")
-                    
+                start = time.perf_counter()
+                mask = combine_masks(masks, scores, self.combine)
+                if recorder is not None:
+                    recorder.add(image_path, "combine", time.perf_counter() - start)
+                    recorder.set(image_path, masks=len(masks), mask_pixels=int(np.count_nonzero(mask)))
+                writer.submit(image_path, mask, on_saved)
+                report(idx, image_path, True, f"✓ {label}")
             except Exception as e:
-                print(f"  ✗ 错误: {e}")
+                report(idx, image_path, False, f"✗ 错误: {e}")
         
-        print(f"\n{'='*60}")
-        print(f"处理完成！成功: {success_count}/{len(image_files)}")
-        print(f"{'='*60}\n")
+        writer.close()
+        stats['success'] = writer.written
+        return stats
 
+    def watch(self, input_folder, output_folder, prompt_fn, manifest=None, recorder=None, resume=True,
+              recursive=False, interval=1.0, settle=1.0, queue_size=64, status_interval=10.0,
+              use_inotify=True):
+        """
+        监视模式: 常驻处理文件夹中新到达（或修改过）的图片，直到按 Ctrl+C，见 watch_folder
 
-def main():
-    print("\n" + "="*60)
-    print("批量 SAM Mask 生成器")
-    print("="*60 + "\n")
+        参数:
+            input_folder: 监视的文件夹
+            output_folder / prompt_fn / manifest / recorder: 同 process_files
+            resume: 是否跳过完成清单中已处理且未改变的图片
+            recursive: 是否包含子文件夹
+            interval: 扫描间隔（秒）
+            settle: 文件大小和修改时间连续不变多少秒才认为已经写完
+            queue_size: 等待处理的队列容量
+            status_interval: 打印状态和写 watch_status.json 的间隔（秒）
+            use_inotify: Linux 上用 inotify 只检查改变过的文件（False 时每次完整扫描）
+
+        返回:
+            统计字典，同 process_files，另有 'watch'（最终的监视状态，见 watch_folder.WatchStats.snapshot）
+        """
+        os.makedirs(output_folder, exist_ok=True)
+        feed = WatchQueue(FolderWatcher(input_folder, recursive, settle, use_inotify),
+                          manifest if resume else None, interval, queue_size,
+                          status_path=os.path.join(output_folder, WATCH_STATUS_NAME),
+                          status_interval=status_interval)
+        result = {}
+        done = threading.Event()
+
+        def on_result(idx, image_path, ok, message):
+            latency = feed.finish(image_path, ok)
+            suffix = f"  (延迟 {latency:.1f}s)" if latency is not None else ""
+            print(f"[{idx}] {image_path.name}  {message}{suffix}")
+
+        def work():
+            try:
+                result.update(self.process_files(feed.stream(), output_folder, prompt_fn, on_result,
+                                                  manifest, recorder))
+            finally:
+                done.set()
+
+        scanner = threading.Thread(target=feed.run, daemon=True)
+        worker = threading.Thread(target=work, daemon=True)
+        scanner.start()
+        worker.start()
+        print(f"监视中: {input_folder} (每 {interval:g}s 检查一次, 方式: {feed.watcher.mode}, 按 Ctrl+C 停止)\n")
+        try:
+            # 用 Event 等待而不是 Thread.join: join 被 Ctrl+C 打断后线程状态不可靠
+            while not done.wait(0.5):
+                pass
+        except KeyboardInterrupt:
+            # 再按一次 Ctrl+C 时等待被打断，守护线程随进程立即退出
+            print("\n正在停止: 处理完队列中的图片后退出 (再按一次 Ctrl+C 立即退出)")
+            feed.stop()
+            done.wait()
+        feed.stop()
+        scanner.join()
+        result['watch'] = feed.report()
+        return result
+
+    @staticmethod
+    def auto_prompts(w, h, use_center_point=True, grid_points=None, per_point=False,
+                     min_score=0.8, nms_iou=0.7):
+        """
+        根据图片尺寸生成点提示，没有点时使用整图框
+
+        per_point=True 时每个网格点单独作为一个提示，得到去重后的多个物体mask
+        （min_score / nms_iou 为置信度阈值和去重IoU阈值）
+        """
+        points = []
+        if use_center_point:
+            # 使用中心点
+            points = [[w // 2, h // 2]]
+        elif grid_points:
+            # 使用网格点
+            rows, cols = grid_points
+            for i in range(rows):
+                for j in range(cols):
+                    x = int((j + 1) * w / (cols + 1))
+                    y = int((i + 1) * h / (rows + 1))
+                    points.append([x, y])
+        
+        if points and per_point:
+            return {'points': points, 'per_point': True, 'min_score': min_score, 'nms_iou': nms_iou}
+        if points:
+            labels = [1] * len(points)  # 所有点都是前景点
+            return {'points': points, 'labels': labels}
+        # 没有点提示，使用整图
+        return {'bboxes': [[0, 0, w, h]]}
     
-    # 配置参数
+    @staticmethod
+    def box_prompts(w, h, box_config=None):
+        """根据图片尺寸和框配置生成框提示"""
+        if box_config == "full":
+            boxes = [[0, 0, w, h]]
+        elif box_config == "center_80":
+            margin = 0.1
+            x1 = int(w * margin)
+            y1 = int(h * margin)
+            x2 = int(w * (1 - margin))
+            y2 = int(h * (1 - margin))
+            boxes = [[x1, y1, x2, y2]]
+        elif isinstance(box_config, list) and len(box_config) == 4:
+            # 检查是否是相对坐标
+            if all(0 <= x <= 1 for x in box_config):
+                # 相对坐标，转换为绝对坐标
+                x1 = int(box_config[0] * w)
+                y1 = int(box_config[1] * h)
+                x2 = int(box_config[2] * w)
+                y2 = int(box_config[3] * h)
+                boxes = [[x1, y1, x2, y2]]
+            else:
+                # 绝对坐标
+                boxes = [box_config]
+        else:
+            # 默认使用整图
+            boxes = [[0, 0, w, h]]
+        return {'bboxes': boxes}
+    
+    def process_folder_auto(self, input_folder, output_folder="batch_masks", 
+                           use_center_point=True, grid_points=None, per_point=False, resume=True):
+        """
+        自动批量处理文件夹中的图片
+        
+        参数:
+            input_folder: 输入图片文件夹路径
+            output_folder: 输出mask文件夹路径
+            use_center_point: 是否使用中心点作为提示（默认True）
+            grid_points: 使用网格点数量，例如 (3, 3) 表示3x3网格
+            per_point: 每个网格点单独分割一个物体（默认所有点共同构成一个提示）
+            resume: 跳过清单中已完成且未改变的图片
+        """
+        self._run(input_folder, output_folder,
+                  partial(self.auto_prompts, use_center_point=use_center_point, grid_points=grid_points,
+                          per_point=per_point),
+                  resume)
+    
+    def process_folder_with_boxes(self, input_folder, output_folder="batch_masks", 
+                                  box_config=None, resume=True):
+        """
+        使用固定框批量处理
+        
+        参数:
+            input_folder: 输入图片文件夹路径
+            output_folder: 输出mask文件夹路径
+            box_config: 框配置，格式:
+                - "full": 使用整个图片作为框
+                - "center_80": 使用中心80%区域
+                - [x1, y1, x2, y2]: 固定坐标
+                - "ratio": [[0.1, 0.1, 0.9, 0.9]] 相对坐标(0-1)
+            resume: 跳过清单中已完成且未改变的图片
+        """
+        self._run(input_folder, output_folder, partial(self.box_prompts, box_config=box_config), resume)
+
+
+def skip_done(manifest, image_files):
+    """
+    根据清单跳过已完成的图片，返回 (待处理列表, 跳过数量)
+
+    流式输入（生成器）返回边读取边过滤的生成器，跳过数量为 None。
+    """
+    pending = manifest.pending(image_files)
+    if not isinstance(image_files, list):
+        return pending, None
+    skipped = len(image_files) - len(pending)
+    if skipped > 0:
+        print(f"跳过 {skipped} 张已完成且未改变的图片 (清单: {manifest.path})")
+    return pending, skipped
+
+
+def manifest_key(prompt_fn, combine, output_format="png", sequence=None, tile=None, variant=None):
+    """
+    完成清单中的提示配置描述（包括合并方式、非默认的输出格式、序列模式的跟踪参数、分块参数和模型变体）
+
+    参数:
+        sequence: 序列模式的跟踪参数字典（None 表示不是序列模式）
+        tile: 分块推理的 (块边长, 重叠像素)（None 表示整张编码）
+        variant: 推理后端和编码器精度的标识，非默认时mask可能有细微差异，见 sam_backends.model_variant
+    """
+    options = {'combine': combine}
+    if output_format != "png":
+        options['format'] = output_format
+    if sequence is not None:
+        options['sequence'] = sorted(sequence.items())
+    if tile is not None:
+        options['tile'] = tuple(tile)
+    if variant is not None:
+        options['precision'] = variant
+    return describe_prompt_fn(prompt_fn, **options)
+
+
+def print_summary(stats, total):
+    """打印处理统计"""
+    decode_count = stats['decode_count']
+    decode_seconds = stats['decode_seconds']
+    
+    print(f"\n{'='*60}")
+    print(f"处理完成！成功: {stats['success']}/{total}")
+    if decode_count > 0:
+        print(f"图片解码: {decode_count} 张, 累计 {decode_seconds:.2f}s "
+              f"(平均 {decode_seconds / decode_count * 1000:.1f} ms/张)")
+    print(f"{'='*60}\n")
+
+
+# 处理模式: (交互式菜单编号, 说明)
+PROCESS_MODES = {
+    'center': ("1", "自动模式 - 使用中心点"),
+    'grid': ("2", "自动模式 - 使用网格点 (3x3)"),
+    'full': ("3", "框模式 - 使用整图"),
+    'center_80': ("4", "框模式 - 使用中心80%区域"),
+    'box': ("5", "框模式 - 自定义相对坐标"),
+    'objects': ("6", "自动模式 - 网格逐点分割物体 (16x16)"),
+}
+
+# 网格模式默认的每边点数
+DEFAULT_GRID = {'grid': 3, 'objects': 16}
+
+
+def make_prompt_fn(mode, box=None, grid=None, min_score=0.8, nms_iou=0.7):
+    """根据处理模式生成提示函数（partial 对象，可传给子进程）"""
+    if mode in DEFAULT_GRID:
+        n = grid or DEFAULT_GRID[mode]
+        if mode == 'grid':
+            return partial(BatchMaskGenerator.auto_prompts, use_center_point=False, grid_points=(n, n))
+        return partial(BatchMaskGenerator.auto_prompts, use_center_point=False, grid_points=(n, n),
+                       per_point=True, min_score=min_score, nms_iou=nms_iou)
+    if mode == 'full':
+        return partial(BatchMaskGenerator.box_prompts, box_config="full")
+    if mode == 'center_80':
+        return partial(BatchMaskGenerator.box_prompts, box_config="center_80")
+    if mode == 'box':
+        return partial(BatchMaskGenerator.box_prompts, box_config=list(box))
+    return partial(BatchMaskGenerator.auto_prompts, use_center_point=True)
+
+
+def ask_config():
+    """交互式输入配置，返回 (input_folder, output_folder, mode, box)"""
     input_folder = input("请输入图片文件夹路径 (直接回车使用当前目录): ").strip()
     if not input_folder:
         input_folder = "."
     
-    if not os.path.exists(input_folder):
-        print(f"错误: 文件夹 {input_folder} 不存在")
-        return
-    
     output_folder = input("请输入输出文件夹路径 (直接回车使用 'batch_masks'): ").strip()
     if not output_folder:
         output_folder = "batch_masks"
     
     print("\n选择处理模式:")
-    print("1. 自动模式 - 使用中心点")
-    print("2. 自动模式 - 使用网格点 (3x3)")
-    print("3. 框模式 - 使用整图")
-    print("4. 框模式 - 使用中心80%区域")
-    print("5. 框模式 - 自定义相对坐标")
+    for key, desc in PROCESS_MODES.values():
+        print(f"{key}. {desc}")
     
-    mode = input("\n请选择模式 (1-5, 默认1): ").strip()
-    if not mode:
-        mode = "1"
+    choice = input("\n请选择模式 (1-6, 默认1): ").strip()
+    if not choice:
+        choice = "1"
     
-    # 创建生成器
-    generator = BatchMaskGenerator("mobile_sam.pt")
+    mode = next((m for m, (key, _) in PROCESS_MODES.items() if key == choice), None)
+    if mode is None:
+        print("无效的选择，使用默认中心点模式")
+        mode = 'center'
     
-    # 根据模式处理
-    if mode == "1":
-        print("\n使用中心点模式处理...\n")
-        generator.process_folder_auto(input_folder, output_folder, use_center_point=True)
-    elif mode == "2":
-        print("\n使用3x3网格点模式处理...\n")
-        generator.process_folder_auto(input_folder, output_folder, 
-                                     use_center_point=False, grid_points=(3, 3))
-    elif mode == "3":
-        print("\n使用整图框模式处理...\n")
-        generator.process_folder_with_boxes(input_folder, output_folder, box_config="full")
-    elif mode == "4":
-        print("\n使用中心80%区域框模式处理...\n")
-        generator.process_folder_with_boxes(input_folder, output_folder, box_config="center_80")
-    elif mode == "5":
+    box = None
+    if mode == 'box':
         print("\n请输入相对坐标 (0-1之间的小数)")
         x1 = float(input("左上角X (例如 0.1): "))
         y1 = float(input("左上角Y (例如 0.1): "))
         x2 = float(input("右下角X (例如 0.9): "))
         y2 = float(input("右下角Y (例如 0.9): "))
-        print(f"\n使用自定义框 [{x1}, {y1}, {x2}, {y2}] 处理...\n")
-        generator.process_folder_with_boxes(input_folder, output_folder, 
-                                           box_config=[x1, y1, x2, y2])
+        box = [x1, y1, x2, y2]
+    
+    return input_folder, output_folder, mode, box
+
+
+def main():
+    import argparse
+    
+    parser = argparse.ArgumentParser(
+        description='批量 SAM Mask 生成器',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+不带参数运行时进入交互式配置。
+
+处理模式 (--mode):
+  center     自动模式 - 使用中心点 (默认)
+  grid       自动模式 - 使用网格点 (3x3)
+  full       框模式 - 使用整图
+  center_80  框模式 - 使用中心80%%区域
+  box        框模式 - 自定义相对坐标 (配合 --box)
+  objects    自动模式 - 网格逐点分割物体，每个点单独解码后去重 (配合 --grid/--min-score/--nms-iou)
+
+示例:
+  python batch_mask.py
+  python batch_mask.py images/ -o masks/ --mode center_80
+  python batch_mask.py images/ --workers 8 --threads 4
+  python batch_mask.py images/ --precision int8 --channels-last --autotune
+  python batch_mask.py images/ --backend onnx --precision int8
+  python batch_mask.py images/ --mode objects --grid 32 --combine label
+  python batch_mask.py images/ --stats --profile
+  python batch_mask.py images/ --format npz --shard-size 5000
+  python batch_mask.py images/ --shard 0/4   # 第1台机器
+  python batch_mask.py images/ --shard 1/4   # 第2台机器
+  python batch_mask.py images/ggbond --sequence --mode box --box 0.3 0.2 0.7 0.9
+  python batch_mask.py wafers/ --tile 1024 --mode box --box 0.1 0.1 0.4 0.3
+  python batch_mask.py --replay output/ggbond/prompts.jsonl -o remasks/ --workers 4
+  python batch_mask.py incoming/ -o masks/ --watch --mode center_80
+
+回放 (--replay): 读取交互工具记录的提示日志 (prompts.jsonl)，用其中每张图片的框和点
+重新生成mask，不需要输入和 --mode；可以换模型、输出格式，或配合 --workers 多进程。
+
+监视 (--watch): 模型常驻，持续处理输入文件夹中新到达的图片，直到按 Ctrl+C；
+文件写完 (--settle 秒内大小和修改时间不变) 才处理，重启后跳过已完成的图片，
+状态定期打印并写到输出目录的 watch_status.json。
+
+输入 (input):
+  文件夹                  文件夹中的图片，--recursive 递归子文件夹（边遍历边处理）
+  列表文件 (.txt/.lst)    每行一个图片路径
+  tar 包 (.tar/.tar.gz)   顺序读取，不解压到磁盘
+  视频 (.mp4/.avi/...)    逐帧处理，--frame-step N 每 N 帧取一帧
+  -                       从标准输入读取图片路径
+
+  python batch_mask.py dataset/ --recursive
+  python batch_mask.py images.tar.gz -o masks/
+  python batch_mask.py clip.mp4 --frame-step 5
+  find /data -name '*.jpg' | python batch_mask.py - -o masks/
+        """
+    )
+    
+    parser.add_argument('input_folder', nargs='?', default=None, metavar='input',
+                       help='输入: 图片文件夹 / 列表文件 / tar 包 / 视频 / - (不填则进入交互式配置)')
+    parser.add_argument('--replay', default=None, metavar='JOURNAL',
+                       help='回放交互工具记录的提示日志 (prompts.jsonl)，处理其中的图片，使用记录的提示')
+    parser.add_argument('--watch', action='store_true',
+                       help='监视模式: 持续处理输入文件夹中新到达的图片，直到按 Ctrl+C')
+    parser.add_argument('--poll', type=float, default=1.0, metavar='SECONDS',
+                       help='监视模式: 扫描文件夹的间隔秒数 (默认: 1.0)')
+    parser.add_argument('--settle', type=float, default=1.0, metavar='SECONDS',
+                       help='监视模式: 文件大小和修改时间连续不变多少秒才处理，避免读到写了一半的文件 (默认: 1.0)')
+    parser.add_argument('--no-inotify', action='store_true',
+                       help='监视模式: 不使用 inotify，每次完整扫描文件夹（网络盘上 inotify 收不到其他机器写入的文件）')
+    parser.add_argument('--watch-queue', type=int, default=64,
+                       help='监视模式: 等待处理的队列容量，超出部分积压在监视线程中 (默认: 64)')
+    parser.add_argument('--status-interval', type=float, default=10.0, metavar='SECONDS',
+                       help='监视模式: 打印状态和写 watch_status.json 的间隔秒数 (默认: 10)')
+    parser.add_argument('--recursive', action='store_true',
+                       help='递归处理子文件夹中的图片，mask按相对路径保存到对应的子文件夹')
+    parser.add_argument('--frame-step', type=int, default=1,
+                       help='视频输入每隔几帧处理一帧 (默认: 1)')
+    parser.add_argument('-o', '--output', default='batch_masks',
+                       help='输出mask文件夹路径 (默认: batch_masks)')
+    parser.add_argument('-m', '--model', default='mobile_sam.pt',
+                       help='模型文件路径 (默认: mobile_sam.pt)')
+    parser.add_argument('--mode', choices=list(PROCESS_MODES), default='center',
+                       help='处理模式 (默认: center)')
+    parser.add_argument('--box', type=float, nargs=4, metavar=('X1', 'Y1', 'X2', 'Y2'),
+                       help='box 模式使用的相对坐标 (0-1)')
+    parser.add_argument('--grid', type=int, default=None,
+                       help='grid/objects 模式每边的点数 (默认: grid=3, objects=16)')
+    parser.add_argument('--min-score', type=float, default=0.8,
+                       help='objects 模式的mask置信度阈值 (默认: 0.8)')
+    parser.add_argument('--nms-iou', type=float, default=0.7,
+                       help='objects 模式的去重IoU阈值 (默认: 0.7)')
+    parser.add_argument('--sequence', action='store_true',
+                       help='序列模式: 按顺序处理连续帧，第一帧使用 --mode 的提示，之后的帧用前一帧mask的外接框作提示，'
+                            '跟踪丢失时重新使用 --mode 的提示')
+    parser.add_argument('--reuse-diff', type=float, default=2.0,
+                       help='序列模式: 与参考帧的平均灰度差异 (0-255) 不超过该值时直接复用mask, 0 表示不复用 (默认: 2.0)')
+    parser.add_argument('--min-iou', type=float, default=0.5,
+                       help='序列模式: 新mask与上一帧mask的IoU低于该值时认为跟踪丢失 (默认: 0.5)')
+    parser.add_argument('--area-jump', type=float, default=2.0,
+                       help='序列模式: mask面积变化超过该倍数时认为跟踪丢失 (默认: 2.0)')
+    parser.add_argument('--tile', type=int, default=None, metavar='SIZE',
+                       help='分块推理: 超大图片按 SIZE 像素的块分别编码后拼接，只编码与提示相交的块 (默认: 整张编码)')
+    parser.add_argument('--tile-overlap', type=int, default=128,
+                       help='分块推理: 相邻块重叠的像素数，重叠区域加权融合 (默认: 128)')
+    parser.add_argument('--combine', choices=COMBINE_MODES, default='union',
+                       help='多个mask的合并方式: union=并集, label=实例标签图, best=置信度最高 (默认: union)')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='png',
+                       help='输出格式: png=每张一个PNG, rle=COCO RLE 分片, npz=位打包分片 (默认: png)')
+    parser.add_argument('--shard-size', type=int, default=1000,
+                       help='rle/npz 格式每个分片的mask数 (默认: 1000)')
+    parser.add_argument('--png-compression', type=int, choices=range(10), default=None, metavar='0-9',
+                       help='PNG 压缩级别，越小越快、文件越大 (默认: OpenCV 默认值)')
+    parser.add_argument('--writers', type=int, default=None,
+                       help='每个进程的mask写入线程数 (默认: 单进程2个, 多进程每个进程1个)')
+    parser.add_argument('--batch-size', type=int, default=4,
+                       help='每次编码器调用处理的图片数 (默认: 4)')
+    parser.add_argument('--workers', type=int, default=1,
+                       help='进程数，每个进程加载一份模型 (默认: 1)')
+    parser.add_argument('--threads', type=int, default=None,
+                       help='每个进程的 torch/OpenCV 线程数 (默认: CPU核数/进程数)')
+    parser.add_argument('--precision', choices=PRECISIONS, default='fp32',
+                       help='图像编码器的精度: fp32=原模型, bf16=bfloat16 计算, int8=动态量化 (默认: fp32)；'
+                            '与 fp32 的速度和mask差异可用 benchmark.py --compare-fp32 测量')
+    parser.add_argument('--channels-last', action='store_true',
+                       help='图像编码器使用 channels_last 内存布局 (CPU 上卷积更快，结果不变)')
+    parser.add_argument('--autotune', action='store_true',
+                       help='启动时测量并选择最快的 torch 线程数 (结果按机器缓存; 指定 --threads 或 --workers 大于 1 时不调优)')
+    parser.add_argument('--backend', choices=BACKENDS, default='ultralytics',
+                       help='推理后端: ultralytics=PyTorch 模型, onnx=导出的 ONNX 模型在 ONNX Runtime 上运行 '
+                            '(第一次使用时自动导出; 支持 fp32/int8) (默认: ultralytics)')
+    parser.add_argument('--onnx-dir', default=None, metavar='DIR',
+                       help='onnx 后端的导出目录 (默认: 模型旁边的 <模型名>_onnx/)')
+    parser.add_argument('--shard', default=None,
+                       help='只处理第 i 片 (共 N 片)，格式 i/N，i 从 0 开始')
+    parser.add_argument('--cache', default=None, metavar='DIR',
+                       help='磁盘embedding缓存目录，换提示配置重跑时跳过图像编码器 (默认: 不使用)')
+    parser.add_argument('--cache-mb', type=int, default=4096,
+                       help='磁盘embedding缓存的大小上限 MB (默认: 4096)')
+    parser.add_argument('--force', action='store_true',
+                       help='忽略输出目录中的完成清单，重新处理所有图片')
+    parser.add_argument('--verify', choices=['mtime', 'hash'], default='mtime',
+                       help='判断输入是否改变: mtime=大小+修改时间, hash=内容SHA1 (默认: mtime)')
+    parser.add_argument('--stats', action='store_true',
+                       help=f'记录每张图片各阶段耗时到输出目录的 {STATS_LOG_NAME}，结束时打印 p50/p95/p99 汇总')
+    parser.add_argument('--profile', action='store_true',
+                       help=f'用 cProfile 分析处理过程（包括读取/写入线程），结果保存到输出目录 (多进程时每个进程一个文件)')
+    
+    args = parser.parse_args()
+    
+    print("\n" + "="*60)
+    print("批量 SAM Mask 生成器")
+    print("="*60 + "\n")
+    
+    # 配置参数
+    if args.replay is not None:
+        input_folder, output_folder, mode, box = args.replay, args.output, None, None
+        if args.sequence:
+            print("错误: 回放提示日志不支持序列模式")
+            return
+    elif args.input_folder is None:
+        input_folder, output_folder, mode, box = ask_config()
     else:
-        print("无效的选择，使用默认中心点模式")
-        generator.process_folder_auto(input_folder, output_folder, use_center_point=True)
+        input_folder, output_folder, mode, box = args.input_folder, args.output, args.mode, args.box
+        if mode == 'box' and box is None:
+            print("错误: box 模式需要 --box X1 Y1 X2 Y2")
+            return
+    
+    if input_folder != '-' and not os.path.exists(input_folder):
+        print(f"错误: {input_folder} 不存在")
+        return
+    
+    kind = 'journal' if args.replay is not None else source_kind(input_folder)
+    if args.workers > 1 and kind in ('tar', 'video'):
+        print("错误: tar 包和视频输入只能单进程处理 (--workers 1)")
+        return
+    if args.workers > 1 and args.sequence:
+        print("错误: 序列模式逐帧依赖前一帧，只能单进程处理 (--workers 1)")
+        return
+    if args.watch and (kind != 'folder' or args.workers > 1 or args.sequence or args.shard):
+        print("错误: 监视模式只支持文件夹输入，且不能与 --workers、--sequence、--shard 同时使用")
+        return
+    if args.backend == 'onnx' and (args.precision == 'bf16' or args.channels_last):
+        print("错误: onnx 后端只支持 --precision fp32/int8，不支持 --channels-last")
+        return
+    if args.tile is not None:
+        if args.sequence or mode == 'objects':
+            print("错误: 分块推理不支持序列模式和 objects 模式")
+            return
+        if not 0 <= args.tile_overlap < args.tile:
+            print("错误: --tile-overlap 应小于 --tile")
+            return
+    
+    try:
+        shard = parse_shard(args.shard) if args.shard else None
+        if kind == 'journal':
+            entries = load_journal(input_folder)
+            image_files, missing = journal_inputs(entries)
+            print(f"提示日志: {len(entries)} 张图片" + (f", 其中 {len(missing)} 张已不存在，跳过" if missing else ""))
+        elif args.watch:
+            image_files = None  # 由 FolderWatcher 持续扫描
+        else:
+            image_files = open_source(input_folder, args.recursive, args.frame_step)
+        if args.workers > 1:
+            image_files = list(image_files)  # 多进程按列表分配给各进程
+    except (ValueError, OSError) as e:
+        print(f"错误: {e}")
+        return
+    
+    streaming = not isinstance(image_files, list)
+    if args.watch:
+        print(f"监视模式: 持续处理 {input_folder} 中新到达的图片")
+    elif streaming:
+        print(f"流式输入 ({kind}): 边读取边处理")
+    elif len(image_files) == 0:
+        print(f"错误: 在 {input_folder} 中没有找到图片文件")
+        return
+    else:
+        print(f"找到 {len(image_files)} 张图片")
+    if shard is not None:
+        image_files = select_shard(image_files, *shard)
+        if streaming:
+            print(f"分片 {shard[0]}/{shard[1]}: 处理其中每 {shard[1]} 张的第 {shard[0] + 1} 张")
+        else:
+            print(f"分片 {shard[0]}/{shard[1]}: 处理其中 {len(image_files)} 张")
+    print(f"输出目录: {output_folder}")
+    if kind == 'journal':
+        print(f"处理模式: 回放提示日志 {input_folder}")
+        prompt_fn = JournalPrompts(entries)
+    else:
+        print(f"处理模式: {PROCESS_MODES[mode][1]}" + (f" {box}" if box else ""))
+        prompt_fn = make_prompt_fn(mode, box, args.grid, args.min_score, args.nms_iou)
+    sequence = dict(reuse_diff=args.reuse_diff, min_iou=args.min_iou,
+                    area_jump=args.area_jump) if args.sequence else None
+    tile = (args.tile, args.tile_overlap) if args.tile else None
+    manifest = RunManifest(output_folder, args.model,
+                           manifest_key(prompt_fn, args.combine, args.format, sequence, tile,
+                                        model_variant(args.precision, args.backend)),
+                           verify=args.verify, image_prompt=getattr(prompt_fn, "digest", None))
+    if not args.force and not args.watch:
+        image_files, _ = skip_done(manifest, image_files)
+    print(f"{'='*60}\n")
+    
+    if not streaming and len(image_files) == 0:
+        print("没有需要处理的图片")
+        return
+    
+    os.makedirs(output_folder, exist_ok=True)
+    stats_log = os.path.join(output_folder, STATS_LOG_NAME)
+    recorder = StageRecorder(stats_log) if args.stats else None
+    
+    start = time.perf_counter()
+    
+    if args.workers > 1:
+        # 每个进程各自调优会同时运行测量子进程，互相干扰；线程数由 run_parallel 按 CPU 平均分配
+        if args.autotune and not args.threads:
+            print("  --autotune 只用于单进程; 多进程时每个进程的线程数由 --threads 指定或按 CPU 平均分配")
+        stats = run_parallel(image_files, output_folder, prompt_fn, args.workers,
+                             model_path=args.model, threads=args.threads,
+                             verify=args.verify, profile=args.profile,
+                             stats_log=stats_log if recorder else None,
+                             run_id=recorder.run_id if recorder else None,
+                             batch_size=args.batch_size,
+                             cache_dir=args.cache, cache_size_mb=args.cache_mb,
+                             combine=args.combine, output_format=args.format,
+                             shard_size=args.shard_size, png_compression=args.png_compression,
+                             num_writers=args.writers or 1,
+                             tile_size=args.tile, tile_overlap=args.tile_overlap,
+                             precision=args.precision, channels_last=args.channels_last,
+                             backend=args.backend, onnx_dir=args.onnx_dir)
+    else:
+        if args.threads:
+            import torch
+            torch.set_num_threads(args.threads)
+            cv2.setNumThreads(args.threads)
+        generator = BatchMaskGenerator(args.model, batch_size=args.batch_size,
+                                       cache_dir=args.cache, cache_size_mb=args.cache_mb,
+                                       num_writers=args.writers or 2,
+                                       combine=args.combine, output_format=args.format,
+                                       shard_size=args.shard_size, png_compression=args.png_compression,
+                                       tile_size=args.tile, tile_overlap=args.tile_overlap,
+                                       precision=args.precision, channels_last=args.channels_last,
+                                       autotune=args.autotune and not args.threads,
+                                       backend=args.backend, onnx_dir=args.onnx_dir)
+        profile_path = os.path.join(output_folder, PROFILE_NAME)
+        with profiled(profile_path) if args.profile else nullcontext():
+            if args.watch:
+                stats = generator.watch(input_folder, output_folder, prompt_fn, manifest=manifest,
+                                        recorder=recorder, resume=not args.force, recursive=args.recursive,
+                                        interval=args.poll, settle=args.settle,
+                                        queue_size=args.watch_queue, status_interval=args.status_interval,
+                                        use_inotify=not args.no_inotify)
+            elif sequence is not None:
+                stats = generator.process_sequence(image_files, output_folder, prompt_fn, manifest=manifest,
+                                                   recorder=recorder, **sequence)
+            else:
+                stats = generator.process_files(image_files, output_folder, prompt_fn, manifest=manifest,
+                                                recorder=recorder)
+        if generator.cache is not None:
+            print(generator.cache.stats_line())
+    
+    elapsed = time.perf_counter() - start
+    total = stats['total'] if streaming else len(image_files)
+    print_summary(stats, total)
+    if sequence is not None:
+        print(f"序列模式: 提示 {stats['prompted']} 帧, 跟踪 {stats['tracked']} 帧, "
+              f"复用 {stats['reused']} 帧; 编码器运行 {stats['encoded']} 次\n")
+    print(f"总耗时: {elapsed:.1f}s, 吞吐: {total / elapsed:.2f} 张/秒\n")
+    
+    if recorder is not None:
+        save_report(stats_log, recorder.run_id, elapsed, output_folder)
 
 
 if __name__ == "__main__":
     main()
-
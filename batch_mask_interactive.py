@@ -6,41 +6,117 @@
   - 空格键: 生成mask并进入下一张
   - S键: 跳过当前图片
   - R键: 重新绘制当前图片的框
+  - P键: 开关实时预览 (--live-preview)
+  - 滚轮 / + - 键: 缩放，0键: 整图显示，中键拖拽 / I J K L 键: 平移
   - Q键: 退出程序
+
+实时预览 (--live-preview): 拖拽框时在后台线程中只运行解码器，显示当前所有框的低分辨率mask（蓝色），
+松开鼠标前就能看到分割效果，见 live_preview。
+
+序列模式 (--sequence): 从第二帧起，用上一帧mask的外接框自动生成候选mask（画面几乎不变时直接
+复用上一帧的mask），按空格接受；跟踪丢失的物体标为红色，按R重画。--auto-accept 时自动接受
+跟踪成功的帧，只在跟踪丢失时停下来等待重新标注。
+
+启动时先打开窗口显示第一张图片，模型在后台加载（见 model_loader）；加载期间可以先画框，
+按空格的生成请求排队，模型就绪后自动完成。
+
+每张保存的图片的框都记录到输出目录的提示日志 (prompts.jsonl)，之后可以用
+batch_mask.py --replay 重新生成全部mask，见 prompt_journal。
 """
 
 import cv2
-import numpy as np
-from ultralytics import SAM
+from prefetch import ImagePrefetcher
+from image_sources import list_images
+from image_io import read_image
+from mask_combine import COMBINE_MODES, combine_masks, extract_masks, mask_preview
+from mask_sinks import OUTPUT_FORMATS, make_sink
+from mask_writer import AsyncMaskWriter
+from sequence_tracker import TRACK_LOST, TRACK_REUSED, SequenceTracker
+from live_preview import LivePreview
+from display_canvas import DisplayCanvas
+from prompt_journal import JOURNAL_NAME, PromptJournal
+from sam_backends import BACKENDS, PRECISIONS
+from model_loader import BackgroundLoader, StartupTimer, open_and_encode
+from run_report import PROFILE_NAME, STATS_LOG_NAME, StageRecorder, profiled, save_report
 import os
-from pathlib import Path
+import time
+from contextlib import nullcontext
 
 
 class InteractiveBatchMask:
-    def __init__(self, input_folder, output_folder="batch_masks_manual", model_path="mobile_sam.pt"):
-        """初始化交互式批量处理器"""
+    def __init__(self, input_folder, output_folder="batch_masks_manual", model_path="mobile_sam.pt",
+                 prefetch_depth=1, prefetch_memory_mb=512, cache_dir=None, cache_size_mb=4096,
+                 combine="union", output_format="png", shard_size=1000, png_compression=None,
+                 sequence=False, auto_accept=False, tracker_options=None,
+                 live_preview=False, preview_interval_ms=50, debug=False, journal_path=None,
+                 precision="fp32", channels_last=False, autotune=False, backend="ultralytics", onnx_dir=None,
+                 recorder=None):
+        """
+        初始化交互式批量处理器
+
+        参数:
+            prefetch_depth: 后台提前编码的图片张数（0 表示关闭）
+            prefetch_memory_mb: 预编码结果的内存上限 (MB)
+            cache_dir: 磁盘embedding缓存目录（None 表示不使用缓存）
+            cache_size_mb: 磁盘embedding缓存的大小上限 (MB)
+            combine: 多个框的mask合并方式 union / label / best，见 mask_combine
+            output_format: 输出格式 png / rle / npz，见 mask_sinks
+            shard_size: rle / npz 格式每个分片的mask数
+            png_compression: PNG 压缩级别 0-9（None 使用 OpenCV 默认值）
+            sequence: 序列模式，用上一帧的mask为下一帧生成候选mask，见 sequence_tracker
+            auto_accept: 序列模式下自动接受跟踪成功的帧
+            tracker_options: 传给 SequenceTracker 的参数（reuse_diff、min_iou、area_jump 等）
+            live_preview: 拖拽框时实时预览低分辨率mask（运行中可按P开关）
+            preview_interval_ms: 预览解码的最短间隔（毫秒）
+            debug: 打印鼠标事件等调试信息
+            journal_path: 提示日志路径（默认为输出目录中的 prompts.jsonl）
+            precision: 图像编码器的精度 fp32 / bf16 / int8，见 cpu_fastpath
+            channels_last: 图像编码器使用 channels_last 内存布局
+            autotune: 启动时自动选择 torch 线程数（结果按机器缓存）
+            backend: 推理后端 ultralytics / onnx，见 sam_backends
+            onnx_dir: onnx 后端的导出目录（默认为模型旁边的 <模型名>_onnx/）
+            recorder: run_report.StageRecorder，记录每张图片 read / encode / decode / combine / write 的耗时
+        """
         self.input_folder = input_folder
         self.output_folder = output_folder
         self.model_path = model_path
+        self.combine = combine
+        self.debug = debug
+        self.recorder = recorder
+        self.timer = StartupTimer()  # 启动各阶段的时间（打开窗口、模型就绪）
         
-        # 加载模型
-        print(f"\n正在加载模型: {model_path}")
-        self.model = SAM(model_path)
-        print(f"✓ 模型已加载")
-        
-        # 创建输出文件夹
-        os.makedirs(output_folder, exist_ok=True)
-        
-        # 获取所有图片
-        self.image_files = self._get_image_files()
+        # 获取所有图片（在加载模型之前，没有图片时立即报错）
+        self.image_files = list_images(self.input_folder)
         
         if len(self.image_files) == 0:
             raise ValueError(f"在 {input_folder} 中没有找到图片")
         
+        # 在后台加载模型并编码第一张图片，窗口先打开；依赖模型的组件在 attach_session 中创建
+        print(f"\n正在后台加载模型: {model_path}")
+        self.loader = BackgroundLoader(open_and_encode, self.image_files[0], model_path=model_path,
+                                       backend=backend, precision=precision, channels_last=channels_last,
+                                       autotune=autotune, onnx_dir=onnx_dir, cache_dir=cache_dir,
+                                       cache_size_mb=cache_size_mb, recorder=recorder)
+        self.session = None  # 缓存当前图片的embedding
+        self.prefetcher = None
+        self.tracker = None
+        self.preview = None
+        self.prefetch_options = dict(depth=prefetch_depth, max_memory_mb=prefetch_memory_mb, recorder=recorder)
+        self.tracker_options = (tracker_options or {}) if sequence else None
+        self.preview_options = dict(interval_ms=preview_interval_ms, enabled=live_preview)
+        self.pending_save = False  # 模型加载期间按了空格，就绪后自动生成
+        
+        # 创建输出文件夹
+        os.makedirs(output_folder, exist_ok=True)
+        # 保存在后台线程中进行，不阻塞标注下一张
+        self.writer = AsyncMaskWriter(make_sink(output_format, output_folder, shard_size,
+                                                png_compression=png_compression), recorder=recorder)
+        # 记录每张图片的框，用于回放
+        self.journal = PromptJournal(journal_path or os.path.join(output_folder, JOURNAL_NAME))
+        
         # 当前图片相关
         self.current_index = 0
         self.current_image = None
-        self.display_image = None
         
         # 框绘制相关
         self.drawing = False
@@ -48,56 +124,156 @@ class InteractiveBatchMask:
         self.box_end = None
         self.boxes = []  # 当前图片的所有框
         
+        # 序列模式: 由上一帧得到的候选mask（TrackResult），框未修改时按空格直接保存
+        self.auto_accept = auto_accept
+        self.proposal = None
+        
         # 窗口名称（使用英文避免乱码）
         self.window_name = "Batch Mask Tool"
+        # 显示分辨率的画布: 鼠标事件只更新状态，主循环按刷新率合并重画
+        self.canvas = DisplayCanvas(self.window_name)
         
         # 统计
         self.processed_count = 0
         self.skipped_count = 0
     
-    def _get_image_files(self):
-        """获取所有图片文件"""
-        image_extensions = ['.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp']
-        image_files = []
-        for ext in image_extensions:
-            image_files.extend(Path(self.input_folder).glob(f'*{ext}'))
-            image_files.extend(Path(self.input_folder).glob(f'*{ext.upper()}'))
-        return sorted(list(set(image_files)))
-    
     def load_current_image(self):
         """加载当前图片"""
         if self.current_index >= len(self.image_files):
             return False
         
         image_path = self.image_files[self.current_index]
-        self.current_image = cv2.imread(str(image_path))
         
-        if self.current_image is None:
+        if self.session is None:
+            # 模型还在后台加载: 先显示图片，可以先画框，就绪后再编码（见 attach_session）
+            image, _ = read_image(image_path)
+        else:
+            # 取出预编码结果（未预编码时在这里读取并编码），同时丢弃上一张图片的embedding
+            self.session.reset_image()
+            embedding = self.prefetcher.get(self.current_index)
+            
+            # 在用户标注当前图片时，后台编码接下来的图片
+            self.prefetcher.prefetch(self.current_index)
+            
+            if embedding is not None:
+                self.session.set_embedding(embedding)
+                self.preview.clear()
+            image = embedding.image if embedding is not None else None
+        
+        if image is None:
             print(f"错误: 无法读取图片 {image_path}")
             return False
         
-        self.display_image = self.current_image.copy()
+        self.current_image = image
+        self.canvas.set_image(self.current_image)
         self.boxes = []
         self.drawing = False
+        self.proposal = None
+        self.pending_save = False
+        
+        if self.tracker is not None and self.tracker.active:
+            self.propose_from_previous()
         
-        # 更新窗口标题（使用英文避免乱码）
+        self.update_title()
+        return True
+    
+    def update_title(self):
+        """更新窗口标题（使用英文避免乱码）"""
         progress = f"[{self.current_index + 1}/{len(self.image_files)}]"
-        filename = image_path.name
-        title = f"{progress} {filename} - Draw box | Space:OK S:Skip R:Reset Q:Quit"
+        filename = self.image_files[self.current_index].name
+        if self.proposal is not None and self.proposal.status == TRACK_LOST:
+            title = f"{progress} {filename} - Tracking lost, R:Redraw | Space:OK S:Skip Q:Quit"
+        elif self.proposal is not None:
+            title = f"{progress} {filename} - Tracked | Space:Accept R:Redraw S:Skip Q:Quit"
+        else:
+            title = f"{progress} {filename} - Draw box | Space:OK S:Skip R:Reset Q:Quit"
+        if self.session is None:
+            title += " (loading model...)"
         cv2.setWindowTitle(self.window_name, title)
+    
+    def attach_session(self):
+        """
+        模型加载完成: 创建依赖模型的组件，设置当前图片的embedding，应用加载期间画的框
         
+        返回:
+            是否成功（加载失败时打印错误）
+        """
+        try:
+            session, first = self.loader.result()
+        except Exception as e:
+            print(f"\n✗ 模型加载失败: {e}")
+            return False
+        ready = self.timer.mark("model_ready")
+        print(f"\n✓ 模型已加载 (后台 {self.loader.seconds:.1f}s, 启动后 {ready:.1f}s 就绪)")
+        
+        self.session = session
+        # 标注当前图片时在后台编码下一张
+        self.prefetcher = ImagePrefetcher(session, self.image_files, **self.prefetch_options)
+        if self.tracker_options is not None:
+            self.tracker = SequenceTracker(session, **self.tracker_options)
+        # 实时预览: 后台线程解码，主循环中取出结果重画
+        self.preview = LivePreview(session, **self.preview_options)
+        
+        image_path = self.image_files[self.current_index]
+        if first is not None and first.image_path == image_path:
+            embedding = first
+        else:
+            embedding = self.prefetcher.get(self.current_index)  # 加载期间跳过了第一张
+        self.prefetcher.prefetch(self.current_index)
+        if embedding is None:
+            print(f"错误: 无法读取图片 {image_path}")
+            return False
+        session.set_embedding(embedding)
+        if self.boxes:
+            self.preview.request(bboxes=self.boxes)
+        self.update_title()
         return True
     
+    def propose_from_previous(self):
+        """序列模式: 用上一帧的mask为当前帧生成候选mask，并画在图片上"""
+        embedding = self.session.embedding
+        with self._timed("decode"):
+            self.proposal = self.tracker.track(self.current_image, lambda: embedding)
+        self.boxes = [list(box) for box in self.proposal.boxes]
+        
+        # 跟踪成功的物体绿色，丢失的红色
+        for i, (mask, box) in enumerate(zip(self.proposal.masks, self.boxes)):
+            color = (0, 0, 255) if i in self.proposal.lost else (0, 255, 0)
+            self.canvas.tint(mask, color)
+            self.canvas.draw_box(box, color, f"Box{i+1}")
+        
+        if self.proposal.status == TRACK_REUSED:
+            print(f"  画面几乎没变 (差异 {self.proposal.diff:.1f})，复用上一帧的mask")
+        elif self.proposal.status == TRACK_LOST:
+            lost = ", ".join(f"Box{i+1}" for i in self.proposal.lost)
+            print(f"  ⚠ 跟踪丢失: {lost}，请按R重画框")
+        else:
+            print(f"  已根据上一帧生成 {len(self.boxes)} 个物体的mask，按空格接受")
+    
+    def toggle_preview(self):
+        """开关实时预览"""
+        if self.preview is None:
+            enabled = self.preview_options["enabled"] = not self.preview_options["enabled"]
+            print(f"  实时预览: {'开' if enabled else '关'} (模型就绪后生效)")
+            return
+        enabled = self.preview.toggle()
+        self.canvas.set_overlay(None)
+        print(f"  实时预览: {'开' if enabled else '关'}")
+    
+    def _debug(self, message):
+        if self.debug:
+            print(f"  [调试] {message}")
+    
     def mouse_callback(self, event, x, y, flags, param):
-        """鼠标回调函数"""
-        # 调试：打印所有事件（除了鼠标移动）
+        """鼠标回调函数（只更新状态，画面由主循环中的 canvas.present() 刷新）"""
         if event != cv2.EVENT_MOUSEMOVE:
-            print(f"  [调试] 鼠标事件: event={event}, 坐标=({x}, {y})")
+            self._debug(f"鼠标事件: event={event}, 坐标=({x}, {y})")
+        if self.canvas.handle_mouse(event, x, y, flags):
+            return  # 滚轮缩放、中键平移
+        x, y = self.canvas.to_image(x, y)  # 视口坐标 -> 原图坐标
         
-        # 参考 interactive_mask.py 的实现
         if event == cv2.EVENT_LBUTTONDOWN:
             # 开始绘制框
-            print(f"  [调试] 检测到 LBUTTONDOWN 事件！")
             self.drawing = True
             self.box_start = (x, y)
             self.box_end = (x, y)
@@ -105,44 +281,38 @@ class InteractiveBatchMask:
             
         elif event == cv2.EVENT_MOUSEMOVE:
             if self.drawing:
-                # 实时更新框的显示
+                # 只更新橡皮筋框（紫色），已完成的框在画布底层，不重画
                 self.box_end = (x, y)
-                print(f"  [调试] 鼠标移动: ({x}, {y})")  # 调试移动坐标
-                temp_img = self.display_image.copy()
-                
-                # 绘制之前保存的框（绿色）
-                for box in self.boxes:
-                    cv2.rectangle(temp_img, (box[0], box[1]), (box[2], box[3]), 
-                                (0, 255, 0), 2)
-                    cv2.putText(temp_img, f"Box{self.boxes.index(box)+1}", 
-                              (box[0], box[1]-10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
+                self.canvas.set_band(self.box_start + self.box_end)
                 
-                # 绘制当前正在画的框（紫色）
-                cv2.rectangle(temp_img, self.box_start, self.box_end, (255, 0, 255), 2)
-                cv2.imshow(self.window_name, temp_img)
+                # 预览已有的框加上正在画的框
+                x1, x2 = sorted((self.box_start[0], x))
+                y1, y2 = sorted((self.box_start[1], y))
+                if x2 - x1 > 3 and y2 - y1 > 3 and self.preview is not None:
+                    self.preview.request(bboxes=self.boxes + [[x1, y1, x2, y2]])
                 
         elif event == cv2.EVENT_LBUTTONUP:
             if self.drawing:
                 # 完成框的绘制
                 self.drawing = False
                 self.box_end = (x, y)
+                self.canvas.set_band(None)
                 
                 # 计算框的坐标 [x1, y1, x2, y2]
                 x1 = min(self.box_start[0], self.box_end[0])
                 y1 = min(self.box_start[1], self.box_end[1])
                 x2 = max(self.box_start[0], self.box_end[0])
                 y2 = max(self.box_start[1], self.box_end[1])
-                print(f"  [调试] 框计算结果: start={self.box_start}, end={self.box_end} -> ({x1},{y1})-({x2},{y2}), 宽={x2-x1}, 高={y2-y1}")
+                self._debug(f"框计算结果: start={self.box_start}, end={self.box_end} -> ({x1},{y1})-({x2},{y2}), 宽={x2-x1}, 高={y2-y1}")
                 
                 # 确保框有一定大小（降低限制）
                 if x2 - x1 > 3 and y2 - y1 > 3:
                     self.boxes.append([x1, y1, x2, y2])
                     
-                    # 在display_image上绘制最终的框（绿色）
-                    cv2.rectangle(self.display_image, (x1, y1), (x2, y2), (0, 255, 0), 2)
-                    cv2.putText(self.display_image, f"Box{len(self.boxes)}", 
-                              (x1, y1-10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
-                    cv2.imshow(self.window_name, self.display_image)
+                    # 在画布底层绘制最终的框（绿色）
+                    self.canvas.draw_box([x1, y1, x2, y2], (0, 255, 0), f"Box{len(self.boxes)}")
+                    if self.preview is not None:
+                        self.preview.request(bboxes=self.boxes)
                     
                     print(f"  ✓ 添加框 {len(self.boxes)}: ({x1}, {y1}) -> ({x2}, {y2})")
                 else:
@@ -152,8 +322,12 @@ class InteractiveBatchMask:
         """重置当前图片的框"""
         self.boxes = []
         self.drawing = False
-        self.display_image = self.current_image.copy()
-        cv2.imshow(self.window_name, self.display_image)
+        self.proposal = None
+        if self.preview is not None:
+            self.preview.clear()
+        self.canvas.set_overlay(None)
+        self.canvas.set_band(None)
+        self.canvas.reset()
         print("  已重置所有框")
     
     def generate_and_save_mask(self):
@@ -161,57 +335,81 @@ class InteractiveBatchMask:
         if len(self.boxes) == 0:
             print("  ✗ 未绘制框，请至少绘制一个框或按S跳过")
             return False
+        if self.session is None:
+            # 模型还在加载: 记下请求，就绪后在主循环中自动生成
+            self.pending_save = True
+            print("  模型加载中，加载完成后自动生成mask...")
+            return False
         
         try:
             image_path = self.image_files[self.current_index]
             
-            print(f"\n  正在生成mask...")
-            print(f"  使用 {len(self.boxes)} 个框")
+            if self.proposal is not None and self.boxes == self.proposal.boxes:
+                # 序列模式下接受候选mask，不需要再解码
+                masks, scores = self.proposal.masks, self.proposal.scores
+            else:
+                print(f"\n  正在生成mask...")
+                print(f"  使用 {len(self.boxes)} 个框")
+                
+                # 每张图片只编码一次，重画框后再次生成只运行解码器
+                with self._timed("decode"):
+                    results = self.session.predict(bboxes=self.boxes)
+                    masks, scores = extract_masks(results[0]) if results else (None, None)
             
-            # 调用SAM模型
-            results = self.model.predict(
-                str(image_path),
-                bboxes=self.boxes,
-                save=False,
-                verbose=False
-            )
+            h, w = self.current_image.shape[:2]
+            boxes = [list(box) for box in self.boxes]
             
-            # 提取并保存mask
-            if results and len(results) > 0:
-                result = results[0]
-                if result.masks is not None and len(result.masks) > 0:
-                    # 获取mask
-                    mask_data = result.masks.data[0].cpu().numpy()
-                    binary_mask = (mask_data * 255).astype(np.uint8)
-                    
-                    # 保存
-                    output_name = image_path.stem + '.png'
-                    output_path = os.path.join(self.output_folder, output_name)
-                    cv2.imwrite(output_path, binary_mask)
-                    
-                    print(f"  ✓ 已保存: {output_name}")
-                    
-                    # 显示mask预览（小窗口）
-                    cv2.imshow("Mask Preview", binary_mask)
-                    cv2.waitKey(500)  # 显示0.5秒
-                    
-                    self.processed_count += 1
-                    return True
-                else:
-                    print(f"  ✗ 未检测到mask")
-                    return False
+            # 保存mask（每个框一个mask，按合并方式合成一张）
+            if masks is not None:
+                with self._timed("combine"):
+                    binary_mask = combine_masks(masks, scores, self.combine)
+                
+                # 保存；写入成功后（在写入线程中）才把框记录到提示日志
+                self.writer.submit(image_path, binary_mask,
+                                   on_saved=lambda path, _: self.journal.record(path, (w, h), boxes=boxes))
+                
+                print(f"  ✓ 已保存: {image_path.stem}")
+                
+                # 复用的帧不更新参考帧，避免缓慢变化累积
+                if self.tracker is not None and not (
+                        self.proposal is not None and self.proposal.status == TRACK_REUSED
+                        and masks is self.proposal.masks):
+                    self.tracker.set_reference(self.current_image, masks, scores)
+                
+                # 显示mask预览（小窗口）
+                cv2.imshow("Mask Preview", mask_preview(binary_mask))
+                cv2.waitKey(500)  # 显示0.5秒
+                
+                self.processed_count += 1
+                return True
             else:
-                print(f"  ✗ 处理失败")
+                # 没有mask也记录框，之后可以用新模型 --replay 重新生成
+                self.journal.record(image_path, (w, h), boxes=boxes, saved=False)
+                self._finish_record(False, "未检测到mask")
+                print(f"  ✗ 未检测到mask (框已记录到提示日志)")
                 return False
                 
         except Exception as e:
             print(f"  ✗ 错误: {e}")
+            self._finish_record(False, str(e))
             return False
     
+    def _timed(self, stage):
+        """当前图片一个阶段的计时上下文（未开启 --stats 时不计时）"""
+        if self.recorder is None:
+            return nullcontext()
+        return self.recorder.time(self.image_files[self.current_index], stage)
+    
+    def _finish_record(self, ok, message):
+        """没有提交写入的图片在这里结束阶段记录（提交写入的由 AsyncMaskWriter 写完后结束）"""
+        if self.recorder is not None:
+            self.recorder.finish(self.image_files[self.current_index], ok, message)
+    
     def skip_current(self):
         """跳过当前图片"""
         print(f"  跳过")
         self.skipped_count += 1
+        self._finish_record(False, "跳过")
     
     def run(self):
         """运行交互式批量处理"""
@@ -228,7 +426,12 @@ class InteractiveBatchMask:
         print(f"  - 空格键: 生成mask并进入下一张")
         print(f"  - S键: 跳过当前图片")
         print(f"  - R键: 重新绘制当前图片的框")
+        print(f"  - P键: 开关实时预览 (拖拽时显示低分辨率mask，当前: {'开' if self.preview_options['enabled'] else '关'})")
+        print(f"  - 滚轮 / +-键: 缩放，0键: 整图显示，中键拖拽 / IJKL键: 平移")
         print(f"  - Q键: 退出程序")
+        if self.tracker_options is not None:
+            print(f"  序列模式: 根据上一帧自动生成候选mask (绿色)，空格接受；跟踪丢失的物体为红色，按R重画"
+                  + ("\n    自动接受跟踪成功的帧，按任意键在当前帧停下" if self.auto_accept else ""))
         print(f"{'='*70}\n")
         
         # 创建窗口（使用 WINDOW_NORMAL 允许调整大小）
@@ -246,28 +449,48 @@ class InteractiveBatchMask:
             print(f"  图片尺寸: {self.current_image.shape[1]} x {self.current_image.shape[0]}")
             
             # 显示图片并设置鼠标回调（每次加载新图片时重新设置）
-            # 根据图片大小调整窗口（但不超过屏幕）
+            # 画布已按比例缩小到不超过 1600x1200，窗口与画布一样大
             h, w = self.current_image.shape[:2]
-            max_w, max_h = 1600, 1200
-            if w > max_w or h > max_h:
-                scale = min(max_w/w, max_h/h)
-                new_w, new_h = int(w*scale), int(h*scale)
-            else:
-                new_w, new_h = w, h
+            new_w, new_h = self.canvas.display_size
             cv2.resizeWindow(self.window_name, new_w, new_h)
             
-            cv2.imshow(self.window_name, self.display_image)
-            print(f"  正在设置鼠标回调...")
+            self.canvas.present(force=True)
             cv2.setMouseCallback(self.window_name, self.mouse_callback)
-            print(f"  ✓ 鼠标回调已设置")
-            print(f"  窗口大小: {new_w}x{new_h}, 图片大小: {w}x{h}")
+            self._debug(f"鼠标回调已设置, 窗口大小: {new_w}x{new_h}, 图片大小: {w}x{h}")
+            if "first_window" not in self.timer.marks:
+                print(f"  ✓ 窗口已打开 (启动后 {self.timer.mark('first_window'):.2f}s"
+                      + ("，模型在后台加载，可以先画框)" if self.session is None else ")"))
             print(f"  请在窗口中拖拽鼠标绘制框...")
             
+            if self.auto_accept and self.proposal is not None and self.proposal.status != TRACK_LOST:
+                # 自动接受跟踪成功的帧；按任意键在当前帧停下，手动确认
+                if cv2.waitKey(1) == -1 and self.generate_and_save_mask():
+                    self.current_index += 1
+                    continue
+            
             # 等待用户操作
             while True:
                 key = cv2.waitKey(1) & 0xFF
                 
-                if key == ord(' '):  # 空格 - 生成mask
+                if self.session is None and self.loader.ready:
+                    if not self.attach_session():
+                        self.close()
+                        return
+                    if self.pending_save:  # 加载期间按了空格
+                        self.pending_save = False
+                        if self.generate_and_save_mask():
+                            self.current_index += 1
+                            break
+                
+                # 后台线程产生了新的预览mask时重画（GUI 只在主线程中更新）
+                if self.preview is not None and self.preview.poll():
+                    self.canvas.set_overlay(self.preview.mask)
+                self.canvas.present()
+                
+                if self.canvas.handle_key(key):  # 缩放 / 平移
+                    pass
+                    
+                elif key == ord(' '):  # 空格 - 生成mask
                     if self.generate_and_save_mask():
                         self.current_index += 1
                         break
@@ -280,15 +503,28 @@ class InteractiveBatchMask:
                 elif key == ord('r') or key == ord('R'):  # R - 重置
                     self.reset_current_boxes()
                     
+                elif key == ord('p') or key == ord('P'):  # P - 开关实时预览
+                    self.toggle_preview()
+                    
                 elif key == ord('q') or key == ord('Q'):  # Q - 退出
                     print("\n用户退出")
-                    cv2.destroyAllWindows()
-                    self._print_summary()
+                    self.close()
                     return
         
         # 处理完成
+        self.close()
+    
+    def close(self):
+        """关闭后台线程和窗口，打印统计"""
+        if self.preview is not None:
+            self.preview.close()
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+        self.writer.close()
         cv2.destroyAllWindows()
         self._print_summary()
+        if not self.loader.ready:
+            print("等待模型加载结束后退出...")  # 加载到一半退出进程会让 torch 异常终止
     
     def _print_summary(self):
         """打印统计摘要"""
@@ -296,10 +532,19 @@ class InteractiveBatchMask:
         print(f"处理完成！")
         print(f"{'='*70}")
         print(f"总图片数: {len(self.image_files)}")
-        print(f"已处理: {self.processed_count}")
+        print(f"已处理: {self.processed_count} (已保存 {self.writer.written}"
+              + (f", 保存失败 {self.writer.failed})" if self.writer.failed else ")"))
         print(f"已跳过: {self.skipped_count}")
         print(f"未处理: {len(self.image_files) - self.processed_count - self.skipped_count}")
+        if self.tracker is not None:
+            counts = self.tracker.counts
+            print(f"序列模式: 跟踪 {counts['tracked']} 帧, 复用 {counts['reused']} 帧, 跟踪丢失 {counts['lost']} 帧")
+        if self.preview is not None and self.preview.decoded:
+            print(f"实时预览: 解码 {self.preview.decoded} 次, 丢弃过期请求 {self.preview.dropped} 次")
+        if self.debug:
+            print(f"画面刷新: {self.canvas.frames} 次 (画面变化 {self.canvas.updates} 次)")
         print(f"输出目录: {self.output_folder}")
+        print(f"提示日志: {self.journal.path} (用 batch_mask.py --replay 重新生成)")
         print(f"{'='*70}\n")
 
 
@@ -316,11 +561,17 @@ def main():
   3. 按空格键生成mask并进入下一张
   4. 按S键跳过当前图片
   5. 按R键重置当前图片的框
-  6. 按Q键退出程序
+  6. 按P键开关实时预览
+  7. 滚轮或 +/- 键缩放，0键整图显示，中键拖拽或 I/J/K/L 键平移
+  8. 按Q键退出程序
 
 示例:
   python batch_mask_interactive.py images/
   python batch_mask_interactive.py images/ -o my_masks/
+  python batch_mask_interactive.py images/ggbond --sequence --auto-accept
+  python batch_mask_interactive.py images/ggbond --live-preview
+  python batch_mask_interactive.py images/ggbond --precision int8 --autotune
+  python batch_mask_interactive.py images/ggbond --backend onnx
         """
     )
     
@@ -330,6 +581,56 @@ def main():
                        help='输出mask文件夹路径')
     parser.add_argument('-m', '--model', default='mobile_sam.pt', 
                        help='模型文件路径 (默认: mobile_sam.pt)')
+    parser.add_argument('--prefetch', type=int, default=1,
+                       help='后台提前编码的图片张数, 0 表示关闭 (默认: 1)')
+    parser.add_argument('--prefetch-mb', type=int, default=512,
+                       help='预编码结果的内存上限 MB (默认: 512)')
+    parser.add_argument('--combine', choices=COMBINE_MODES, default='union',
+                       help='多个框的mask合并方式: union=并集, label=实例标签图, best=置信度最高 (默认: union)')
+    parser.add_argument('--cache', default=None, metavar='DIR',
+                       help='磁盘embedding缓存目录，可与 batch_mask.py 共用 (默认: 不使用)')
+    parser.add_argument('--sequence', action='store_true',
+                       help='序列模式: 用上一帧的mask为下一帧生成候选mask，只需标注第一帧和跟踪丢失的帧')
+    parser.add_argument('--auto-accept', action='store_true',
+                       help='序列模式: 自动接受跟踪成功的帧，只在跟踪丢失时停下')
+    parser.add_argument('--reuse-diff', type=float, default=2.0,
+                       help='序列模式: 与参考帧的平均灰度差异 (0-255) 不超过该值时直接复用mask (默认: 2.0)')
+    parser.add_argument('--min-iou', type=float, default=0.5,
+                       help='序列模式: 新mask与上一帧mask的IoU低于该值时认为跟踪丢失 (默认: 0.5)')
+    parser.add_argument('--area-jump', type=float, default=2.0,
+                       help='序列模式: mask面积变化超过该倍数时认为跟踪丢失 (默认: 2.0)')
+    parser.add_argument('--cache-mb', type=int, default=4096,
+                       help='磁盘embedding缓存的大小上限 MB (默认: 4096)')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='png',
+                       help='输出格式: png=每张一个PNG, rle=COCO RLE 分片, npz=位打包分片 (默认: png)')
+    parser.add_argument('--shard-size', type=int, default=1000,
+                       help='rle/npz 格式每个分片的mask数 (默认: 1000)')
+    parser.add_argument('--png-compression', type=int, choices=range(10), default=None, metavar='0-9',
+                       help='PNG 压缩级别，越小越快、文件越大 (默认: OpenCV 默认值)')
+    parser.add_argument('--live-preview', action='store_true',
+                       help='拖拽框时实时预览低分辨率mask，运行中按P开关 (默认: 关)')
+    parser.add_argument('--preview-interval', type=int, default=50, metavar='MS',
+                       help='实时预览两次解码之间的最短间隔 毫秒 (默认: 50)')
+    parser.add_argument('--debug', action='store_true',
+                       help='打印鼠标事件等调试信息')
+    parser.add_argument('--journal', default=None, metavar='PATH',
+                       help=f'提示日志路径 (默认: 输出目录中的 {JOURNAL_NAME})')
+    parser.add_argument('--precision', choices=PRECISIONS, default='fp32',
+                       help='图像编码器的精度: fp32=原模型, bf16=bfloat16 计算, int8=动态量化 (默认: fp32)')
+    parser.add_argument('--channels-last', action='store_true',
+                       help='图像编码器使用 channels_last 内存布局 (CPU 上卷积更快，结果不变)')
+    parser.add_argument('--autotune', action='store_true',
+                       help='启动时测量并选择最快的 torch 线程数 (结果按机器缓存)')
+    parser.add_argument('--backend', choices=BACKENDS, default='ultralytics',
+                       help='推理后端: ultralytics=PyTorch 模型, onnx=导出的 ONNX 模型在 ONNX Runtime 上运行 '
+                            '(第一次使用时自动导出; 支持 fp32/int8) (默认: ultralytics)')
+    parser.add_argument('--onnx-dir', default=None, metavar='DIR',
+                       help='onnx 后端的导出目录 (默认: 模型旁边的 <模型名>_onnx/)')
+    parser.add_argument('--stats', action='store_true',
+                       help=f'记录每张图片 read/encode/decode/combine/write 的耗时到输出目录的 {STATS_LOG_NAME}，'
+                            '结束时打印 p50/p95/p99 汇总')
+    parser.add_argument('--profile', action='store_true',
+                       help=f'用 cProfile 分析整个会话（包括后台加载、预编码和写入线程），结果保存到输出目录的 {PROFILE_NAME}')
     
     args = parser.parse_args()
     
@@ -343,14 +644,42 @@ def main():
         print(f"错误: 模型文件 '{args.model}' 不存在")
         return
     
+    if args.backend == 'onnx' and (args.precision == 'bf16' or args.channels_last):
+        print("错误: onnx 后端只支持 --precision fp32/int8，不支持 --channels-last")
+        return
+    
+    if args.stats or args.profile:
+        os.makedirs(args.output, exist_ok=True)
+    stats_log = os.path.join(args.output, STATS_LOG_NAME)
+    recorder = StageRecorder(stats_log) if args.stats else None
+    start = time.perf_counter()
     try:
-        # 创建并运行交互式批量处理器
-        processor = InteractiveBatchMask(args.input_folder, args.output, args.model)
-        processor.run()
+        # 创建并运行交互式批量处理器（后台线程在创建时启动，一起分析）
+        with profiled(os.path.join(args.output, PROFILE_NAME)) if args.profile else nullcontext():
+            processor = InteractiveBatchMask(args.input_folder, args.output, args.model,
+                                             prefetch_depth=args.prefetch,
+                                             prefetch_memory_mb=args.prefetch_mb,
+                                             cache_dir=args.cache, cache_size_mb=args.cache_mb,
+                                             combine=args.combine, output_format=args.format,
+                                             shard_size=args.shard_size,
+                                             png_compression=args.png_compression,
+                                             sequence=args.sequence, auto_accept=args.auto_accept,
+                                             tracker_options=dict(reuse_diff=args.reuse_diff,
+                                                                  min_iou=args.min_iou,
+                                                                  area_jump=args.area_jump),
+                                             live_preview=args.live_preview,
+                                             preview_interval_ms=args.preview_interval,
+                                             debug=args.debug, journal_path=args.journal,
+                                             precision=args.precision, channels_last=args.channels_last,
+                                             autotune=args.autotune,
+                                             backend=args.backend, onnx_dir=args.onnx_dir)
+            processor.run()
     except ValueError as e:
         print(f"错误: {e}")
     except KeyboardInterrupt:
         print("\n\n用户中断")
+    if recorder is not None:
+        save_report(stats_log, recorder.run_id, time.perf_counter() - start, args.output)
 
 
 if __name__ == "__main__":
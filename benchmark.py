@@ -0,0 +1,432 @@
+"""
+基准测试 - 在合成图片上测量批量和交互流程的速度，结果保存为 JSON 以便与基线比较
+
+测试项:
+  auto         BatchMaskGenerator.process_folder_auto（中心点）
+  boxes        BatchMaskGenerator.process_folder_with_boxes（中心80%框）
+  interactive  交互流程：预编码取图 + 每张图片多次画框解码 + 合并保存
+
+--stub 使用确定性的替身模型（见 stub_model.py），不需要模型权重，
+只测量读取、预处理、调度和写入的开销。
+
+--precision / --channels-last 使用 CPU 加速的编码器（见 cpu_fastpath.py），--backend onnx 使用
+ONNX Runtime 后端（见 sam_backends.py），--compare-fp32 另外在合成图片上测量当前配置与
+ultralytics fp32 原模型的编码/解码速度和 mask IoU。
+
+--startup 在子进程中测量各入口脚本 --help 的耗时（不加载模型的启动开销）和加载模型的耗时；
+交互式工具打开窗口的时间（time-to-first-window）由工具启动时自己打印，见 model_loader.py。
+
+示例:
+  python benchmark.py --stub --sizes 640p 1080p --counts 100
+  python benchmark.py -m mobile_sam.pt --sizes 1080p --counts 100 -o bench_new.json --baseline bench_old.json
+  python benchmark.py -m mobile_sam.pt --precision int8 --channels-last --compare-fp32
+  python benchmark.py -m mobile_sam.pt --backend onnx --compare-fp32
+  python benchmark.py --stub --cases auto --startup
+"""
+
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from sam_backends import BACKENDS, PRECISIONS
+from run_report import percentile
+
+# 分辨率名称 -> (宽, 高)
+RESOLUTIONS = {
+    '640p': (640, 480),
+    '1080p': (1920, 1080),
+    '4k': (3840, 2160),
+}
+CASES = ('auto', 'boxes', 'interactive')
+
+
+def make_dataset(data_dir, resolution, count, seed=0, ext='.jpg'):
+    """
+    生成（或复用已生成的）合成图片文件夹
+
+    每张图片是渐变背景上随机的矩形和椭圆，加少量噪声，内容只取决于 seed 和序号。
+
+    返回:
+        文件夹路径
+    """
+    w, h = RESOLUTIONS[resolution]
+    folder = Path(data_dir) / f"{resolution}_{count}_seed{seed}"
+    done_flag = folder / ".complete"
+    if done_flag.exists():
+        return folder
+
+    folder.mkdir(parents=True, exist_ok=True)
+    print(f"生成合成图片: {folder} ({count} 张 {w}x{h})")
+    gradient = np.linspace(40, 200, w, dtype=np.float32)[None, :, None]
+    for i in range(count):
+        rng = np.random.default_rng(seed * 1_000_003 + i)
+        image = np.ascontiguousarray(np.broadcast_to(gradient * rng.uniform(0.5, 1.0, 3), (h, w, 3)), dtype=np.uint8)
+        for _ in range(rng.integers(3, 8)):
+            color = tuple(int(c) for c in rng.integers(0, 256, 3))
+            cx, cy = int(rng.integers(0, w)), int(rng.integers(0, h))
+            aw, ah = int(rng.integers(w // 20, w // 4)), int(rng.integers(h // 20, h // 4))
+            if rng.random() < 0.5:
+                cv2.rectangle(image, (cx - aw, cy - ah), (cx + aw, cy + ah), color, -1)
+            else:
+                cv2.ellipse(image, (cx, cy), (aw, ah), float(rng.uniform(0, 180)), 0, 360, color, -1)
+        noise = rng.integers(0, 12, (h // 4, w // 4, 1), dtype=np.uint8)
+        image = cv2.add(image, cv2.resize(noise, (w, h), interpolation=cv2.INTER_NEAREST)[..., None]
+                        .repeat(3, axis=2))
+        cv2.imwrite(str(folder / f"{i:05d}{ext}"), image)
+    done_flag.touch()
+    return folder
+
+
+def make_session(model_path, stub, precision="fp32", channels_last=False, backend="ultralytics"):
+    """创建推理会话（真实模型或替身模型）"""
+    if stub:
+        from stub_model import StubSession
+        return StubSession()
+    from sam_backends import load_model
+    from sam_session import SAMSession
+    return SAMSession(load_model(model_path, backend, precision, channels_last))
+
+
+def warm_up(session, folder):
+    """编码并解码一张图片，排除首次调用的初始化开销"""
+    image = cv2.imread(str(_images(folder)[0]))
+    h, w = image.shape[:2]
+    embedding = session.encode(image)
+    session.decode(embedding, bboxes=[[0, 0, w, h]])
+
+
+def bench_batch(case, session, folder, model_path, batch_size, verbose):
+    """测量 process_folder_auto / process_folder_with_boxes，返回 (秒, 成功张数)"""
+    from batch_mask import BatchMaskGenerator
+
+    with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+        generator = BatchMaskGenerator(model_path, batch_size=batch_size, session=session)
+    output = tempfile.mkdtemp(prefix="bench_masks_")
+    try:
+        start = time.perf_counter()
+        # 控制台输出不计入（逐张打印在大文件夹上会主导耗时）
+        with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+            if case == 'auto':
+                generator.process_folder_auto(str(folder), output, use_center_point=True, resume=False)
+            else:
+                generator.process_folder_with_boxes(str(folder), output, box_config="center_80", resume=False)
+        seconds = time.perf_counter() - start
+        success = sum(1 for name in os.listdir(output) if name.endswith('.png'))
+    finally:
+        shutil.rmtree(output, ignore_errors=True)
+    return seconds, success, {}
+
+
+def bench_interactive(session, folder, prompts_per_image, prefetch_depth, think_ms):
+    """
+    测量交互流程（与 InteractiveBatchMask 相同的调用，不打开窗口）
+
+    每张图片: 取出预编码结果 -> 安排后台预编码 -> 画 prompts_per_image 次框并解码
+    -> 合并保存最后一次的mask。think_ms 模拟用户画框的时间（预编码在这段时间内进行）。
+
+    返回:
+        (秒, 成功张数, 额外统计)
+    """
+    from mask_combine import combine_masks, extract_masks
+    from prefetch import ImagePrefetcher
+
+    image_files = _images(folder)
+    prefetcher = ImagePrefetcher(session, image_files, depth=prefetch_depth)
+    output = tempfile.mkdtemp(prefix="bench_masks_")
+    load_times, prompt_times = [], []
+    success = 0
+    try:
+        start = time.perf_counter()
+        for index, image_path in enumerate(image_files):
+            t = time.perf_counter()
+            session.reset_image()
+            embedding = prefetcher.get(index)
+            prefetcher.prefetch(index)
+            load_times.append(time.perf_counter() - t)
+            if embedding is None:
+                continue
+            session.set_embedding(embedding)
+
+            h, w = embedding.orig_shape
+            boxes = []
+            for k in range(prompts_per_image):
+                time.sleep(think_ms / 1000)
+                # 每次多画一个框，模拟逐步标注
+                inset = 0.05 + 0.3 * k / max(1, prompts_per_image)
+                boxes.append([w * inset, h * inset, w * (1 - inset), h * (1 - inset)])
+                t = time.perf_counter()
+                results = session.predict(bboxes=boxes)
+                prompt_times.append(time.perf_counter() - t)
+
+            masks, scores = extract_masks(results[0])
+            if masks is not None:
+                cv2.imwrite(os.path.join(output, image_path.stem + '.png'), combine_masks(masks, scores))
+                success += 1
+        seconds = time.perf_counter() - start
+    finally:
+        prefetcher.close()
+        shutil.rmtree(output, ignore_errors=True)
+
+    extra = {
+        'load_ms_p50': round(_percentile(load_times, 50) * 1000, 2),
+        'load_ms_p95': round(_percentile(load_times, 95) * 1000, 2),
+        'prompt_ms_p50': round(_percentile(prompt_times, 50) * 1000, 2),
+        'prompt_ms_p95': round(_percentile(prompt_times, 95) * 1000, 2),
+        'think_ms': think_ms,
+    }
+    return seconds, success, extra
+
+
+def _images(folder):
+    """合成文件夹中的图片（排序）"""
+    return sorted(p for p in Path(folder).iterdir() if p.suffix.lower() in ('.jpg', '.png'))
+
+
+def _percentile(values, q):
+    return percentile(sorted(values), q)
+
+
+def run_case(case, session, folder, args):
+    """运行一个测试项 args.repeat 次，返回结果字典（取耗时中位数）"""
+    runs = []
+    for _ in range(args.repeat):
+        if case == 'interactive':
+            runs.append(bench_interactive(session, folder, args.prompts, args.prefetch, args.think_ms))
+        else:
+            runs.append(bench_batch(case, session, folder, args.model, args.batch_size, args.verbose))
+    times = [r[0] for r in runs]
+    seconds = statistics.median(times)
+    _, success, extra = min(runs, key=lambda r: abs(r[0] - seconds))
+    count = len(_images(folder))
+    return {
+        'seconds': round(seconds, 4),
+        'runs': [round(t, 4) for t in times],
+        'images': count,
+        'success': success,
+        'images_per_s': round(count / seconds, 3) if seconds > 0 else 0.0,
+        **extra,
+    }
+
+
+STARTUP_SCRIPTS = ('batch_mask.py', 'batch_mask_interactive.py', 'mask_server.py')
+
+
+def measure_startup(model_path, stub, runs=3, backend='ultralytics', precision='fp32'):
+    """
+    在子进程中测量启动耗时，取中位数
+
+    返回:
+        {'help_seconds': {脚本: 秒}, 'model_load_seconds': 秒（--stub 时为 None）}
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+
+    def timed(command):
+        samples = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run(command, cwd=root, capture_output=True, check=True)
+            samples.append(time.perf_counter() - start)
+        return round(statistics.median(samples), 3)
+
+    startup = {'help_seconds': {script: timed([sys.executable, script, '--help']) for script in STARTUP_SCRIPTS},
+               'model_load_seconds': None}
+    if not stub:
+        code = (f"from sam_backends import open_session; "
+                f"open_session({os.path.abspath(model_path)!r}, {backend!r}, {precision!r})")
+        startup['model_load_seconds'] = timed([sys.executable, '-c', code])
+    return startup
+
+
+def environment_info(args):
+    """记录运行环境，便于判断两次结果是否可比"""
+    import torch
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'commit': commit,
+        'model': 'stub' if args.stub else os.path.abspath(args.model),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'opencv': cv2.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'torch_threads': torch.get_num_threads(),
+        'batch_size': args.batch_size,
+        'repeat': args.repeat,
+        'backend': args.backend,
+        'precision': args.precision,
+        'channels_last': args.channels_last,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    与基线比较吞吐，打印对比表
+
+    返回:
+        变慢超过 tolerance 的测试项数量
+    """
+    base = {(r['case'], r['resolution'], r['count']): r for r in baseline['results']}
+    regressions = 0
+    print(f"\n与基线比较 (基线: {baseline['env'].get('commit') or '?'} {baseline['env'].get('time', '')}):")
+    print(f"  {'测试项':<28}{'基线 张/秒':>12}{'当前 张/秒':>12}{'变化':>10}")
+    for r in results:
+        key = (r['case'], r['resolution'], r['count'])
+        name = f"{r['case']} {r['resolution']} x{r['count']}"
+        if key not in base:
+            print(f"  {name:<28}{'-':>12}{r['images_per_s']:>12.2f}{'新增':>10}")
+            continue
+        old = base[key]['images_per_s']
+        change = (r['images_per_s'] - old) / old if old else 0.0
+        mark = ""
+        if change < -tolerance:
+            mark = "  ✗ 变慢"
+            regressions += 1
+        elif change > tolerance:
+            mark = "  ✓ 变快"
+        print(f"  {name:<28}{old:>12.2f}{r['images_per_s']:>12.2f}{change:>+10.1%}{mark}")
+    return regressions
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='SAM mask 流程基准测试',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+测试项 (--cases):
+  auto         process_folder_auto（中心点）
+  boxes        process_folder_with_boxes（中心80%%框）
+  interactive  交互流程（预编码 + 每张图片多次画框解码）
+
+示例:
+  python benchmark.py --stub --sizes 640p 1080p --counts 100
+  python benchmark.py --stub --sizes 4k --counts 10000 --cases auto
+  python benchmark.py -m mobile_sam.pt -o bench_new.json --baseline bench_old.json
+  python benchmark.py -m mobile_sam.pt --precision int8 --channels-last --compare-fp32
+  python benchmark.py -m mobile_sam.pt --backend onnx --compare-fp32
+  python benchmark.py --stub --cases auto --startup
+        """,
+    )
+    parser.add_argument('--stub', action='store_true',
+                        help='使用确定性的替身模型（不需要模型权重，只测量读写和调度开销）')
+    parser.add_argument('-m', '--model', default='mobile_sam.pt',
+                        help='模型文件路径 (默认: mobile_sam.pt)')
+    parser.add_argument('--sizes', nargs='+', choices=list(RESOLUTIONS), default=['640p'],
+                        help='图片分辨率 (默认: 640p)')
+    parser.add_argument('--counts', nargs='+', type=int, default=[100],
+                        help='每个文件夹的图片数，例如 100 10000 (默认: 100)')
+    parser.add_argument('--cases', nargs='+', choices=CASES, default=list(CASES),
+                        help='测试项 (默认: 全部)')
+    parser.add_argument('--data-dir', default='bench_data',
+                        help='合成图片目录，已生成的会复用 (默认: bench_data)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='合成图片的随机种子 (默认: 0)')
+    parser.add_argument('--batch-size', type=int, default=4,
+                        help='批量测试项的编码批大小 (默认: 4)')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='每个测试项重复次数，取耗时中位数 (默认: 1)')
+    parser.add_argument('--prompts', type=int, default=3,
+                        help='interactive 测试项每张图片的画框次数，至少为 1 (默认: 3)')
+    parser.add_argument('--prefetch', type=int, default=1,
+                        help='interactive 测试项的预编码张数 (默认: 1)')
+    parser.add_argument('--think-ms', type=float, default=0.0,
+                        help='interactive 测试项每次画框前等待的时间，模拟用户操作 (默认: 0)')
+    parser.add_argument('-o', '--output', default='bench_results.json',
+                        help='结果 JSON 文件 (默认: bench_results.json)')
+    parser.add_argument('--baseline', default=None,
+                        help='基线结果 JSON，给出时打印对比，有测试项变慢超过 --tolerance 时退出码为1')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='与基线比较时允许的吞吐下降比例 (默认: 0.1)')
+    parser.add_argument('--verbose', action='store_true',
+                        help='显示批量处理的逐张输出')
+    parser.add_argument('--precision', choices=PRECISIONS, default='fp32',
+                        help='图像编码器的精度 fp32 / bf16 / int8 (默认: fp32)')
+    parser.add_argument('--channels-last', action='store_true',
+                        help='图像编码器使用 channels_last 内存布局')
+    parser.add_argument('--backend', choices=BACKENDS, default='ultralytics',
+                        help='推理后端 ultralytics / onnx (默认: ultralytics)')
+    parser.add_argument('--startup', type=int, nargs='?', const=3, default=None, metavar='N',
+                        help='在子进程中测量各入口脚本 --help 和加载模型的耗时，重复 N 次取中位数 (默认 N: 3)')
+    parser.add_argument('--compare-fp32', type=int, nargs='?', const=8, default=None, metavar='N',
+                        help='在第一个合成图片文件夹的前 N 张上比较当前 --backend/--precision/--channels-last 与 '
+                             'ultralytics fp32 原模型的编码/解码速度和 mask IoU (默认 N: 8)')
+    args = parser.parse_args()
+
+    if not args.stub and not os.path.exists(args.model):
+        print(f"错误: 模型文件 {args.model} 不存在（可使用 --stub）")
+        sys.exit(2)
+    if args.prompts < 1:
+        print("错误: --prompts 至少为 1")
+        sys.exit(2)
+    if args.stub and args.compare_fp32:
+        print("错误: --compare-fp32 需要真实模型")
+        sys.exit(2)
+    if args.backend == 'onnx' and (args.precision == 'bf16' or args.channels_last):
+        print("错误: onnx 后端只支持 --precision fp32/int8，不支持 --channels-last")
+        sys.exit(2)
+
+    print(f"正在加载{'替身' if args.stub else ''}模型...")
+    session = make_session(args.model, args.stub, args.precision, args.channels_last, args.backend)
+
+    results = []
+    for resolution in args.sizes:
+        for count in args.counts:
+            folder = make_dataset(args.data_dir, resolution, count, args.seed)
+            warm_up(session, folder)
+            for case in args.cases:
+                result = run_case(case, session, folder, args)
+                result = {'case': case, 'resolution': resolution, 'count': count, **result}
+                results.append(result)
+                print(f"  {case:<12} {resolution:<6} x{count:<6} {result['seconds']:>9.2f}s  "
+                      f"{result['images_per_s']:>8.2f} 张/秒  成功 {result['success']}/{result['images']}")
+
+    report = {'env': environment_info(args), 'results': results}
+    if args.startup:
+        report['startup'] = measure_startup(args.model, args.stub, args.startup, args.backend, args.precision)
+        print("\n启动耗时 (子进程, 中位数):")
+        for script, seconds in report['startup']['help_seconds'].items():
+            print(f"  {script + ' --help':<34} {seconds:>6.2f}s")
+        if report['startup']['model_load_seconds'] is not None:
+            print(f"  {'加载模型 (' + args.backend + ', ' + args.precision + ')':<30} "
+                  f"{report['startup']['model_load_seconds']:>6.2f}s")
+    if args.compare_fp32:
+        from cpu_fastpath import describe
+        from sam_backends import compare_sessions, print_comparison
+        folder = make_dataset(args.data_dir, args.sizes[0], args.counts[0], args.seed)
+        images = [cv2.imread(str(path)) for path in _images(folder)[:args.compare_fp32]]
+        label = f"{args.backend} {describe(args.precision, args.channels_last)}"
+        comparison = compare_sessions(make_session(args.model, False), session, images)
+        report['precision_comparison'] = {'backend': args.backend, 'precision': args.precision,
+                                          'channels_last': args.channels_last, **comparison}
+        print_comparison(comparison, "ultralytics fp32", label)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n结果已保存: {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
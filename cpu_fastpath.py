@@ -0,0 +1,266 @@
+"""
+CPU 推理加速 - 没有GPU时让图像编码器跑得更快
+
+SAM 在 CPU 上的耗时几乎都在图像编码器，解码器（提示编码器 + mask解码器）很小，保持 fp32 不变:
+  - 推理模式: 模型切到 eval，编码和解码都在 torch.inference_mode() 中运行（见 SAMSession）
+  - 精度 (precision):
+      fp32  默认，与 SAM.predict 完全一致
+      bf16  编码器在 bfloat16 autocast 下计算，输出转回 float32（需要 CPU 支持 bf16 指令才会变快）
+      int8  编码器的 Linear 层做动态 int8 量化（权重预先量化，激活运行时量化）
+  - channels_last: 编码器权重和输入使用 NHWC 内存布局，卷积层更快，结果与 fp32 一致
+  - 线程自动调优: 启动时用一张合成输入测量不同 intra-op / inter-op 线程数组合下的编码耗时
+    （inter-op 只能在进程开始并行计算之前设置一次，所以在子进程中测量），选最快的，
+    结果按机器缓存到 ~/.cache/good-segment/threads.json，下次启动直接使用
+
+bf16 / int8 会让mask有细微差异，benchmark.py --compare-fp32 在同一批图片上测量与 fp32 的速度和 mask IoU
+（见 sam_backends.compare_sessions），用于判断精度损失是否可以接受。
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+import torch
+from torch import nn
+
+from sam_backends import PRECISIONS
+
+THREADS_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "good-segment", "threads.json")
+
+
+class FastEncoder(nn.Module):
+    """包装图像编码器: 输入转为 channels_last，按需在 bf16 autocast 下运行，输出转回 float32"""
+
+    def __init__(self, encoder, bf16=False, channels_last=False):
+        super().__init__()
+        self.encoder = encoder
+        self.bf16 = bf16
+        self.channels_last = channels_last
+
+    def set_imgsz(self, imgsz):
+        """转发给原编码器（SAMModel.set_imgsz 会调用）"""
+        if hasattr(self.encoder, "set_imgsz"):
+            self.encoder.set_imgsz(imgsz)
+        self.encoder.img_size = imgsz[0]
+
+    def forward(self, x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        if not self.bf16:
+            return self.encoder(x)
+        with torch.autocast("cpu", dtype=torch.bfloat16):
+            features = self.encoder(x)
+        return features.float()
+
+
+def optimize_model(model, precision="fp32", channels_last=False):
+    """
+    原地替换 SAM 模型的图像编码器为 CPU 优化版本
+
+    参数:
+        model: 已加载的 ultralytics SAM 模型
+        precision: fp32 / bf16 / int8
+        channels_last: 编码器使用 channels_last 内存布局
+
+    返回:
+        model（便于链式调用）
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"不支持的精度: {precision}，可选 {', '.join(PRECISIONS)}")
+    sam = model.model.eval()
+    if precision == "fp32" and not channels_last:
+        return model
+    encoder = sam.image_encoder
+    if isinstance(encoder, FastEncoder):
+        encoder = encoder.encoder  # 重复调用时从原编码器开始
+    if channels_last:
+        encoder = encoder.to(memory_format=torch.channels_last)
+    if precision == "int8":
+        with warnings.catch_warnings():
+            # torch.ao 的动态量化接口已标记为弃用，但仍是不依赖额外包的唯一选择
+            warnings.simplefilter("ignore")
+            encoder = torch.ao.quantization.quantize_dynamic(encoder, {nn.Linear}, dtype=torch.qint8)
+    sam.image_encoder = FastEncoder(encoder, bf16=precision == "bf16", channels_last=channels_last)
+    return model
+
+
+def describe(precision="fp32", channels_last=False, threads=None):
+    """一行配置说明"""
+    parts = [precision] + (["channels_last"] if channels_last else [])
+    if threads is not None:
+        parts.append(f"{threads} 线程")
+    return ", ".join(parts)
+
+
+def _available_cpus():
+    """当前进程可用的CPU核数"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _thread_candidates(cpus):
+    """候选的 intra-op 线程数: 不少于 cpus/8 的2的幂，以及 cpus 本身"""
+    candidates = {cpus}
+    n = 1
+    while n < cpus:
+        if n >= cpus // 8:
+            candidates.add(n)
+        n *= 2
+    return sorted(candidates)
+
+
+def _interop_candidates(cpus):
+    """候选的 inter-op 线程数: eager 模式下只有少数独立算子并行，1 / 2 / 4 就够了"""
+    return sorted({min(n, cpus) for n in (1, 2, 4)})
+
+
+def _time_encoder(encoder, x, runs=2):
+    """编码器在当前线程设置下的平均耗时（秒），先运行一次预热"""
+    with torch.inference_mode():
+        encoder(x)
+        start = time.perf_counter()
+        for _ in range(runs):
+            encoder(x)
+    return (time.perf_counter() - start) / runs
+
+
+def _time_intra(encoder, imgsz, candidates, verbose, inter):
+    """在当前进程中逐个测量 intra-op 候选值，返回 {(intra, inter): 秒}"""
+    x = torch.randn(1, 3, imgsz, imgsz)
+    timings = {}
+    for n in candidates:
+        torch.set_num_threads(n)
+        timings[(n, inter)] = _time_encoder(encoder, x)
+        if verbose:
+            print(f"  intra-op {n:>3} / inter-op {inter}: {timings[(n, inter)] * 1000:.0f} ms/张")
+    return timings
+
+
+def _tuning_worker(encoder_path, imgsz, inter, candidates):
+    """子进程: 先设置 inter-op 线程数，再测量各 intra-op 候选值，结果以 JSON 打印到 stdout"""
+    torch.set_num_interop_threads(inter)
+    encoder = torch.load(encoder_path, weights_only=False)
+    timings = _time_intra(encoder, imgsz, candidates, False, inter)
+    print(json.dumps({str(intra): t for (intra, _), t in timings.items()}))
+
+
+def _time_grid(encoder, imgsz, intra_candidates, inter_candidates, verbose):
+    """
+    测量 intra-op x inter-op 的全部组合
+
+    inter-op 线程数在一个进程中只能在第一次并行计算之前设置一次，所以每个 inter-op 候选值
+    在单独的子进程中测量（编码器用 torch.save 传给子进程）。
+
+    返回:
+        {(intra, inter): 秒}
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    fd, encoder_path = tempfile.mkstemp(suffix=".pt")
+    os.close(fd)
+    try:
+        torch.save(encoder, encoder_path)
+        timings = {}
+        for inter in inter_candidates:
+            code = (f"import cpu_fastpath; "
+                    f"cpu_fastpath._tuning_worker({encoder_path!r}, {imgsz}, {inter}, {list(intra_candidates)!r})")
+            out = subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, text=True, check=True)
+            for intra, seconds in json.loads(out.stdout.strip().splitlines()[-1]).items():
+                timings[(int(intra), inter)] = seconds
+                if verbose:
+                    print(f"  intra-op {int(intra):>3} / inter-op {inter}: {seconds * 1000:.0f} ms/张")
+        return timings
+    finally:
+        os.remove(encoder_path)
+
+
+def _set_interop_threads(inter):
+    """设置 inter-op 线程数，返回实际生效的值（已经开始过并行计算时无法修改，打印提示）"""
+    if torch.get_num_interop_threads() != inter:
+        try:
+            torch.set_num_interop_threads(inter)
+        except RuntimeError:
+            pass
+    actual = torch.get_num_interop_threads()
+    if actual != inter:
+        print(f"  ✗ inter-op 线程数已经固定为 {actual}，无法设为 {inter}（必须在第一次并行计算之前设置）")
+    return actual
+
+
+def autotune_threads(model, imgsz=1024, precision="fp32", channels_last=False, cache_path=THREADS_CACHE,
+                     verbose=True):
+    """
+    为当前机器选择 torch 的 intra-op / inter-op 线程数并立即生效
+
+    测量 intra-op（单个算子内部的并行）和 inter-op（独立算子之间的并行）候选值的每个组合，
+    取最快的；差距在 5% 以内时取线程少的，把剩下的核留给流水线的读取/写入线程。
+    inter-op 线程数只能在第一次并行计算之前设置，因此测量在子进程中进行，当前进程不运行编码器，
+    最后直接设置选中的值。子进程无法运行时只在当前进程中调 intra-op，inter-op 保持不变。
+
+    参数:
+        model: 已经 optimize_model 过的 SAM 模型
+        imgsz: 编码器输入尺寸
+        precision / channels_last: 同 optimize_model，只用于区分缓存的调优结果
+        cache_path: 调优结果缓存文件（None 表示不缓存）
+
+    返回:
+        (intra_op, inter_op)，inter_op 为实际生效的值
+    """
+    cpus = _available_cpus()
+    key = f"{cpus}cpu/torch{torch.__version__}/{describe(precision, channels_last)}/{imgsz}"
+    cached = _load_tuning(cache_path).get(key)
+    if cached is not None:
+        intra, inter = cached
+        source = "缓存"
+    else:
+        intra_candidates = _thread_candidates(cpus)
+        inter_candidates = _interop_candidates(cpus)
+        encoder = model.model.image_encoder
+        if len(intra_candidates) * len(inter_candidates) == 1:
+            timings = {(intra_candidates[0], inter_candidates[0]): 0.0}
+        else:
+            try:
+                timings = _time_grid(encoder, imgsz, intra_candidates, inter_candidates, verbose)
+            except Exception as e:  # 编码器无法序列化、子进程出错等
+                detail = e.stderr.strip().splitlines()[-1] if getattr(e, "stderr", None) else e
+                print(f"  ✗ 无法在子进程中测量 inter-op 线程数 ({detail})，只调 intra-op")
+                timings = _time_intra(encoder, imgsz, intra_candidates, verbose, torch.get_num_interop_threads())
+        fastest = min(timings.values())
+        intra, inter = min(combo for combo, t in timings.items() if t <= fastest * 1.05)
+        _save_tuning(cache_path, key, (intra, inter))
+        source = "测量"
+    inter = _set_interop_threads(inter)
+    torch.set_num_threads(intra)
+    if verbose:
+        print(f"✓ 线程自动调优 ({source}): intra-op {intra}, inter-op {inter}")
+    return intra, inter
+
+
+def _load_tuning(cache_path):
+    if cache_path is None:
+        return {}
+    try:
+        with open(cache_path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_tuning(cache_path, key, value):
+    if cache_path is None:
+        return
+    tuning = _load_tuning(cache_path)
+    tuning[key] = list(value)
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(tuning, f, indent=2)
+        os.replace(tmp, cache_path)
+    except OSError:
+        pass  # 缓存只是加速下次启动
+
@@ -0,0 +1,352 @@
+"""
+显示画布 - 交互工具的低开销重绘，支持大图的缩放和平移
+
+大图（4K 以上）在鼠标拖拽时每次都复制整张原图、重画所有框再 imshow 会明显卡顿。画布:
+  - 每张图片建一次图像金字塔（每层边长减半），只把视口内可见的区域从分辨率刚好够用的
+    那一层渲染成视口大小（不超过 max_size），重绘开销与原图大小无关
+  - 已确认的框、点和候选mask按原图坐标记录，画在视口底层上，只在它们或视口改变时重画
+  - 拖拽中的橡皮筋框只更新它的四条边: 先从底层恢复旧框的边，再画新框，不复制整张图
+  - 鼠标事件只记录状态，由主循环调用 present() 按刷新率（fps）合并成一次 imshow
+
+缩放和平移:
+  - 鼠标滚轮: 以鼠标位置为中心放大/缩小
+  - 按住中键拖拽: 平移
+  - + / - 键: 以视口中心放大/缩小，0 键: 恢复整图显示
+  - I / J / K / L 键: 上 / 左 / 下 / 右平移
+
+鼠标回调收到的是视口坐标，用 to_image() 换算回原图坐标；框、点和mask都使用原图坐标传入。
+"""
+
+import time
+
+import cv2
+import numpy as np
+
+from live_preview import blend_mask, overlay
+
+BAND_THICKNESS = 2
+ZOOM_STEP = 1.25   # 每次滚轮/按键的缩放倍数
+PAN_STEP = 0.2     # 每次按键平移视口宽/高的比例
+
+
+def _edge_slices(rect, pad, shape):
+    """矩形四条边（向外扩 pad 像素）所在的区域，用于局部恢复"""
+    x1, y1, x2, y2 = rect
+    h, w = shape[:2]
+    xs = slice(max(0, x1 - pad), min(w, x2 + pad + 1))
+    ys = slice(max(0, y1 - pad), min(h, y2 + pad + 1))
+    return [(slice(max(0, y - pad), min(h, y + pad + 1)), xs) for y in (y1, y2)] + \
+           [(ys, slice(max(0, x - pad), min(w, x + pad + 1))) for x in (x1, x2)]
+
+
+def build_pyramid(image, min_size):
+    """
+    图像金字塔: 第0层是原图（不复制），之后每层边长减半，直到不超过 min_size
+
+    参数:
+        min_size: (宽, 高)，最粗的一层不小于视口即可
+
+    返回:
+        [(图像, x方向比例, y方向比例), ...]，比例为该层尺寸 / 原图尺寸
+    """
+    h, w = image.shape[:2]
+    levels = [(image, 1.0, 1.0)]
+    current = image
+    while current.shape[1] > 2 * min_size[0] and current.shape[0] > 2 * min_size[1]:
+        ch, cw = current.shape[:2]
+        current = cv2.resize(current, ((cw + 1) // 2, (ch + 1) // 2), interpolation=cv2.INTER_AREA)
+        levels.append((current, current.shape[1] / w, current.shape[0] / h))
+    return levels
+
+
+class DisplayCanvas:
+    def __init__(self, window_name, max_size=(1600, 1200), fps=60, max_zoom=32.0):
+        """
+        参数:
+            window_name: OpenCV 窗口名
+            max_size: 视口大小的上限 (宽, 高)，整图显示时图片按比例缩小到不超过该尺寸
+            fps: present() 的最高刷新率，两次刷新之间的鼠标事件合并为一次 imshow
+            max_zoom: 相对整图显示的最大放大倍数
+        """
+        self.window_name = window_name
+        self.max_size = max_size
+        self.frame_interval = 1.0 / fps if fps > 0 else 0.0
+        self.max_zoom = max_zoom
+        self.fit_scale = 1.0
+        self.zoom = 1.0
+        self.image_size = (0, 0)   # 原图 (宽, 高)
+        self.view_size = (0, 0)    # 视口 (宽, 高)
+        self.frames = 0            # imshow 次数
+        self.updates = 0           # 画面变化次数（被合并的鼠标事件也计入）
+        self._pyramid = []
+        self._origin = (0.0, 0.0)  # 视口左上角对应的原图坐标
+        self._marks = []           # 已确认的标注（原图坐标），视口改变时重画
+        self.base = None           # 底层: 视口内的图像 + 已确认的标注
+        self._composite = None     # 底层 + 实时预览mask
+        self.frame = None          # 显示的画面: 合成层 + 橡皮筋框
+        self._overlay = None
+        self._band = None          # 画在 frame 上的橡皮筋框（视口坐标）
+        self._band_box = None      # 下一次 present() 要画的橡皮筋框（原图坐标）
+        self._band_color = (255, 0, 255)
+        self._pan_anchor = None    # 中键拖拽平移的起点（视口坐标）
+        self._rebuild = False      # 底层或预览mask改变，需要重新合成
+        self._dirty = False
+        self._last_present = 0.0
+
+    def set_image(self, image):
+        """
+        设置新图片（整图显示），清除所有标注和预览
+
+        返回:
+            视口尺寸 (宽, 高)，用于 resizeWindow
+        """
+        h, w = image.shape[:2]
+        max_w, max_h = self.max_size
+        self.fit_scale = min(1.0, max_w / w, max_h / h)
+        self.image_size = (w, h)
+        self.view_size = (max(1, round(w * self.fit_scale)), max(1, round(h * self.fit_scale)))
+        self._pyramid = build_pyramid(image, self.view_size)
+        self.zoom = 1.0
+        self._origin = (0.0, 0.0)
+        self._overlay = None
+        self._band_box = None
+        self._pan_anchor = None
+        self.reset()
+        return self.view_size
+
+    @property
+    def display_size(self):
+        """视口尺寸 (宽, 高)"""
+        return self.view_size
+
+    @property
+    def scale(self):
+        """视口像素 / 原图像素"""
+        return self.fit_scale * self.zoom
+
+    def to_image(self, x, y):
+        """视口坐标 -> 原图坐标（限制在图片范围内）"""
+        w, h = self.image_size
+        ox, oy = self._origin
+        return (min(w - 1, max(0, int(ox + x / self.scale))),
+                min(h - 1, max(0, int(oy + y / self.scale))))
+
+    def to_display(self, x, y):
+        """原图坐标 -> 视口坐标"""
+        ox, oy = self._origin
+        return int(round((x - ox) * self.scale)), int(round((y - oy) * self.scale))
+
+    def reset(self):
+        """清除所有标注"""
+        self._marks = []
+        self._render_base()
+
+    def draw_box(self, box, color, label=None):
+        """画一个已确认的框 [x1, y1, x2, y2]（原图坐标）"""
+        self._add_mark(("box", list(box), color, label))
+
+    def draw_point(self, point, color, label=None):
+        """画一个提示点（原图坐标）"""
+        self._add_mark(("point", tuple(point), color, label))
+
+    def tint(self, mask, color, alpha=0.5):
+        """把原图分辨率的mask区域染色"""
+        self._add_mark(("tint", np.asarray(mask, dtype=np.uint8), color, alpha))
+
+    def set_overlay(self, mask):
+        """设置实时预览mask（覆盖整张图、任意分辨率的 bool 数组，None 表示不显示）"""
+        self._overlay = None if mask is None else np.asarray(mask, dtype=np.uint8)
+        self._mark_rebuild()
+
+    def set_band(self, box=None, color=(255, 0, 255)):
+        """
+        设置拖拽中的橡皮筋框（原图坐标 [x1, y1, x2, y2]，None 表示去掉）
+
+        只记录状态，下一次 present() 时才更新画面。
+        """
+        self._band_box = None if box is None else (min(box[0], box[2]), min(box[1], box[3]),
+                                                   max(box[0], box[2]), max(box[1], box[3]))
+        self._band_color = color
+        self._dirty = True
+        self.updates += 1
+
+    # ---- 缩放和平移 ----
+
+    def zoom_by(self, factor, anchor=None):
+        """
+        缩放视口
+
+        参数:
+            factor: 缩放倍数（>1 放大）
+            anchor: 保持不动的视口坐标 (x, y)，默认视口中心
+        """
+        vw, vh = self.view_size
+        ax, ay = anchor if anchor is not None else (vw / 2, vh / 2)
+        ox, oy = self._origin
+        # 锚点对应的原图坐标在缩放前后保持不变
+        ix, iy = ox + ax / self.scale, oy + ay / self.scale
+        self.zoom = min(self.max_zoom, max(1.0, self.zoom * factor))
+        self._set_origin(ix - ax / self.scale, iy - ay / self.scale)
+
+    def pan(self, dx, dy):
+        """平移视口（视口像素，正值向右/向下移动视野）"""
+        ox, oy = self._origin
+        self._set_origin(ox + dx / self.scale, oy + dy / self.scale)
+
+    def fit(self):
+        """恢复整图显示"""
+        self.zoom = 1.0
+        self._set_origin(0.0, 0.0)
+
+    def handle_key(self, key):
+        """
+        处理缩放/平移按键（key 为 waitKey(...) & 0xFF）
+
+        返回:
+            是否处理了该按键
+        """
+        vw, vh = self.view_size
+        if key in (ord('+'), ord('=')):
+            self.zoom_by(ZOOM_STEP)
+        elif key in (ord('-'), ord('_')):
+            self.zoom_by(1 / ZOOM_STEP)
+        elif key == ord('0'):
+            self.fit()
+        elif key in (ord('i'), ord('I')):
+            self.pan(0, -vh * PAN_STEP)
+        elif key in (ord('k'), ord('K')):
+            self.pan(0, vh * PAN_STEP)
+        elif key in (ord('j'), ord('J')):
+            self.pan(-vw * PAN_STEP, 0)
+        elif key in (ord('l'), ord('L')):
+            self.pan(vw * PAN_STEP, 0)
+        else:
+            return False
+        return True
+
+    def handle_mouse(self, event, x, y, flags):
+        """
+        处理滚轮缩放和中键拖拽平移（在鼠标回调的开头调用）
+
+        返回:
+            是否处理了该事件（处理了的事件不再作为提示使用）
+        """
+        if event == cv2.EVENT_MOUSEWHEEL:
+            # 滚动量在 flags 的高16位（有符号），向前滚动时 flags > 0
+            self.zoom_by(ZOOM_STEP if flags > 0 else 1 / ZOOM_STEP, (x, y))
+            return True
+        if event == cv2.EVENT_MBUTTONDOWN:
+            self._pan_anchor = (x, y)
+            return True
+        if event == cv2.EVENT_MBUTTONUP:
+            self._pan_anchor = None
+            return True
+        if event == cv2.EVENT_MOUSEMOVE and self._pan_anchor is not None:
+            ax, ay = self._pan_anchor
+            self.pan(ax - x, ay - y)
+            self._pan_anchor = (x, y)
+            return True
+        return False
+
+    # ---- 渲染 ----
+
+    def present(self, force=False):
+        """
+        把改变画到窗口上（主循环中每次 waitKey 后调用）
+
+        参数:
+            force: 忽略刷新率限制立即显示
+
+        返回:
+            是否调用了 imshow
+        """
+        if not self._dirty:
+            return False
+        now = time.perf_counter()
+        if not force and now - self._last_present < self.frame_interval:
+            return False  # 合并到下一帧
+        if self._rebuild:
+            self._composite = self.base if self._overlay is None else \
+                overlay(self.base, self._warp(self._overlay, cv2.INTER_NEAREST))
+            self.frame = self._composite.copy()
+            self._rebuild = False
+        elif self._band is not None:
+            # 只恢复旧橡皮筋框的四条边
+            for region in _edge_slices(self._band, BAND_THICKNESS, self.frame.shape):
+                self.frame[region] = self._composite[region]
+        self._band = None
+        if self._band_box is not None:
+            x1, y1, x2, y2 = self._band_box
+            self._band = self.to_display(x1, y1) + self.to_display(x2, y2)
+            cv2.rectangle(self.frame, self._band[:2], self._band[2:], self._band_color, BAND_THICKNESS)
+        cv2.imshow(self.window_name, self.frame)
+        self._dirty = False
+        self._last_present = now
+        self.frames += 1
+        return True
+
+    def _set_origin(self, x, y):
+        """设置视口左上角（限制视口在图片范围内）并重画底层"""
+        w, h = self.image_size
+        vw, vh = self.view_size
+        self._origin = (min(max(0.0, x), max(0.0, w - vw / self.scale)),
+                        min(max(0.0, y), max(0.0, h - vh / self.scale)))
+        self._render_base()
+
+    def _level(self):
+        """分辨率不低于当前显示比例的最粗一层"""
+        for image, fx, fy in reversed(self._pyramid):
+            if fx >= self.scale and fy >= self.scale:
+                return image, fx, fy
+        return self._pyramid[0]
+
+    def _warp(self, src, interpolation):
+        """
+        把覆盖整张图的 src（任意分辨率）中视口内的部分渲染成视口大小
+
+        只计算视口内的像素，开销与 src 的大小无关。
+        """
+        w, h = self.image_size
+        fx, fy = src.shape[1] / w, src.shape[0] / h
+        ox, oy = self._origin
+        sx, sy = self.scale / fx, self.scale / fy
+        # 像素中心对齐: 视口像素 d 的中心对应 src 像素 (d + 0.5) / s - 0.5 + 原点
+        matrix = np.float32([[sx, 0, 0.5 * sx - 0.5 - ox * self.scale],
+                             [0, sy, 0.5 * sy - 0.5 - oy * self.scale]])
+        return cv2.warpAffine(src, matrix, self.view_size, flags=interpolation,
+                              borderMode=cv2.BORDER_REPLICATE)
+
+    def _render_base(self):
+        """从金字塔渲染视口内的图像，再重画所有标注"""
+        image = self._level()[0]
+        interpolation = cv2.INTER_LINEAR if self.scale < 1.0 else cv2.INTER_NEAREST
+        self.base = self._warp(image, interpolation)
+        for mark in self._marks:
+            self._draw_mark(mark)
+        self._mark_rebuild()
+
+    def _add_mark(self, mark):
+        self._marks.append(mark)
+        self._draw_mark(mark)
+        self._mark_rebuild()
+
+    def _draw_mark(self, mark):
+        kind, value, color, extra = mark
+        if kind == "box":
+            p1, p2 = self.to_display(value[0], value[1]), self.to_display(value[2], value[3])
+            cv2.rectangle(self.base, p1, p2, color, 2)
+            if extra:
+                cv2.putText(self.base, extra, (p1[0], p1[1] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
+        elif kind == "point":
+            x, y = self.to_display(*value)
+            cv2.circle(self.base, (x, y), 8, color, -1)
+            cv2.circle(self.base, (x, y), 10, color, 2)
+            if extra:
+                cv2.putText(self.base, extra, (x + 15, y - 15), cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
+        elif kind == "tint":
+            blend_mask(self.base, self._warp(value, cv2.INTER_NEAREST), color, extra)
+
+    def _mark_rebuild(self):
+        self._rebuild = True
+        self._dirty = True
+        self.updates += 1
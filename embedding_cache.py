@@ -0,0 +1,131 @@
+"""
+磁盘 embedding 缓存 - 同一批图片换提示配置重跑时跳过图像编码器
+
+每个 embedding 保存为一个 .npy 文件，读取时以内存映射方式打开。
+缓存键 = 图片内容SHA1 + 模型标识（模型文件内容和输入尺寸），换模型不会读到旧结果。
+总大小超过上限时按最近使用时间（文件 mtime）淘汰最旧的条目。
+"""
+
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+from manifest import file_sha1, input_sha1
+
+
+class EmbeddingCache:
+    def __init__(self, cache_dir, model_path, imgsz=1024, max_size_mb=4096, variant=None):
+        """
+        打开（或创建）缓存目录
+
+        参数:
+            cache_dir: 缓存根目录
+            model_path: 模型文件路径，用于区分不同模型的缓存
+            imgsz: 编码器输入尺寸
+            max_size_mb: 缓存总大小上限 (MB)
+            variant: 会改变编码结果的模型设置（例如 int8 量化，见 sam_backends.model_variant），None 表示原模型
+        """
+        self.model_id = model_identity(model_path, imgsz, variant)
+        self.root = os.path.join(cache_dir, self.model_id)
+        self.max_size = max_size_mb * 1024 * 1024
+        os.makedirs(self.root, exist_ok=True)
+        self._entries = self._scan()  # key -> 文件大小，按最近使用排序
+        self._total = sum(self._entries.values())
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key + ".npy")
+
+    def _scan(self):
+        """扫描缓存目录（包括其他进程写入的条目），按 mtime 从旧到新排序"""
+        found = []
+        for sub in os.scandir(self.root):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith(".npy"):
+                    st = entry.stat()
+                    found.append((st.st_mtime, entry.name[:-4], st.st_size))
+        found.sort()
+        return OrderedDict((key, size) for _, key, size in found)
+
+    def get(self, key):
+        """读取缓存的特征，未命中返回 None"""
+        path = self._path(key)
+        try:
+            # copy-on-write 映射：不占用额外内存，也不会改动缓存文件
+            array = np.load(path, mmap_mode="c")
+            os.utime(path)  # 记录最近使用时间
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        if key in self._entries:
+            self._entries.move_to_end(key)
+        import torch  # 只有加载了模型才会读取缓存，不在模块顶层导入
+        return torch.from_numpy(array)
+
+    def put(self, key, features):
+        """写入特征（先写临时文件再改名，多进程共享缓存目录也安全）"""
+        import torch
+
+        if not isinstance(features, torch.Tensor):
+            return  # 只缓存单个张量形式的特征（SAM / MobileSAM）
+        array = features.detach().cpu().numpy()
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        size = os.path.getsize(path)
+        self._total += size - self._entries.pop(key, 0)
+        self._entries[key] = size
+        if self._total > self.max_size:
+            self._evict()
+
+    def _evict(self):
+        """淘汰最久未使用的条目，直到总大小降到上限的90%"""
+        self._entries = self._scan()
+        self._total = sum(self._entries.values())
+        target = self.max_size * 0.9
+        while self._entries and self._total > target:
+            key, size = self._entries.popitem(last=False)
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass  # 可能已被其他进程删除
+            self._total -= size
+
+    def key_for_file(self, image_path):
+        """根据图片文件内容计算缓存键（视频帧没有文件内容，返回 None 表示不缓存）"""
+        return input_sha1(image_path)
+
+    def contains(self, key):
+        """缓存中是否有该条目（不读取内容）"""
+        return os.path.exists(self._path(key))
+
+    def stats_line(self):
+        """命中统计"""
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0.0
+        return f"embedding缓存: 命中 {self.hits}/{total} ({rate:.0f}%), 占用 {self._total / 1024 / 1024:.0f} MB"
+
+
+def model_identity(model_path, imgsz=1024, variant=None):
+    """模型标识：模型文件内容、输入尺寸（和模型设置）的哈希"""
+    h = hashlib.sha1(file_sha1(model_path).encode())
+    h.update(str(imgsz).encode())
+    if variant is not None:
+        h.update(variant.encode())
+    return h.hexdigest()[:16]
@@ -0,0 +1,124 @@
+"""
+图片读取工具
+
+  - read_image: 解码图片并记录解码耗时
+  - probe_image_size: 只读取文件头获取图片尺寸，不解码像素
+"""
+
+import struct
+import time
+
+import cv2
+
+from image_sources import SourceItem
+
+
+def read_image(image_path):
+    """
+    解码图片（image_path 可以是 image_sources.SourceItem）
+
+    返回:
+        (image, seconds): BGR图像（读取失败为 None）和解码耗时（秒）
+    """
+    start = time.perf_counter()
+    if isinstance(image_path, SourceItem):
+        image = image_path.read()
+    else:
+        image = cv2.imread(str(image_path))
+    return image, time.perf_counter() - start
+
+
+def probe_image_size(image_path):
+    """
+    只读取文件头获取图片尺寸
+
+    支持 PNG、JPEG、BMP、WebP、TIFF；无法识别的格式退回到完整解码。
+
+    返回:
+        (w, h)，无法读取时返回 None
+    """
+    try:
+        with open(image_path, 'rb') as f:
+            size = _probe_header(f)
+    except (OSError, struct.error, ValueError):
+        size = None
+
+    if size is None:
+        image = cv2.imread(str(image_path))
+        if image is None:
+            return None
+        size = (image.shape[1], image.shape[0])
+    return size
+
+
+def _probe_header(f):
+    """根据文件头解析尺寸，无法识别时返回 None"""
+    head = f.read(32)
+
+    # PNG: 签名后紧跟 IHDR 块
+    if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+        w, h = struct.unpack('>II', head[16:24])
+        return w, h
+
+    # BMP: BITMAPINFOHEADER 中的宽高（高度为负表示自上而下存储）
+    if head[:2] == b'BM':
+        w, h = struct.unpack('<ii', head[18:26])
+        return w, abs(h)
+
+    # WebP: VP8 / VP8L / VP8X 三种子格式
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        chunk = head[12:16]
+        if chunk == b'VP8 ':
+            w, h = struct.unpack('<HH', head[26:30])
+            return w & 0x3FFF, h & 0x3FFF
+        if chunk == b'VP8L':
+            b = head[21:25]
+            w = 1 + (((b[1] & 0x3F) << 8) | b[0])
+            h = 1 + (((b[3] & 0xF) << 10) | (b[2] << 2) | ((b[1] & 0xC0) >> 6))
+            return w, h
+        if chunk == b'VP8X':
+            w = 1 + int.from_bytes(head[24:27], 'little')
+            h = 1 + int.from_bytes(head[27:30], 'little')
+            return w, h
+        return None
+
+    # JPEG: 扫描到第一个 SOF 段
+    if head[:2] == b'\xff\xd8':
+        f.seek(2)
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                return None
+            code = marker[1]
+            if code == 0xFF:  # 填充字节
+                f.seek(-1, 1)
+                continue
+            if code in (0xD8, 0x01) or 0xD0 <= code <= 0xD7:  # 无长度字段的标记
+                continue
+            length = struct.unpack('>H', f.read(2))[0]
+            if code in (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF):
+                h, w = struct.unpack('>HH', f.read(5)[1:5])
+                return w, h
+            f.seek(length - 2, 1)
+
+    # TIFF: 读取第一个 IFD 中的 ImageWidth / ImageLength 标签
+    if head[:4] in (b'II*\x00', b'MM\x00*'):
+        endian = '<' if head[:2] == b'II' else '>'
+        ifd_offset = struct.unpack(endian + 'I', head[4:8])[0]
+        f.seek(ifd_offset)
+        count = struct.unpack(endian + 'H', f.read(2))[0]
+        w = h = None
+        for _ in range(count):
+            tag, typ, _, value = struct.unpack(endian + 'HHI4s', f.read(12))
+            if tag in (256, 257):
+                fmt = 'H' if typ == 3 else 'I'
+                v = struct.unpack(endian + fmt, value[:struct.calcsize(fmt)])[0]
+                if tag == 256:
+                    w = v
+                else:
+                    h = v
+            if w is not None and h is not None:
+                return w, h
+        return None
+
+    return None
@@ -0,0 +1,278 @@
+"""
+输入源 - 从文件夹、列表文件、tar 包、视频或标准输入逐个产生待处理的图片
+
+  folder  文件夹中的图片（一次 os.scandir，按文件名排序）；recursive=True 时递归子文件夹
+  list    列表文件，每行一个图片路径（空行和 # 开头的行忽略，相对路径相对于列表文件所在目录）
+  stdin   "-"：从标准输入逐行读取图片路径，例如 find ... | python batch_mask.py -
+  tar     tar 包（可以是 .tar.gz 等压缩包），顺序读取成员，不解压到磁盘
+  video   视频文件，逐帧解码
+
+除了不递归的文件夹（返回排好序的 Path 列表）之外，其他输入源都是生成器：边枚举边处理，
+不需要先列出全部图片。
+
+输入项是普通的 Path，或者 SourceItem（子文件夹中的文件、tar 成员、视频帧）。
+SourceItem.stem 决定mask名，可以包含子目录，例如 "sub/001"、"clip_000012"。
+"""
+
+import os
+import sys
+import tarfile
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp')
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.webm', '.m4v')
+LIST_EXTENSIONS = ('.txt', '.lst', '.list')
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+
+
+class SourceItem:
+    """不是普通文件路径的输入项"""
+
+    __slots__ = ("name", "stem", "key", "path", "data", "frame", "size", "mtime_ns")
+
+    def __init__(self, name, stem, key, path=None, data=None, frame=None, size=None, mtime_ns=None):
+        """
+        参数:
+            name: 显示名
+            stem: mask名（不带扩展名，可以包含 "/" 分隔的子目录）
+            key: 唯一标识，用于完成清单和阶段统计
+            path: 磁盘上的图片文件（子文件夹中的文件）
+            data: 编码后的图片字节（tar 成员）
+            frame: 已解码的 BGR 图像（视频帧）
+            size / mtime_ns: 判断输入是否改变用，默认取 path 的文件属性
+        """
+        self.name = name
+        self.stem = stem
+        self.key = key
+        self.path = path
+        self.data = data
+        self.frame = frame
+        self.size = size
+        self.mtime_ns = mtime_ns
+
+    def read(self):
+        """解码图片，失败返回 None"""
+        if self.frame is not None:
+            return self.frame
+        if self.data is not None:
+            return cv2.imdecode(np.frombuffer(self.data, np.uint8), cv2.IMREAD_COLOR)
+        return cv2.imread(str(self.path))
+
+    def __str__(self):
+        return self.key
+
+    def __repr__(self):
+        return f"SourceItem({self.key!r})"
+
+
+def input_key(item):
+    """输入项的唯一标识（普通文件为绝对路径）"""
+    if isinstance(item, SourceItem):
+        return item.key
+    return os.path.abspath(item)
+
+
+def input_file(item):
+    """输入项对应的磁盘文件，tar 成员和视频帧返回 None"""
+    if isinstance(item, SourceItem):
+        return item.path
+    return item
+
+
+def input_stat(item):
+    """
+    输入项的 (大小, 修改时间ns)
+
+    tar 成员为成员的大小和修改时间，视频帧为视频文件的大小和修改时间。
+    """
+    if isinstance(item, SourceItem) and item.path is None:
+        return item.size, item.mtime_ns
+    st = os.stat(input_file(item))
+    return st.st_size, st.st_mtime_ns
+
+
+def is_image_file(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def list_images(folder):
+    """文件夹中的所有图片（不递归，按文件名排序）"""
+    with os.scandir(folder) as entries:
+        names = [e.name for e in entries if is_image_file(e.name) and e.is_file()]
+    return [Path(folder) / name for name in sorted(names)]
+
+
+def iter_tree(folder):
+    """
+    递归遍历文件夹，逐个产生图片
+
+    每个文件夹只扫描一次，先产生其中的图片（按文件名排序），再依次进入子文件夹。
+    mask名保留相对子目录，不同子文件夹中的同名图片不会互相覆盖。
+    """
+    root = os.path.abspath(folder)
+    stack = [root]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError as e:
+            print(f"  ✗ 无法读取文件夹 {current}: {e}")
+            continue
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif is_image_file(entry.name) and entry.is_file():
+                rel = os.path.relpath(entry.path, root).replace(os.sep, "/")
+                yield SourceItem(rel, os.path.splitext(rel)[0], entry.path, path=Path(entry.path))
+        stack.extend(reversed(subdirs))
+
+
+def iter_path_list(lines, base_dir="."):
+    """
+    逐行读取图片路径
+
+    参数:
+        lines: 可迭代的文本行（打开的列表文件或 sys.stdin）
+        base_dir: 相对路径的起点
+    """
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        path = Path(line)
+        yield path if path.is_absolute() else Path(base_dir) / path
+
+
+def iter_list_file(list_path):
+    """读取列表文件中的图片路径"""
+    with open(list_path, encoding="utf-8") as f:
+        yield from iter_path_list(f, os.path.dirname(os.path.abspath(list_path)))
+
+
+def iter_tar(tar_path):
+    """
+    顺序读取 tar 包中的图片（流式模式，不随机访问，也不解压到磁盘）
+
+    mask名为成员路径去掉扩展名。
+    """
+    archive = os.path.abspath(tar_path)
+    with tarfile.open(tar_path, mode="r|*") as tar:
+        for member in tar:
+            # 只读普通文件: isfile() 不包括符号链接和硬链接
+            if not member.isfile() or not is_image_file(member.name):
+                continue
+            name = _safe_member_name(member.name)
+            if name is None:
+                print(f"  ✗ 跳过路径不安全的 tar 成员: {member.name}")
+                continue
+            # 流式模式下必须在读取下一个成员之前取出内容
+            data = tar.extractfile(member).read()
+            stem = os.path.splitext(name)[0]
+            yield SourceItem(member.name, stem, f"{archive}::{member.name}", data=data,
+                             size=member.size, mtime_ns=int(member.mtime * 1e9))
+
+
+def _safe_member_name(name):
+    """
+    tar 成员名对应的相对路径（"/" 分隔），绝对路径、带盘符或包含 ".." 时返回 None
+
+    mask名由成员名决定，写出时与输出目录拼接，不检查的话恶意的 tar 包可以写到输出目录之外
+    （与 tarfile.data_filter 拒绝的路径相同）。
+    """
+    name = name.replace("\\", "/")
+    if name.startswith("/") or (len(name) >= 2 and name[1] == ":"):
+        return None
+    parts = [p for p in name.split("/") if p not in ("", ".")]
+    if not parts or ".." in parts:
+        return None
+    return "/".join(parts)
+
+
+def iter_video(video_path, frame_step=1):
+    """
+    逐帧解码视频
+
+    参数:
+        video_path: 视频文件路径
+        frame_step: 每隔几帧取一帧（1 为每帧都处理）
+
+    mask名为 <视频名>_<帧号>，帧号从0开始，6位补零。
+    """
+    path = Path(video_path)
+    st = os.stat(path)
+    capture = cv2.VideoCapture(str(path))
+    if not capture.isOpened():
+        raise ValueError(f"无法打开视频: {video_path}")
+    frame_step = max(1, frame_step)
+    try:
+        index = 0
+        while True:
+            if index % frame_step == 0:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                yield SourceItem(f"{path.name}#{index}", f"{path.stem}_{index:06d}",
+                                 f"{path.resolve()}#{index}", frame=frame,
+                                 size=st.st_size, mtime_ns=st.st_mtime_ns)
+            elif not capture.grab():  # 跳过的帧不解码
+                break
+            index += 1
+    finally:
+        capture.release()
+
+
+def source_kind(spec):
+    """
+    判断输入的类型
+
+    返回:
+        "stdin" / "folder" / "tar" / "video" / "list" / "image"，无法识别时返回 None
+    """
+    if spec == "-":
+        return "stdin"
+    if os.path.isdir(spec):
+        return "folder"
+    name = spec.lower()
+    if name.endswith(TAR_SUFFIXES):
+        return "tar"
+    if name.endswith(VIDEO_EXTENSIONS):
+        return "video"
+    if name.endswith(LIST_EXTENSIONS):
+        return "list"
+    if is_image_file(name):
+        return "image"
+    return None
+
+
+def open_source(spec, recursive=False, frame_step=1):
+    """
+    打开输入源
+
+    参数:
+        spec: 文件夹 / 列表文件 / tar 包 / 视频文件 / 单张图片 / "-"（标准输入）
+        recursive: 文件夹是否递归子文件夹
+        frame_step: 视频每隔几帧取一帧
+
+    返回:
+        不递归的文件夹和单张图片返回列表，其他返回生成器
+    """
+    kind = source_kind(spec)
+    if kind == "stdin":
+        return iter_path_list(sys.stdin)
+    if kind == "folder":
+        return iter_tree(spec) if recursive else list_images(spec)
+    if kind == "tar":
+        return iter_tar(spec)
+    if kind == "video":
+        return iter_video(spec, frame_step)
+    if kind == "list":
+        return iter_list_file(spec)
+    if kind == "image":
+        return [Path(spec)]
+    raise ValueError(f"无法识别的输入: {spec}（支持文件夹、列表文件 {'/'.join(LIST_EXTENSIONS)}、"
+                     f"tar 包、视频 {'/'.join(VIDEO_EXTENSIONS)}、图片或 -）")
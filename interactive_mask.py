@@ -1,14 +1,26 @@
+import os
+import time
+from contextlib import nullcontext
+
 import cv2
-import numpy as np
-from ultralytics import SAM
+from mask_combine import combine_masks, extract_masks, mask_preview
+from live_preview import LivePreview
+from display_canvas import DisplayCanvas
+from prompt_journal import JOURNAL_NAME, PromptJournal
+from model_loader import BackgroundLoader, StartupTimer, open_and_encode
+from run_report import PROFILE_NAME, STATS_LOG_NAME, StageRecorder, profiled, save_report
 
 # 全局变量
 points = []
 labels = []
 boxes = []  # 存储框
 image = None
-display_image = None
 window_name = "SAM Mask Generator"
+canvas = DisplayCanvas(window_name)  # 显示分辨率的画布，主循环按刷新率重画
+debug = False  # 打印按键等调试信息
+combine_mode = "union"  # 多个框的mask合并方式: union / label / best
+output_dir = "mask_output"  # 二值mask、提示日志和阶段统计的输出目录
+recorder = None  # 阶段耗时记录（run_report.StageRecorder），main 中 stats = True 时创建
 
 # 框绘制相关
 drawing_box = False
@@ -16,9 +28,30 @@ box_start = None
 box_end = None
 current_mode = "box"  # "point" 或 "box"
 
+# 实时预览（拖拽框/悬停点时只运行解码器的低分辨率mask），模型就绪后创建
+preview = None
+pending_generate = False  # 模型加载期间按了空格，就绪后自动生成
+
+def request_preview(extra_point=None, extra_box=None):
+    """提交当前提示（加上正在悬停的点或正在拖拽的框）的预览请求"""
+    if preview is None:
+        return
+    pts, lbs = list(points), list(labels)
+    if extra_point is not None:
+        pts.append(extra_point)
+        lbs.append(1)
+    bxs = list(boxes) + ([extra_box] if extra_box is not None else [])
+    if not pts and not bxs:
+        return
+    preview.request(points=pts or None, labels=lbs or None, bboxes=bxs or None)
+
 def mouse_callback(event, x, y, flags, param):
-    """鼠标回调函数"""
-    global points, labels, boxes, display_image, drawing_box, box_start, box_end, current_mode
+    """鼠标回调函数（只更新状态，画面由主循环中的 canvas.present() 刷新）"""
+    global points, labels, boxes, drawing_box, box_start, box_end, current_mode
+    
+    if canvas.handle_mouse(event, x, y, flags):
+        return  # 滚轮缩放、中键平移
+    x, y = canvas.to_image(x, y)  # 视口坐标 -> 原图坐标
     
     if current_mode == "point":
         # 点模式
@@ -26,23 +59,20 @@ def mouse_callback(event, x, y, flags, param):
             points.append([x, y])
             labels.append(1)
             # 画绿色圆圈表示前景点
-            cv2.circle(display_image, (x, y), 8, (0, 255, 0), -1)
-            cv2.circle(display_image, (x, y), 10, (0, 255, 0), 2)
-            cv2.putText(display_image, f"F{len(points)}", (x+15, y-15), 
-                       cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 0), 2)
-            cv2.imshow(window_name, display_image)
+            canvas.draw_point((x, y), (0, 255, 0), f"F{len(points)}")
+            request_preview()
             print(f"[前景点 {len(points)}] 坐标: ({x}, {y})")
             
         elif event == cv2.EVENT_RBUTTONDOWN:  # 右键点击 - 背景点
             points.append([x, y])
             labels.append(0)
             # 画红色圆圈表示背景点
-            cv2.circle(display_image, (x, y), 8, (0, 0, 255), -1)
-            cv2.circle(display_image, (x, y), 10, (0, 0, 255), 2)
-            cv2.putText(display_image, f"B{len(points)}", (x+15, y-15), 
-                       cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
-            cv2.imshow(window_name, display_image)
+            canvas.draw_point((x, y), (0, 0, 255), f"B{len(points)}")
+            request_preview()
             print(f"[背景点 {len(points)}] 坐标: ({x}, {y})")
+
+        elif event == cv2.EVENT_MOUSEMOVE:  # 悬停 - 预览在此处加一个前景点的结果
+            request_preview(extra_point=[x, y])
     
     elif current_mode == "box":
         # 框模式
@@ -55,17 +85,20 @@ def mouse_callback(event, x, y, flags, param):
             
         elif event == cv2.EVENT_MOUSEMOVE:
             if drawing_box:
-                # 实时更新框的显示
+                # 只更新橡皮筋框，不复制整张图
                 box_end = (x, y)
-                temp_img = display_image.copy()
-                cv2.rectangle(temp_img, box_start, box_end, (255, 0, 255), 2)
-                cv2.imshow(window_name, temp_img)
+                canvas.set_band(box_start + box_end)
+                x1, x2 = sorted((box_start[0], x))
+                y1, y2 = sorted((box_start[1], y))
+                if x2 - x1 > 5 and y2 - y1 > 5:
+                    request_preview(extra_box=[x1, y1, x2, y2])
                 
         elif event == cv2.EVENT_LBUTTONUP:
             if drawing_box:
                 # 完成框的绘制
                 drawing_box = False
                 box_end = (x, y)
+                canvas.set_band(None)
                 
                 # 计算框的坐标 [x1, y1, x2, y2]
                 x1 = min(box_start[0], box_end[0])
@@ -75,24 +108,25 @@ def mouse_callback(event, x, y, flags, param):
                 
                 if x2 - x1 > 5 and y2 - y1 > 5:  # 确保框有一定大小
                     boxes.append([x1, y1, x2, y2])
-                    # 在display_image上绘制最终的框
-                    cv2.rectangle(display_image, (x1, y1), (x2, y2), (255, 0, 255), 2)
-                    cv2.putText(display_image, f"Box{len(boxes)}", (x1, y1-10), 
-                               cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 0, 255), 2)
-                    cv2.imshow(window_name, display_image)
+                    # 在画布底层绘制最终的框
+                    canvas.draw_box([x1, y1, x2, y2], (255, 0, 255), f"Box{len(boxes)}")
+                    request_preview()
                     print(f"[框 {len(boxes)}] 坐标: ({x1}, {y1}) -> ({x2}, {y2})")
                 else:
                     print("框太小，已忽略")
 
 def reset_all():
     """重置所有点和框"""
-    global points, labels, boxes, display_image, image, drawing_box
+    global points, labels, boxes, drawing_box
     points = []
     labels = []
     boxes = []
     drawing_box = False
-    display_image = image.copy()
-    cv2.imshow(window_name, display_image)
+    if preview is not None:
+        preview.clear()
+    canvas.set_overlay(None)
+    canvas.set_band(None)
+    canvas.reset()
     print("已重置所有点和框")
 
 def switch_mode():
@@ -107,9 +141,9 @@ def switch_mode():
         print("\n>>> 切换到 [点模式] <<<")
         print("  左键:前景点, 右键:背景点")
 
-def generate_mask(model, image_path):
-    """生成mask"""
-    global points, labels, boxes
+def generate_mask(session, image_path):
+    """生成mask（只运行解码器，图像embedding已缓存在session中；模型还在加载时排队）"""
+    global points, labels, boxes, pending_generate
     
     # 检查是否有输入
     has_points = len(points) > 0
@@ -119,6 +153,13 @@ def generate_mask(model, image_path):
         print("错误: 请至少添加一个点或一个框！")
         return
     
+    if session is None:
+        pending_generate = True
+        print("模型加载中，加载完成后自动生成 mask...")
+        return
+    
+    from sam_session import save_result_plot
+    
     print(f"\n{'='*50}")
     print("正在生成 Mask...")
     print(f"{'='*50}")
@@ -141,14 +182,15 @@ def generate_mask(model, image_path):
             print(f"  框{i+1}: ({box[0]}, {box[1]}) -> ({box[2]}, {box[3]})")
     
     try:
-        # 调用SAM模型
-        results = model.predict(image_path, **kwargs, save=True)
-        
-        print(f"\n✓ Mask已生成并保存到: runs/segment/predict/")
+        # 使用缓存的embedding生成mask
+        with timed(image_path, "decode"):
+            results = session.predict(**kwargs)
         
         # 处理结果
         if results and len(results) > 0:
             result = results[0]
+            save_path = save_result_plot(result, image_path)
+            print(f"\n✓ Mask已生成并保存到: {save_path}")
             
             # 显示彩色结果
             result_img = result.plot()
@@ -168,27 +210,34 @@ def generate_mask(model, image_path):
             print("✓ 结果已显示在新窗口")
             
             # 提取mask并保存为纯黑白图像
-            if result.masks is not None and len(result.masks) > 0:
-                # 获取第一个mask（如果有多个，取置信度最高的）
-                mask_data = result.masks.data[0].cpu().numpy()
-                
-                # 转换为二值图像 (0 或 255)
-                binary_mask = (mask_data * 255).astype(np.uint8)
+            masks, scores = extract_masks(result)
+            if masks is not None:
+                # 多个框时每个框一个mask，按 combine_mode 合成一张
+                with timed(image_path, "combine"):
+                    binary_mask = combine_masks(masks, scores, combine_mode)
                 
                 # 保存黑白mask图像
-                import os
                 # 获取原始图像文件名
                 base_name = os.path.splitext(os.path.basename(image_path))[0]
                 
                 # 创建输出目录
-                output_dir = "mask_output"
                 os.makedirs(output_dir, exist_ok=True)
                 
                 # 保存路径
                 mask_save_path = os.path.join(output_dir, f"{base_name}.png")
-                cv2.imwrite(mask_save_path, binary_mask)
+                with timed(image_path, "write"):
+                    saved = cv2.imwrite(mask_save_path, binary_mask)
+                finish_record(image_path, saved, mask_save_path if saved else "无法写入")
+                
+                # 记录提示（原图坐标），之后可用 batch_mask.py --replay 重新生成
+                journal = PromptJournal(os.path.join(output_dir, JOURNAL_NAME))
+                journal.record(image_path, (image.shape[1], image.shape[0]), boxes, points, labels, saved=saved)
                 
-                print(f"✓ 二值mask已保存: {mask_save_path}")
+                if saved:
+                    print(f"✓ 二值mask已保存: {mask_save_path}")
+                else:
+                    print(f"✗ 无法写入 {mask_save_path}")
+                print(f"✓ 提示已记录: {journal.path}")
                 print(f"  - 物体部分：白色 (255)")
                 print(f"  - 背景部分：黑色 (0)")
                 
@@ -204,21 +253,54 @@ def generate_mask(model, image_path):
                 else:
                     cv2.resizeWindow(mask_window, w_m, h_m)
                 
-                cv2.imshow(mask_window, binary_mask)
+                cv2.imshow(mask_window, mask_preview(binary_mask))
+            else:
+                finish_record(image_path, False, "未检测到mask")
             
             print(f"{'='*50}\n")
+        else:
+            finish_record(image_path, False, "未检测到mask")
             
     except Exception as e:
+        finish_record(image_path, False, str(e))
         print(f"生成mask时出错: {e}")
         import traceback
         traceback.print_exc()
 
+def timed(image_path, stage):
+    """一个阶段的计时上下文（未开启 stats 时不计时）"""
+    return recorder.time(image_path, stage) if recorder is not None else nullcontext()
+
+def finish_record(image_path, ok, message):
+    """一次生成结束，追加一行阶段耗时（第一次生成的记录中还有 read / encode）"""
+    if recorder is not None:
+        recorder.finish(image_path, ok, message)
+
+def toggle_preview():
+    """开关实时预览"""
+    if preview is None:
+        print("实时预览: 模型加载中，就绪后可用")
+        return
+    enabled = preview.toggle()
+    canvas.set_overlay(None)
+    print(f"实时预览: {'开' if enabled else '关'}")
+
 def main():
-    global image, display_image
+    global image, preview, pending_generate, recorder
+    timer = StartupTimer()  # 启动各阶段的时间（打开窗口、模型就绪）
     
     # 配置
     image_path = r"images/ggbond/000001.png"
     model_path = "mobile_sam.pt"
+    cache_dir = None  # 磁盘embedding缓存目录，例如 ".sam_cache"（None 表示不使用）
+    live_preview = True  # 拖拽框/悬停点时实时预览低分辨率mask（按 P 开关）
+    preview_interval_ms = 50  # 预览解码的最短间隔（毫秒）
+    precision = "fp32"  # 图像编码器的精度 fp32 / bf16 / int8（见 cpu_fastpath）
+    channels_last = False  # 图像编码器使用 channels_last 内存布局
+    autotune = False  # 启动时自动选择 torch 线程数（只用于 ultralytics 后端）
+    backend = "ultralytics"  # 推理后端 ultralytics / onnx（见 sam_backends）
+    stats = False  # 记录每个阶段的耗时到 output_dir/stats.jsonl，退出时打印统计
+    profile = False  # 用 cProfile 分析整个运行过程，结果保存到 output_dir/profile.prof
     
     print("\n" + "="*60)
     print("交互式 SAM Mask 生成器")
@@ -233,70 +315,107 @@ def main():
     print("    空格键 - 生成 mask")
     print("    M 键   - 切换 点/框 模式")
     print("    R 键   - 重置所有点和框")
+    print("    P 键   - 开关实时预览 (拖拽框/悬停点时显示低分辨率mask)")
+    print("    滚轮 / +- 键 - 缩放, 0 键 - 整图显示")
+    print("    中键拖拽 / IJKL 键 - 平移")
     print("    Q 键   - 退出程序")
     print("\n提示: 可以同时使用点和框！")
     print("="*60 + "\n")
     
+    start = time.perf_counter()
+    if stats or profile:
+        os.makedirs(output_dir, exist_ok=True)
+    if stats:
+        recorder = StageRecorder(os.path.join(output_dir, STATS_LOG_NAME))
+    
     # 加载图像
     print(f"正在加载图像: {image_path}")
-    image = cv2.imread(image_path)
+    with timed(image_path, "read"):
+        image = cv2.imread(image_path)
     if image is None:
         print(f"错误: 无法加载图像 {image_path}")
         return
     
-    display_image = image.copy()
     print(f"✓ 图像已加载 (尺寸: {image.shape[1]} x {image.shape[0]})")
     
-    # 加载模型
-    print(f"正在加载模型: {model_path}")
-    model = SAM(model_path)
-    print(f"✓ 模型已加载")
-    print(f"\n当前模式: [框模式] (按 M 切换)\n")
-    
-    # 创建窗口
-    cv2.namedWindow(window_name, cv2.WINDOW_NORMAL)
+    with profiled(os.path.join(output_dir, PROFILE_NAME)) if profile else nullcontext():
+        # 在后台加载模型并编码图像（只编码一次，之后修改提示只运行解码器），窗口先打开
+        print(f"正在后台加载模型: {model_path}")
+        loader = BackgroundLoader(open_and_encode, image_path, image, model_path=model_path, backend=backend,
+                                  precision=precision, channels_last=channels_last, autotune=autotune,
+                                  cache_dir=cache_dir, recorder=recorder)
+        session = None
+        print(f"\n当前模式: [框模式] (按 M 切换)\n")
     
-    # 根据图片大小自动调整窗口大小（保持等比例）
-    h, w = image.shape[:2]
-    max_w, max_h = 1600, 1200  # 最大窗口尺寸
+        # 创建窗口
+        cv2.namedWindow(window_name, cv2.WINDOW_NORMAL)
     
-    # 计算缩放比例
-    if w > max_w or h > max_h:
-        scale = min(max_w / w, max_h / h)
-        window_w, window_h = int(w * scale), int(h * scale)
-    else:
-        window_w, window_h = w, h
+        # 画布按比例缩小到不超过 1600x1200，窗口与画布一样大
+        h, w = image.shape[:2]
+        window_w, window_h = canvas.set_image(image)
     
-    # 设置窗口大小
-    cv2.resizeWindow(window_name, window_w, window_h)
-    print(f"图片尺寸: {w} x {h}")
-    print(f"窗口尺寸: {window_w} x {window_h}")
+        # 设置窗口大小
+        cv2.resizeWindow(window_name, window_w, window_h)
+        print(f"图片尺寸: {w} x {h}")
+        print(f"窗口尺寸: {window_w} x {window_h}")
     
-    cv2.imshow(window_name, display_image)
-    cv2.setMouseCallback(window_name, mouse_callback)
+        canvas.present(force=True)
+        cv2.setMouseCallback(window_name, mouse_callback)
     
-    print("窗口已打开，请开始选择...\n")
+        print(f"窗口已打开 (启动后 {timer.mark('first_window'):.2f}s)，请开始选择...")
+        print("模型在后台加载，可以先添加点和框\n")
     
-    # 主循环
-    while True:
-        key = cv2.waitKey(1) & 0xFF
+        # 主循环
+        while True:
+            key = cv2.waitKey(1) & 0xFF
         
-        # 调试：显示按键
-        if key != 255:  # 255表示没有按键
-            print(f"检测到按键: {key} (对应字符: {chr(key) if 32 <= key <= 126 else '特殊键'})")
+            if session is None and loader.ready:
+                try:
+                    session, embedding = loader.result()
+                except Exception as e:
+                    print(f"✗ 模型加载失败: {e}")
+                    break
+                session.set_embedding(embedding)
+                print(f"✓ 模型已加载，图像已编码 (后台 {loader.seconds:.1f}s, 启动后 {timer.mark('model_ready'):.1f}s 就绪)")
+                preview = LivePreview(session, interval_ms=preview_interval_ms, enabled=live_preview)
+                request_preview()  # 应用加载期间添加的点和框
+                if pending_generate:
+                    pending_generate = False
+                    generate_mask(session, image_path)
         
-        if key == ord('q') or key == ord('Q'):
-            print("\n退出程序")
-            break
-        elif key == ord('r') or key == ord('R'):
-            reset_all()
-        elif key == ord('m') or key == ord('M'):
-            switch_mode()
-        elif key == 32 or key == ord(' '):  # 空格键 (ASCII 32)
-            print(f"\n检测到空格键！当前有 {len(points)} 个点, {len(boxes)} 个框")
-            generate_mask(model, image_path)
+            # 后台线程产生了新的预览mask时重画（GUI 只在主线程中更新）
+            if preview is not None and preview.poll():
+                canvas.set_overlay(preview.mask)
+            canvas.present()  # 两次刷新之间的鼠标事件合并为一次重画
+        
+            # 调试：显示按键
+            if debug and key != 255:  # 255表示没有按键
+                print(f"检测到按键: {key} (对应字符: {chr(key) if 32 <= key <= 126 else '特殊键'})")
+        
+            if canvas.handle_key(key):  # 缩放 / 平移
+                pass
+            elif key == ord('q') or key == ord('Q'):
+                print("\n退出程序")
+                break
+            elif key == ord('r') or key == ord('R'):
+                reset_all()
+            elif key == ord('m') or key == ord('M'):
+                switch_mode()
+            elif key == ord('p') or key == ord('P'):
+                toggle_preview()
+            elif key == 32 or key == ord(' '):  # 空格键 (ASCII 32)
+                print(f"\n检测到空格键！当前有 {len(points)} 个点, {len(boxes)} 个框")
+                generate_mask(session, image_path)
+    
+        if preview is not None:
+            preview.close()
+            print(f"实时预览: 解码 {preview.decoded} 次, 丢弃过期请求 {preview.dropped} 次")
+        cv2.destroyAllWindows()
+        if not loader.ready:
+            print("等待模型加载结束后退出...")  # 加载到一半退出进程会让 torch 异常终止
     
-    cv2.destroyAllWindows()
+    if recorder is not None:
+        save_report(recorder.log_path, recorder.run_id, time.perf_counter() - start, output_dir)
 
 if __name__ == "__main__":
     main()
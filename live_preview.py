@@ -0,0 +1,164 @@
+"""
+实时预览 - 拖拽框或悬停点时在后台线程中只运行解码器，显示低分辨率的mask
+
+  - GUI 线程在鼠标事件中调用 request() 提交最新的提示，立即返回，不会卡住 OpenCV 事件循环
+  - 后台线程按 interval_ms 节流：两次解码之间到达的请求只保留最新的一个，旧请求直接丢弃
+  - GUI 线程在主循环中调用 poll() 取出新结果，用 overlay() 画到当前画面上
+
+解码使用 session 中已缓存的 embedding，mask 在低分辨率下输出（见 SAMSession.decode_preview）。
+"""
+
+import threading
+import time
+
+import cv2
+import numpy as np
+
+PREVIEW_COLOR = (255, 144, 30)  # BGR，预览mask的颜色
+
+
+class LivePreview:
+    def __init__(self, session, interval_ms=50, low_res=256, enabled=True):
+        """
+        参数:
+            session: SAMSession，默认使用其当前图片的 embedding
+            interval_ms: 两次解码之间的最短间隔（毫秒）
+            low_res: 预览mask的长边尺寸
+            enabled: 是否开启（可以用 toggle() 切换）
+        """
+        self.session = session
+        self.interval = interval_ms / 1000
+        self.low_res = low_res
+        self.enabled = enabled
+        self.mask = None       # 最近一次 poll() 取出的预览mask
+        self.decoded = 0       # 解码次数
+        self.dropped = 0       # 被更新的请求覆盖而丢弃的请求数
+        self._cond = threading.Condition()
+        self._pending = None   # 最新的未处理请求 (序号, embedding, 提示)
+        self._seq = 0          # 最新请求的序号
+        self._cleared = 0      # clear() 时的序号，之前的请求的结果不再显示
+        self._result = None    # 最新的解码结果 (序号, mask)
+        self._shown = 0        # 已经被 poll() 取出的结果序号
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def request(self, embedding=None, **prompts):
+        """
+        提交预览请求（GUI 线程调用，立即返回）
+
+        参数:
+            embedding: 使用的 embedding（默认 session 当前图片的）
+            prompts: points / labels / bboxes，同 SAMSession.decode
+        """
+        if not self.enabled:
+            return
+        embedding = embedding if embedding is not None else self.session.embedding
+        if embedding is None:
+            return
+        with self._cond:
+            if self._pending is not None:
+                self.dropped += 1
+            self._seq += 1
+            self._pending = (self._seq, embedding, prompts)
+            self._cond.notify()
+
+    def clear(self):
+        """丢弃未处理的请求和已有的预览（换图片、重置提示时调用）"""
+        with self._cond:
+            if self._pending is not None:
+                self.dropped += 1
+            self._pending = None
+            self._cleared = self._seq
+            self._result = None
+            self.mask = None
+
+    def toggle(self):
+        """开关实时预览，返回切换后的状态"""
+        self.enabled = not self.enabled
+        if not self.enabled:
+            self.clear()
+        return self.enabled
+
+    def poll(self):
+        """
+        取出新的预览结果（GUI 线程调用）
+
+        返回:
+            有新结果时返回 True，并更新 self.mask（没有mask时为 None）
+        """
+        with self._cond:
+            result = self._result
+            if result is None or result[0] == self._shown:
+                return False
+            self._shown = result[0]
+            self.mask = result[1]
+            return True
+
+    def close(self):
+        """停止后台线程"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout=1.0)
+
+    def _run(self):
+        """后台线程：节流后解码最新的请求"""
+        last = 0.0
+        while True:
+            with self._cond:
+                while self._pending is None and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+            # 节流：等待期间到达的新请求会覆盖旧请求
+            delay = last + self.interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            with self._cond:
+                request, self._pending = self._pending, None
+            if request is None:
+                continue  # 等待期间被 clear()
+            seq, embedding, prompts = request
+            last = time.perf_counter()
+            try:
+                mask, _ = self.session.decode_preview(embedding, low_res=self.low_res, **prompts)
+            except Exception as e:
+                print(f"  ✗ 预览解码出错: {e}")
+                mask = None
+            with self._cond:
+                self.decoded += 1
+                if seq > self._cleared:
+                    self._result = (seq, mask)
+
+
+def overlay(image, mask, color=PREVIEW_COLOR, alpha=0.45):
+    """
+    把低分辨率的预览mask放大后半透明地画在图像上
+
+    参数:
+        image: BGR图像（不修改）
+        mask: (h, w) bool 数组，None 时直接返回原图的副本
+
+    返回:
+        新图像
+    """
+    result = image.copy()
+    if mask is None:
+        return result
+    h, w = image.shape[:2]
+    full = cv2.resize(mask.astype(np.uint8), (w, h), interpolation=cv2.INTER_NEAREST)
+    blend_mask(result, full, color, alpha)
+    return result
+
+
+def blend_mask(image, mask, color, alpha):
+    """
+    把 mask 区域原地染色（cv2 整块混合后按mask复制，比布尔索引快得多）
+
+    参数:
+        image: BGR图像（原地修改）
+        mask: 与 image 同尺寸的 uint8 数组，非0为要染色的区域
+    """
+    tinted = cv2.addWeighted(image, 1 - alpha, np.full_like(image, color), alpha, 0)
+    cv2.copyTo(tinted, mask, image)
@@ -0,0 +1,148 @@
+"""
+运行清单 - 让中断的批量任务可以从断点继续
+
+清单是输出目录中的一个只追加的 JSON-lines 文件，每生成一个mask追加一行:
+    {"input": ..., "size": ..., "mtime_ns": ..., "sha1": ..., "prompt": ..., "model": ..., "output": ...}
+
+重新运行时，输入文件未改变、提示配置和模型相同、输出文件仍然存在的图片会被跳过，
+只处理新增或修改过的图片。
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+from image_sources import input_file, input_key, input_stat
+
+MANIFEST_NAME = "manifest.jsonl"
+
+
+class RunManifest:
+    def __init__(self, output_folder, model_path, prompt_key, verify="mtime", image_prompt=None):
+        """
+        打开（或创建）输出目录中的清单
+
+        参数:
+            output_folder: 输出mask文件夹路径
+            model_path: 模型文件路径
+            prompt_key: 提示配置的描述字符串，见 describe_prompt_fn
+            verify: 判断输入是否改变的方式，"mtime"（大小+修改时间）或 "hash"（内容SHA1）
+            image_prompt: 每张图片提示不同时，返回该图片提示摘要的函数 image_prompt(image_path)，
+                          追加到 prompt_key 后面（例如 prompt_journal.JournalPrompts.digest）
+        """
+        if verify not in ("mtime", "hash"):
+            raise ValueError(f"verify 只能是 'mtime' 或 'hash'，实际为 '{verify}'")
+        self.path = os.path.join(output_folder, MANIFEST_NAME)
+        self.model = os.path.abspath(model_path)
+        self.prompt = prompt_key
+        self.verify = verify
+        self.image_prompt = image_prompt
+        self._lock = threading.Lock()
+        self._entries = self._load()
+
+    def _load(self):
+        """读取已有清单，同一输入以最后一行为准"""
+        entries = {}
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # 进程被杀时可能留下不完整的最后一行
+                entries[entry["input"]] = entry
+        return entries
+
+    def is_done(self, image_path):
+        """图片是否已经用相同的模型和提示处理过，且输入未改变、输出仍存在"""
+        entry = self._entries.get(input_key(image_path))
+        if entry is None:
+            return False
+        if entry.get("model") != self.model or entry.get("prompt") != self.prompt_for(image_path):
+            return False
+        if not os.path.exists(entry.get("output", "")):
+            return False
+
+        try:
+            size, mtime_ns = input_stat(image_path)
+            if entry.get("size") != size:
+                return False
+            if self.verify == "hash":
+                return entry.get("sha1") == input_sha1(image_path)
+        except OSError:
+            return False  # 输入已被删除或改名: 交给读取阶段报告，不中断整个过滤
+        return entry.get("mtime_ns") == mtime_ns
+
+    def prompt_for(self, image_path):
+        """图片的提示描述（逐图提示时追加该图片的提示摘要）"""
+        if self.image_prompt is None:
+            return self.prompt
+        return f"{self.prompt} image={self.image_prompt(image_path)}"
+
+    def pending(self, image_files):
+        """过滤掉已完成的图片：列表返回列表，其他可迭代对象返回生成器（边读取边过滤）"""
+        if isinstance(image_files, list):
+            return [f for f in image_files if not self.is_done(f)]
+        return (f for f in image_files if not self.is_done(f))
+
+    def record(self, image_path, output_path):
+        """追加一条完成记录（线程安全，每条记录一次写入）"""
+        size, mtime_ns = input_stat(image_path)
+        entry = {
+            "input": input_key(image_path),
+            "size": size,
+            "mtime_ns": mtime_ns,
+            "prompt": self.prompt_for(image_path),
+            "model": self.model,
+            "output": os.path.abspath(output_path),
+            "time": time.time(),
+        }
+        if self.verify == "hash":
+            entry["sha1"] = input_sha1(image_path)
+
+        line = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock:
+            # O_APPEND 单次写入，多个进程同时追加也不会交错
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+            self._entries[entry["input"]] = entry
+
+
+def describe_prompt_fn(prompt_fn, **options):
+    """
+    把提示函数（partial 对象）转换成稳定的描述字符串，用于比较提示配置是否相同
+
+    参数:
+        options: 其他影响输出的配置（例如 combine 合并方式），追加到描述中
+    """
+    func = getattr(prompt_fn, "func", prompt_fn)
+    name = getattr(func, "__qualname__", type(func).__qualname__)  # 可调用对象用类名
+    args = [repr(a) for a in getattr(prompt_fn, "args", ())]
+    keywords = getattr(prompt_fn, "keywords", {})
+    args += [f"{k}={keywords[k]!r}" for k in sorted(keywords)]
+    extra = "".join(f" {k}={options[k]!r}" for k in sorted(options))
+    return f"{name}({', '.join(args)}){extra}"
+
+
+def file_sha1(path, chunk_size=1 << 20):
+    """计算文件内容的SHA1"""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def input_sha1(image_path):
+    """输入项内容的SHA1（tar 成员为成员内容），视频帧返回 None"""
+    data = getattr(image_path, "data", None)
+    if data is not None:
+        return hashlib.sha1(data).hexdigest()
+    path = input_file(image_path)
+    return file_sha1(path) if path is not None else None
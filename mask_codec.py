@@ -0,0 +1,57 @@
+"""
+mask 编码 - 把二值mask转换成紧凑的可序列化格式
+
+RLE 与 COCO 的非压缩 RLE 相同:
+    {"size": [h, w], "counts": [n0, n1, n2, ...]}
+按列优先（Fortran 顺序）展开像素，counts 依次是 0 和 1 的连续长度，第一个总是 0 的长度。
+
+位打包（np.packbits）每个像素占1位，是 8 位 PNG 原始数据的 1/8。
+"""
+
+import numpy as np
+
+
+def encode_rle(mask):
+    """
+    二值mask -> COCO 非压缩 RLE
+
+    参数:
+        mask: (H, W) 数组或张量，非0为前景
+    """
+    if hasattr(mask, "cpu"):
+        mask = mask.cpu().numpy()
+    mask = np.asarray(mask)
+    h, w = mask.shape
+    flat = (mask.ravel(order="F") > 0).astype(np.int8)
+    # 值发生变化的位置，两端补上起点和终点
+    changes = np.flatnonzero(np.diff(flat)) + 1
+    bounds = np.concatenate(([0], changes, [flat.size]))
+    counts = np.diff(bounds).tolist()
+    if flat.size and flat[0] == 1:
+        counts.insert(0, 0)  # 第一段必须是背景
+    return {"size": [h, w], "counts": counts}
+
+
+def decode_rle(rle):
+    """COCO 非压缩 RLE -> (H, W) uint8 二值mask (0/1)"""
+    h, w = rle["size"]
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    values = np.zeros(len(counts), dtype=np.uint8)
+    values[1::2] = 1
+    flat = np.repeat(values, counts)
+    return flat.reshape((w, h)).T.copy()
+
+
+def rle_area(rle):
+    """RLE 中前景像素数"""
+    return int(sum(rle["counts"][1::2]))
+
+
+def pack_mask(mask):
+    """二值mask -> 按行位打包的 (H, ceil(W/8)) uint8 数组"""
+    return np.packbits(np.asarray(mask) > 0, axis=1)
+
+
+def unpack_mask(packed, width):
+    """pack_mask 的逆操作，返回 (H, W) uint8 二值mask (0/1)"""
+    return np.unpackbits(packed, axis=1, count=width)
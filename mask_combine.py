@@ -0,0 +1,115 @@
+"""
+合并多个预测mask
+
+一次预测可能返回多个mask（多个框、多个点提示或多输出模式）。这里用一次张量运算
+把 (N, H, W) 的mask合并成一张输出图:
+  - union: 所有mask的并集，0/255 二值图
+  - label: 实例标签图，第 i 个mask的像素值为 i+1，重叠处归属置信度更高的实例
+           （不超过255个实例时为 uint8，否则为 uint16）
+  - best:  只保留置信度最高的一个mask，0/255 二值图
+
+torch 在函数内导入，入口脚本导入本模块（例如取 COMBINE_MODES 做参数检查）时不需要加载 torch。
+"""
+
+import numpy as np
+
+COMBINE_MODES = ("union", "label", "best")
+
+
+def extract_masks(result):
+    """
+    从 Results 中取出全部mask和置信度
+
+    返回:
+        (masks, scores): (N, H, W) bool 张量和 (N,) 张量；没有mask时返回 (None, None)
+    """
+    if result.masks is None or len(result.masks) == 0:
+        return None, None
+    import torch
+
+    masks = result.masks.data
+    scores = result.boxes.conf if result.boxes is not None else torch.ones(len(masks))
+    return masks, scores
+
+
+def combine_masks(masks, scores=None, mode="union"):
+    """
+    合并mask
+
+    参数:
+        masks: (N, H, W) 的 bool/0-1 张量或数组
+        scores: (N,) 置信度（label / best 模式使用，默认按顺序）
+        mode: "union" / "label" / "best"
+
+    返回:
+        (H, W) 的 numpy 数组，可直接用 cv2.imwrite 保存
+    """
+    if mode not in COMBINE_MODES:
+        raise ValueError(f"不支持的合并模式 '{mode}'，可选: {', '.join(COMBINE_MODES)}")
+    import torch
+
+    masks = torch.as_tensor(masks).bool()
+    if masks.ndim == 2:
+        masks = masks[None]
+    n = masks.shape[0]
+    if scores is None:
+        scores = torch.arange(n, 0, -1, dtype=torch.float32)  # 未给置信度时前面的优先
+    scores = torch.as_tensor(scores, dtype=torch.float32, device=masks.device)
+
+    if mode == "union":
+        combined = masks.any(dim=0)
+        return combined.cpu().numpy().astype(np.uint8) * 255
+
+    if mode == "best":
+        combined = masks[scores.argmax()]
+        return combined.cpu().numpy().astype(np.uint8) * 255
+
+    # label: 每个像素取覆盖它的、置信度最高的实例
+    rank = torch.empty(n, dtype=torch.int32, device=masks.device)
+    rank[scores.argsort()] = torch.arange(1, n + 1, dtype=torch.int32, device=masks.device)
+    weights = masks.to(torch.int32) * rank[:, None, None]  # 未覆盖为0，覆盖时置信度越高值越大
+    best_weight, best_index = weights.max(dim=0)
+    labels = torch.where(best_weight > 0, best_index + 1, torch.zeros_like(best_index))
+    dtype = np.uint8 if n < 256 else np.uint16
+    return labels.cpu().numpy().astype(dtype)
+
+
+def mask_nms(masks, scores, iou_thresh=0.7):
+    """
+    按mask IoU做非极大值抑制
+
+    一次矩阵乘法算出所有mask两两之间的交集，再按置信度从高到低贪心保留。
+
+    参数:
+        masks: (N, H, W) bool 张量
+        scores: (N,) 置信度
+        iou_thresh: 与已保留mask的IoU超过该值的被去掉
+
+    返回:
+        保留的下标（按置信度从高到低）
+    """
+    import torch
+
+    n = len(masks)
+    if n == 0:
+        return torch.zeros(0, dtype=torch.long, device=masks.device)
+
+    order = scores.argsort(descending=True)
+    flat = masks[order].flatten(1).float()
+    inter = flat @ flat.T
+    area = flat.sum(dim=1)
+    iou = inter / (area[:, None] + area[None, :] - inter).clamp(min=1)
+
+    suppressed = torch.zeros(n, dtype=torch.bool, device=masks.device)
+    keep = []
+    for i in range(n):
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        suppressed |= iou[i] > iou_thresh
+    return order[keep]
+
+
+def mask_preview(mask):
+    """把合并结果转换成便于显示的 0/255 图"""
+    return (mask > 0).astype(np.uint8) * 255
@@ -0,0 +1,491 @@
+"""
+本地分割服务 - 模型只加载一次，通过 HTTP 或 Unix socket 提供mask生成
+
+接口:
+  POST /segment   请求体为 JSON:
+      {
+        "image_path": "a.jpg",          # 或 "image": "<base64 编码的图片文件>"
+        "points": [[x, y], ...],        # 可选，所有点共同构成一个提示
+        "labels": [1, 0, ...],          # 可选，默认全部为前景点
+        "boxes": [[x1, y1, x2, y2], ...],  # 可选，每个框一个提示
+        "format": "png",                # png（默认，返回合并后的mask图片）或 rle（返回 JSON）
+        "combine": "union"              # png 格式的合并方式，见 mask_combine
+      }
+      png: 返回 image/png，响应头 X-Mask-Count / X-Latency-Ms
+      rle: 返回 {"masks": [RLE, ...], "scores": [...], "latency_ms": ...}，RLE 格式见 mask_codec
+  GET /stats      队列深度、批次大小、延迟分位数等统计
+  GET /health     服务是否就绪
+
+同一时间窗口内到达的请求合并成一次编码器调用（微批处理）；最近用过的图片的
+embedding 保存在内存中，对同一张图片反复提交不同提示时只运行解码器。
+"""
+
+import base64
+import hashlib
+import http.client
+import json
+import os
+import queue
+import socket
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+
+from mask_codec import encode_rle
+from mask_combine import COMBINE_MODES, combine_masks, extract_masks
+from run_report import percentile
+
+_STOP = object()  # 队列结束标记
+
+
+class SegmentRequest:
+    """一个待处理的分割请求"""
+
+    def __init__(self, image, key, prompts, image_path=None):
+        self.image = image            # BGR图像
+        self.key = key                # 图片内容标识，用于复用 embedding
+        self.prompts = prompts        # 传给 session.decode 的提示参数
+        self.image_path = image_path
+        self.inputs = None            # 预处理后的编码器输入（在请求线程中准备）
+        self.future = Future()
+        self.submitted = time.perf_counter()
+
+
+class MaskServer:
+    def __init__(self, session, max_batch=4, batch_window_ms=10, embedding_lru=8):
+        """
+        初始化服务核心（与传输方式无关，可直接在进程内调用 submit）
+
+        参数:
+            session: SAMSession
+            max_batch: 每次编码器调用最多处理的图片数
+            batch_window_ms: 收到第一个请求后等待更多请求的时间
+            embedding_lru: 内存中保留最近多少张图片的 embedding
+        """
+        self.session = session
+        self.max_batch = max(1, max_batch)
+        self.batch_window = batch_window_ms / 1000
+        self.embedding_lru = embedding_lru
+        self._embeddings = OrderedDict()  # key -> ImageEmbedding，最近使用的在最后（受 _lock 保护）
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=2000)   # 最近请求的端到端延迟（秒）
+        self._encode_times = deque(maxlen=500)  # 最近批次的编码耗时（秒）
+        self._counters = {"requests": 0, "errors": 0, "batches": 0, "batched_images": 0,
+                          "encoded_images": 0, "embedding_hits": 0}
+        self._started = time.time()
+        self._thread = threading.Thread(target=self._model_loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, image, prompts, key=None, image_path=None):
+        """
+        提交一个请求
+
+        参数:
+            image: BGR图像
+            prompts: 提示参数 {"points", "labels", "bboxes"}
+            key: 图片内容标识（默认为像素数据的SHA1）
+
+        返回:
+            Future，结果为 (masks, scores)，没有mask时为 (None, None)
+        """
+        if key is None:
+            key = hashlib.sha1(image.tobytes()).hexdigest()
+        request = SegmentRequest(image, key, prompts, image_path)
+        # 预处理在调用方线程中进行，模型线程只运行模型
+        with self._lock:
+            cached = key in self._embeddings
+        if not cached:
+            request.inputs = self.session.preprocess(image)
+        self._queue.put(request)
+        return request.future
+
+    def _model_loop(self):
+        """模型线程：收集一个时间窗口内的请求，一次编码，逐个解码"""
+        while True:
+            first = self._queue.get()
+            if first is _STOP:
+                return
+            batch = [first]
+            deadline = time.perf_counter() + self.batch_window
+            stop = False
+            # 批次按不同图片数计数，同一张图片的多个请求只编码一次
+            while len({r.key for r in batch}) < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            self._process(batch)
+            if stop:
+                return
+
+    def _process(self, batch):
+        """编码批次中未缓存的图片，再逐个请求解码"""
+        try:
+            embeddings = self._encode(batch)
+        except Exception as e:
+            for request in batch:
+                self._finish(request, error=e)
+            return
+
+        for request in batch:
+            try:
+                results = self.session.decode(embeddings[request.key], **request.prompts)
+                self._finish(request, result=extract_masks(results[0]))
+            except Exception as e:
+                self._finish(request, error=e)
+
+    def _encode(self, batch):
+        """返回 key -> embedding，只编码 LRU 中没有的图片"""
+        embeddings = {}
+        missing = OrderedDict()
+        with self._lock:
+            for request in batch:
+                if request.key in self._embeddings:
+                    self._embeddings.move_to_end(request.key)
+                    embeddings[request.key] = self._embeddings[request.key]
+                    self._counters["embedding_hits"] += 1
+                elif request.key not in missing:
+                    missing[request.key] = request
+
+        if missing:
+            requests = list(missing.values())
+            start = time.perf_counter()
+            encoded = self.session.encode_batch(
+                [r.image for r in requests], [r.image_path for r in requests],
+                inputs=[r.inputs for r in requests], keys=[None] * len(requests),
+            )
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._encode_times.append(elapsed)
+                self._counters["encoded_images"] += len(requests)
+                for request, embedding in zip(requests, encoded):
+                    embeddings[request.key] = embedding
+                    if self.embedding_lru > 0:
+                        self._embeddings[request.key] = embedding
+                while len(self._embeddings) > self.embedding_lru:
+                    self._embeddings.popitem(last=False)
+
+        with self._lock:
+            self._counters["batches"] += 1
+            self._counters["batched_images"] += len(missing)
+        return embeddings
+
+    def _finish(self, request, result=None, error=None):
+        with self._lock:
+            self._counters["requests"] += 1
+            if error is not None:
+                self._counters["errors"] += 1
+            self._latencies.append(time.perf_counter() - request.submitted)
+        if error is not None:
+            request.future.set_exception(error)
+        else:
+            request.future.set_result(result)
+
+    def stats(self):
+        """服务统计"""
+        with self._lock:
+            latencies = sorted(self._latencies)
+            encode_times = sorted(self._encode_times)
+            counters = dict(self._counters)
+            cached = len(self._embeddings)
+        encoded_batches = len(encode_times)
+        return {
+            "uptime_s": round(time.time() - self._started, 1),
+            "queue_depth": self._queue.qsize(),
+            **counters,
+            "mean_batch_size": round(counters["batched_images"] / encoded_batches, 2) if encoded_batches else 0.0,
+            "cached_embeddings": cached,
+            "latency_ms": {f"p{q}": round(percentile(latencies, q) * 1000, 2) for q in (50, 95, 99)},
+            "encode_ms": {f"p{q}": round(percentile(encode_times, q) * 1000, 2) for q in (50, 95, 99)},
+        }
+
+    def close(self):
+        """处理完队列中的请求后停止模型线程"""
+        self._queue.put(_STOP)
+        self._thread.join()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """HTTP 请求处理（每个连接一个线程）"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._send_json(200, self.server.mask_server.stats())
+        elif self.path == "/health":
+            self._send_json(200, {"ok": True})
+        else:
+            self._send_json(404, {"error": f"未知路径: {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/segment":
+            self._send_json(404, {"error": f"未知路径: {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            image, key, image_path = _load_request_image(body)
+            prompts = _parse_prompts(body)
+            fmt = body.get("format", "png")
+            combine = body.get("combine", self.server.combine)
+            if fmt not in ("png", "rle"):
+                raise ValueError(f"不支持的格式 '{fmt}'，可选: png, rle")
+            if combine not in COMBINE_MODES:
+                raise ValueError(f"不支持的合并模式 '{combine}'，可选: {', '.join(COMBINE_MODES)}")
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+
+        start = time.perf_counter()
+        try:
+            masks, scores = self.server.mask_server.submit(image, prompts, key, image_path).result()
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+            return
+        latency_ms = round((time.perf_counter() - start) * 1000, 2)
+
+        count = 0 if masks is None else len(masks)
+        if fmt == "rle":
+            self._send_json(200, {
+                "masks": [encode_rle(m) for m in masks] if count else [],
+                "scores": [round(float(s), 4) for s in scores] if count else [],
+                "latency_ms": latency_ms,
+            })
+            return
+
+        if count:
+            combined = combine_masks(masks, scores, combine)
+        else:
+            combined = np.zeros(image.shape[:2], dtype=np.uint8)
+        _, png = cv2.imencode(".png", combined)
+        self._send(200, png.tobytes(), "image/png",
+                   {"X-Mask-Count": str(count), "X-Latency-Ms": str(latency_ms)})
+
+    def _send_json(self, status, data):
+        self._send(status, json.dumps(data, ensure_ascii=False).encode("utf-8"), "application/json")
+
+    def _send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket 的客户端地址为空
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class _UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)  # 上次运行留下的 socket 文件
+        self.socket.bind(self.server_address)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+    def get_request(self):
+        request, _ = self.socket.accept()
+        return request, ("", 0)
+
+
+def make_http_server(mask_server, host="127.0.0.1", port=8765, socket_path=None, combine="union",
+                     verbose=False):
+    """创建 HTTP 服务（给出 socket_path 时监听 Unix socket）"""
+    if socket_path:
+        httpd = _UnixHTTPServer(socket_path, _Handler)
+    else:
+        httpd = ThreadingHTTPServer((host, port), _Handler)
+    httpd.daemon_threads = True
+    httpd.mask_server = mask_server
+    httpd.combine = combine
+    httpd.verbose = verbose
+    return httpd
+
+
+def _load_request_image(body):
+    """从请求中读取图片，返回 (image, key, image_path)"""
+    if "image" in body:
+        data = base64.b64decode(body["image"])
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError("无法解码图片数据")
+        return image, hashlib.sha1(data).hexdigest(), None
+
+    image_path = body["image_path"]
+    image = cv2.imread(image_path)
+    if image is None:
+        raise ValueError(f"无法读取图片: {image_path}")
+    st = os.stat(image_path)
+    key = hashlib.sha1(f"{os.path.abspath(image_path)}:{st.st_size}:{st.st_mtime_ns}".encode()).hexdigest()
+    return image, key, image_path
+
+
+def _parse_prompts(body):
+    """请求中的提示 -> session.decode 参数"""
+    prompts = {}
+    if body.get("points"):
+        prompts["points"] = body["points"]
+        prompts["labels"] = body.get("labels") or [1] * len(body["points"])
+        if len(prompts["labels"]) != len(prompts["points"]):
+            raise ValueError("labels 的数量必须与 points 相同")
+    if body.get("boxes"):
+        prompts["bboxes"] = body["boxes"]
+    if not prompts:
+        raise ValueError("至少需要 points 或 boxes")
+    return prompts
+
+
+class MaskClient:
+    """简单的客户端，便于脚本和测试调用服务"""
+
+    def __init__(self, host="127.0.0.1", port=8765, socket_path=None, timeout=60):
+        self.host = host
+        self.port = port
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def _connection(self):
+        if self.socket_path:
+            return _UnixHTTPConnection(self.socket_path, self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _request(self, method, path, body=None):
+        conn = self._connection()
+        try:
+            headers = {"Content-Type": "application/json"} if body is not None else {}
+            conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+            response = conn.getresponse()
+            return response.status, dict(response.getheaders()), response.read()
+        finally:
+            conn.close()
+
+    def segment(self, image_path=None, image_bytes=None, points=None, labels=None, boxes=None,
+                format="png", combine=None):
+        """
+        请求分割
+
+        返回:
+            format="png": (H, W) mask 数组
+            format="rle": {"masks": [...], "scores": [...], "latency_ms": ...}
+        """
+        body = {"format": format}
+        if image_bytes is not None:
+            body["image"] = base64.b64encode(image_bytes).decode("ascii")
+        else:
+            body["image_path"] = os.path.abspath(image_path)
+        for name, value in (("points", points), ("labels", labels), ("boxes", boxes), ("combine", combine)):
+            if value is not None:
+                body[name] = value
+
+        status, headers, data = self._request("POST", "/segment", body)
+        if status != 200:
+            raise RuntimeError(f"服务返回 {status}: {json.loads(data).get('error', '')}")
+        if format == "rle":
+            return json.loads(data)
+        return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+
+    def stats(self):
+        """服务统计"""
+        return json.loads(self._request("GET", "/stats")[2])
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='本地 SAM 分割服务',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+示例:
+  python mask_server.py --port 8765
+  python mask_server.py --socket /tmp/sam.sock
+
+  curl -s localhost:8765/segment -d '{"image_path": "a.jpg", "boxes": [[10, 10, 200, 200]]}' -o mask.png
+  curl -s localhost:8765/stats
+        """
+    )
+    parser.add_argument('-m', '--model', default='mobile_sam.pt',
+                        help='模型文件路径 (默认: mobile_sam.pt)')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='监听地址 (默认: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8765,
+                        help='监听端口 (默认: 8765)')
+    parser.add_argument('--socket', default=None, metavar='PATH',
+                        help='改为监听 Unix socket')
+    parser.add_argument('--max-batch', type=int, default=4,
+                        help='每次编码器调用最多处理的图片数 (默认: 4)')
+    parser.add_argument('--batch-window-ms', type=float, default=10,
+                        help='收到第一个请求后等待更多请求合并成一批的时间 (默认: 10)')
+    parser.add_argument('--embedding-lru', type=int, default=8,
+                        help='内存中保留最近多少张图片的 embedding (默认: 8)')
+    parser.add_argument('--combine', choices=COMBINE_MODES, default='union',
+                        help='png 格式默认的合并方式 (默认: union)')
+    parser.add_argument('--stub', action='store_true',
+                        help='使用确定性的替身模型（不需要模型权重，用于测试）')
+    parser.add_argument('--verbose', action='store_true',
+                        help='打印每个 HTTP 请求')
+    args = parser.parse_args()
+
+    if args.stub:
+        from stub_model import StubSession
+        session = StubSession()
+    else:
+        from ultralytics import SAM
+        from sam_session import SAMSession
+        print(f"正在加载模型: {args.model}")
+        session = SAMSession(SAM(args.model))
+    print(f"✓ 模型已加载")
+
+    mask_server = MaskServer(session, max_batch=args.max_batch, batch_window_ms=args.batch_window_ms,
+                             embedding_lru=args.embedding_lru)
+    httpd = make_http_server(mask_server, args.host, args.port, args.socket, args.combine, args.verbose)
+    where = args.socket or f"http://{args.host}:{args.port}"
+    print(f"✓ 服务已启动: {where}  (Ctrl+C 停止)")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("\n正在停止...")
+    finally:
+        httpd.server_close()
+        mask_server.close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+        print(json.dumps(mask_server.stats(), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
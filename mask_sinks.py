@@ -0,0 +1,375 @@
+"""
+mask 输出格式 - 每张图片一个 PNG，或把大量mask打包成少量分片文件
+
+  png  每张图片一个 PNG（默认）
+  rle  COCO 非压缩 RLE，每行一张图片的 JSON-lines 分片: masks-<run>-00000.rle.jsonl
+  npz  位打包（np.packbits）的 .npz 分片: masks-<run>-00000.npz（label 图按原值保存）
+
+每个分片写满 shard_size 张（或运行结束）时关闭，并写出索引 <分片>.idx.json:
+    {"mask名": 位置, ...}   rle: [字节偏移, 长度]；npz: {"shape": [h, w], "packed": true/false}
+读取时只加载各分片的索引，按名字直接定位到一条记录，不需要扫描分片内容。
+
+mask 名为图片文件名去掉扩展名（与 PNG 输出的文件名相同）；递归子文件夹或 tar 包中的图片
+保留相对子目录，例如 "sub/001"（PNG 输出为 sub/001.png）。同一张图片在多个分片中
+出现时（例如重新处理过），以文件名排序靠后（即较新）的分片为准。
+"""
+
+import glob
+import json
+import os
+import struct
+import threading
+import time
+import uuid
+import zipfile
+import zlib
+
+import cv2
+import numpy as np
+
+from mask_codec import decode_rle, encode_rle, pack_mask, unpack_mask
+
+OUTPUT_FORMATS = ("png", "rle", "npz")
+INDEX_SUFFIX = ".idx.json"
+
+
+def make_sink(output_format, output_folder, shard_size=1000, prefix=None, png_compression=None):
+    """
+    创建输出格式对应的写入器
+
+    参数:
+        output_format: "png" / "rle" / "npz"
+        output_folder: 输出文件夹
+        shard_size: 每个分片的mask数（rle / npz）
+        prefix: 分片文件名前缀，多个进程同时写同一个文件夹时必须不同（默认: 时间+进程号）
+        png_compression: PNG 压缩级别 0-9（None 使用 OpenCV 默认值）
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"不支持的输出格式 '{output_format}'，可选: {', '.join(OUTPUT_FORMATS)}")
+    if output_format == "png":
+        return PngSink(output_folder, png_compression)
+    cls = RleShardSink if output_format == "rle" else NpzShardSink
+    return cls(output_folder, shard_size, prefix)
+
+
+class PngSink:
+    """每张图片一个 PNG（先写临时文件再改名，中断时不会留下不完整的PNG）"""
+
+    def __init__(self, output_folder, compression=None):
+        """
+        参数:
+            output_folder: 输出文件夹
+            compression: PNG 压缩级别 0-9，越小越快、文件越大（None 使用 OpenCV 默认值）
+        """
+        self.output_folder = output_folder
+        self._params = [] if compression is None else [cv2.IMWRITE_PNG_COMPRESSION, int(compression)]
+        self._zlib_level = 1 if compression is None else int(compression)  # 与 OpenCV 的默认值相同
+
+    def write(self, image_path, mask, on_saved=None):
+        """
+        保存一个mask
+
+        参数:
+            image_path: 原图路径（决定mask名）
+            mask: (H, W) 合并后的mask
+            on_saved: 保存完成（数据已落盘可读）后的回调 on_saved(image_path, output_path)
+
+        返回:
+            输出文件名（用于显示）
+        """
+        output_name = image_path.stem + '.png'
+        ok, data = cv2.imencode('.png', mask, self._params)
+        if not ok:
+            raise IOError(f"无法编码 {output_name}")
+        self._save(image_path, output_name, lambda f: f.write(data.tobytes()), on_saved)
+        return output_name
+
+    def write_strips(self, image_path, width, height, strips, on_saved=None):
+        """
+        按水平条带写出一个mask，不需要把整张mask放在内存中（用于分块推理的超大图片）
+
+        参数:
+            image_path: 原图路径（决定mask名）
+            width / height: mask尺寸
+            strips: 按顺序产生 (y0, 条带) 的可迭代对象，条带为 (rows, width) 的 uint8 或 uint16 数组
+            on_saved: 同 write
+
+        返回:
+            输出文件名
+        """
+        output_name = image_path.stem + '.png'
+        self._save(image_path, output_name,
+                   lambda f: _write_png_strips(f, width, height, strips, self._zlib_level), on_saved)
+        return output_name
+
+    def _save(self, image_path, output_name, write_fn, on_saved):
+        """写入临时文件后改名为 output_name"""
+        output_path = os.path.join(self.output_folder, output_name)
+        output_dir, base = os.path.split(output_path)
+        if output_dir != self.output_folder:
+            os.makedirs(output_dir, exist_ok=True)  # mask名包含子目录
+        # 不用 mkstemp（权限固定为 0600）: os.open 的 0o666 由系统按 umask 收窄，与 cv2.imwrite 相同
+        tmp_path = os.path.join(output_dir, f".{base[:-4]}.{uuid.uuid4().hex}.tmp")
+        fd = os.open(tmp_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, "O_BINARY", 0), 0o666)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write_fn(f)
+            os.replace(tmp_path, output_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        if on_saved is not None:
+            on_saved(image_path, output_path)
+
+    def close(self):
+        pass
+
+
+def _png_chunk(f, tag, data):
+    f.write(struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data)))
+
+
+def _write_png_strips(f, width, height, strips, level):
+    """逐条压缩写出灰度 PNG（每行不做预测滤波，条带数据压缩后立即写出）"""
+    compressor = zlib.compressobj(level)
+    bit_depth = None
+    rows_written = 0
+    for y0, strip in strips:
+        if y0 != rows_written or strip.shape[1] != width:
+            raise ValueError(f"条带位置或宽度不正确: y0={y0}, shape={strip.shape}")
+        if bit_depth is None:
+            bit_depth = 16 if strip.dtype == np.uint16 else 8
+            f.write(b"\x89PNG\r\n\x1a\n")
+            _png_chunk(f, b"IHDR", struct.pack(">IIBBBBB", width, height, bit_depth, 0, 0, 0, 0))
+        rows = strip.astype(">u2" if bit_depth == 16 else np.uint8).view(np.uint8).reshape(len(strip), -1)
+        # 每行前面是滤波类型字节 0
+        raw = np.hstack([np.zeros((len(rows), 1), np.uint8), rows])
+        data = compressor.compress(raw.tobytes())
+        if data:
+            _png_chunk(f, b"IDAT", data)
+        rows_written += len(strip)
+    if rows_written != height:
+        raise ValueError(f"条带总行数 {rows_written} 与高度 {height} 不一致")
+    _png_chunk(f, b"IDAT", compressor.flush())
+    _png_chunk(f, b"IEND", b"")
+
+
+class _ShardSink:
+    """分片写入器的公共部分：分片轮换、索引和完成回调"""
+
+    extension = ""
+
+    def __init__(self, output_folder, shard_size=1000, prefix=None):
+        self.output_folder = output_folder
+        self.shard_size = max(1, shard_size)
+        self.prefix = prefix or f"{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}"
+        self._lock = threading.Lock()
+        self._shard_index = 0
+        self._shard_path = None
+        self._index = {}     # 当前分片: mask名 -> 位置
+        self._pending = []   # 当前分片关闭后才算完成的 (image_path, on_saved)
+
+    def _open_shard(self):
+        self._shard_path = os.path.join(
+            self.output_folder, f"masks-{self.prefix}-{self._shard_index:05d}{self.extension}")
+        self._shard_index += 1
+        self._index = {}
+        self._pending = []
+
+    def write(self, image_path, mask, on_saved=None):
+        """追加一个mask到当前分片（线程安全），参数同 PngSink.write"""
+        name = image_path.stem
+        payload = self._encode(name, np.asarray(mask))  # 编码在锁外进行，多个写入线程可并行
+        with self._lock:
+            if self._shard_path is None:
+                self._open_shard()
+            self._index[name] = self._append(name, payload)
+            self._after_append(image_path, on_saved)
+            shard_name = os.path.basename(self._shard_path)
+            if len(self._index) >= self.shard_size:
+                self._close_shard()
+        return f"{shard_name}:{name}"
+
+    def _after_append(self, image_path, on_saved):
+        self._pending.append((image_path, on_saved))
+
+    def _close_shard(self):
+        """关闭当前分片，写出索引，再通知分片中的mask已完成"""
+        self._finish_shard()
+        index_path = self._shard_path + INDEX_SUFFIX
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._index, f, ensure_ascii=False)
+        os.replace(tmp_path, index_path)
+        for image_path, on_saved in self._pending:
+            if on_saved is not None:
+                on_saved(image_path, self._shard_path)
+        self._shard_path = None
+
+    def close(self):
+        """关闭未写满的分片"""
+        with self._lock:
+            if self._shard_path is not None:
+                self._close_shard()
+
+    def _encode(self, name, mask):
+        raise NotImplementedError
+
+    def _append(self, name, payload):
+        raise NotImplementedError
+
+    def _finish_shard(self):
+        raise NotImplementedError
+
+
+class RleShardSink(_ShardSink):
+    """COCO RLE 的 JSON-lines 分片"""
+
+    extension = ".rle.jsonl"
+
+    def _open_shard(self):
+        super()._open_shard()
+        self._file = open(self._shard_path, "ab")
+
+    def _encode(self, name, mask):
+        record = {"image": name, "size": list(mask.shape), "dtype": mask.dtype.name,
+                  "rles": [{"value": int(v), "rle": encode_rle(mask == v)}
+                           for v in np.unique(mask) if v != 0]}
+        return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+    def _append(self, name, line):
+        offset = self._file.tell()
+        self._file.write(line)
+        self._file.flush()
+        return [offset, len(line)]
+
+    def _after_append(self, image_path, on_saved):
+        # 每行写入后即可读取（没有索引时读取器会扫描分片），不必等分片关闭
+        if on_saved is not None:
+            on_saved(image_path, self._shard_path)
+
+    def _finish_shard(self):
+        self._file.close()
+
+
+class NpzShardSink(_ShardSink):
+    """位打包的 .npz 分片（zip 文件，每个mask一个 .npy 成员，可单独读取）"""
+
+    extension = ".npz"
+
+    def _open_shard(self):
+        super()._open_shard()
+        self._zip = zipfile.ZipFile(self._shard_path, "w", zipfile.ZIP_STORED)
+
+    def _encode(self, name, mask):
+        # 二值mask位打包，label 图保持原值（zip 压缩）
+        binary = mask.dtype == np.uint8 and not np.isin(mask, (0, 255), invert=True).any()
+        data = np.ascontiguousarray(pack_mask(mask) if binary else mask)
+        return data, {"shape": list(mask.shape), "packed": bool(binary)}
+
+    def _append(self, name, payload):
+        data, location = payload
+        info = zipfile.ZipInfo(name + ".npy")
+        info.compress_type = zipfile.ZIP_STORED if location["packed"] else zipfile.ZIP_DEFLATED
+        with self._zip.open(info, "w") as f:
+            np.lib.format.write_array(f, data, allow_pickle=False)
+        return location
+
+    def _finish_shard(self):
+        self._zip.close()
+
+
+class MaskReader:
+    """
+    按名字读取mask，自动识别输出文件夹中的格式（png / rle / npz 可以混合）
+
+    用法:
+        reader = MaskReader("output/masks")
+        mask = reader.get("000123")   # 与 PNG 输出相同: 二值图为 0/255，label 图为实例编号
+    """
+
+    def __init__(self, output_folder):
+        self.output_folder = output_folder
+        self._locations = {}  # mask名 -> (分片路径, 位置)
+        self._zips = {}
+        for shard in sorted(glob.glob(os.path.join(output_folder, "masks-*.rle.jsonl")) +
+                            glob.glob(os.path.join(output_folder, "masks-*.npz"))):
+            index = self._load_index(shard)
+            # 分片按文件名排序后加载，较新的覆盖较旧的
+            for name, location in index.items():
+                self._locations[name] = (shard, location)
+
+    def _load_index(self, shard):
+        """读取分片索引；rle 分片没有索引（写入中断）时扫描一遍"""
+        try:
+            with open(shard + INDEX_SUFFIX, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            pass
+        if not shard.endswith(".rle.jsonl"):
+            return {}  # npz 分片没有索引说明没有正常关闭，zip 不完整
+        index = {}
+        offset = 0
+        with open(shard, "rb") as f:
+            for line in f:
+                try:
+                    index[json.loads(line)["image"]] = [offset, len(line)]
+                except (json.JSONDecodeError, KeyError):
+                    pass  # 最后一行可能不完整
+                offset += len(line)
+        return index
+
+    def names(self):
+        """所有mask名（分片中的和 PNG 文件，包括子目录中的）"""
+        pngs = {os.path.splitext(os.path.relpath(p, self.output_folder))[0].replace(os.sep, "/")
+                for p in glob.glob(os.path.join(self.output_folder, "**", "*.png"), recursive=True)}
+        return sorted(pngs | set(self._locations))
+
+    def __contains__(self, name):
+        return name in self._locations or os.path.exists(os.path.join(self.output_folder, name + ".png"))
+
+    def get(self, name):
+        """
+        读取一个mask
+
+        参数:
+            name: mask名或图片文件名（可以带扩展名和子目录）
+
+        返回:
+            (H, W) 数组，不存在时返回 None
+        """
+        name = str(name)
+        for candidate in (name, os.path.splitext(name)[0], os.path.basename(name),
+                          os.path.splitext(os.path.basename(name))[0]):
+            if candidate in self:
+                name = candidate
+                break
+        location = self._locations.get(name)
+        if location is None:
+            return cv2.imread(os.path.join(self.output_folder, name + ".png"), cv2.IMREAD_UNCHANGED)
+
+        shard, loc = location
+        if shard.endswith(".rle.jsonl"):
+            offset, length = loc
+            with open(shard, "rb") as f:
+                f.seek(offset)
+                record = json.loads(f.read(length))
+            mask = np.zeros(record["size"], dtype=record.get("dtype", "uint8"))
+            for item in record["rles"]:
+                mask[decode_rle(item["rle"]) > 0] = item["value"]
+            return mask
+
+        zf = self._zips.get(shard)
+        if zf is None:
+            zf = self._zips[shard] = zipfile.ZipFile(shard)
+        with zf.open(name + ".npy") as f:
+            data = np.lib.format.read_array(f, allow_pickle=False)
+        if loc["packed"]:
+            return unpack_mask(data, loc["shape"][1]) * np.uint8(255)
+        return data
+
+    def close(self):
+        for zf in self._zips.values():
+            zf.close()
+        self._zips.clear()
@@ -0,0 +1,87 @@
+"""
+后台mask写入 - 保存（PNG编码和磁盘写入）在线程池中进行，调用方不必等待
+
+待写入的mask数量有上限，超过时 submit 阻塞调用方（背压），避免mask在内存中堆积。
+结束前调用 flush() / close() 等待全部写完，此后的计数才准确。
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+class AsyncMaskWriter:
+    def __init__(self, sink, workers=2, max_pending=8, recorder=None):
+        """
+        参数:
+            sink: mask写入器，见 mask_sinks.make_sink
+            workers: 写入线程数
+            max_pending: 最多有多少个mask在等待或正在写入
+            recorder: run_report.StageRecorder，记录 write 耗时，写完后结束这张图片的记录（None 表示不记录）
+        """
+        self.sink = sink
+        self.recorder = recorder
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        self._slots = threading.BoundedSemaphore(max(1, max_pending))
+        self._lock = threading.Lock()
+        self._futures = set()
+        self.written = 0  # 已写完的mask数
+        self.failed = 0   # 写入失败的mask数
+
+    def submit(self, image_path, mask, on_saved=None):
+        """
+        安排写入一个mask，立即返回（待写入的数量已满时等待）
+
+        参数:
+            image_path: 原图路径
+            mask: (H, W) 合并后的mask（提交后不要再修改）
+            on_saved: 写完后的回调 on_saved(image_path, output_path)，在写入线程中调用
+        """
+        self._slots.acquire()
+        future = self._executor.submit(self._write, image_path, mask, on_saved)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _write(self, image_path, mask, on_saved):
+        start = time.perf_counter()
+        try:
+            output_name = self.sink.write(image_path, mask, on_saved)
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            print(f"  ✗ 保存失败 {image_path.name}: {e}")
+            self._finish(image_path, start, False, str(e))
+            raise
+        with self._lock:
+            self.written += 1
+        self._finish(image_path, start, True, output_name)
+        return output_name
+
+    def _finish(self, image_path, start, ok, message):
+        if self.recorder is not None:
+            self.recorder.add(image_path, "write", time.perf_counter() - start)
+            self.recorder.finish(image_path, ok, message)
+
+    def _done(self, future):
+        with self._lock:
+            self._futures.discard(future)
+        self._slots.release()
+
+    def pending(self):
+        """还未写完的mask数"""
+        with self._lock:
+            return len(self._futures)
+
+    def flush(self):
+        """等待已提交的mask全部写完"""
+        with self._lock:
+            futures = list(self._futures)
+        wait(futures)
+
+    def close(self):
+        """写完全部mask，关闭线程池和写入器"""
+        self.flush()
+        self._executor.shutdown(wait=True)
+        self.sink.close()
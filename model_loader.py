@@ -0,0 +1,118 @@
+"""
+快速启动 - 模型在后台线程中加载，窗口先打开
+
+导入 torch / ultralytics 并加载模型需要好几秒。入口脚本只在模块顶层导入轻量的模块，
+参数检查和 --help 不再等待这些导入；交互式工具先读取第一张图片、打开窗口，同时在后台线程中
+加载模型并编码这张图片。加载期间可以照常画点和框，提示保存在当前状态中，按空格的生成请求
+排队，模型就绪后立即应用（实时预览、生成mask）。
+
+StartupTimer 记录各阶段相对进程启动的时间，打开窗口的时间即 time-to-first-window。
+
+后台线程不是守护线程: 模型加载到一半时退出进程会让 torch 异常终止，退出时会等待加载结束。
+"""
+
+import os
+import threading
+import time
+
+_IMPORTED = time.perf_counter()
+
+
+def process_uptime():
+    """当前进程已运行的秒数（Linux 从 /proc 读取进程启动时间，其他平台从导入本模块时算起）"""
+    try:
+        with open("/proc/self/stat", encoding="ascii") as f:
+            # 进程名可能含空格，从最后一个 ')' 之后开始数: 第22个字段是启动时间（开机后的时钟滴答数）
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime", encoding="ascii") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError, AttributeError):
+        return time.perf_counter() - _IMPORTED
+
+
+class StartupTimer:
+    """记录启动各阶段相对进程启动的时间（秒）"""
+
+    def __init__(self):
+        self.marks = {}
+
+    def mark(self, name):
+        """记录阶段 name 完成的时间并返回"""
+        self.marks[name] = round(process_uptime(), 3)
+        return self.marks[name]
+
+
+class BackgroundLoader:
+    """在后台线程中运行加载函数（导入、加载模型、编码第一张图片），主线程轮询是否就绪"""
+
+    def __init__(self, load_fn, *args, **kwargs):
+        """
+        参数:
+            load_fn: 加载函数，load_fn(*args, **kwargs) 的返回值由 result() 取得
+        """
+        self.seconds = None  # 加载耗时
+        self._result = None
+        self._error = None
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(load_fn, args, kwargs), name="model-loader")
+        self._thread.start()
+
+    def _run(self, load_fn, args, kwargs):
+        start = time.perf_counter()
+        try:
+            self._result = load_fn(*args, **kwargs)
+        except BaseException as e:  # 在主线程的 result() 中重新抛出
+            self._error = e
+        finally:
+            self.seconds = time.perf_counter() - start
+            self._done.set()
+
+    @property
+    def ready(self):
+        """加载已结束（成功或失败）"""
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        等待加载结束并返回加载函数的返回值，加载失败时抛出原来的异常
+
+        参数:
+            timeout: 最多等待的秒数（None 表示一直等待），超时抛出 TimeoutError
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError("模型仍在加载")
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+def open_and_encode(image_path, image=None, recorder=None, **session_kwargs):
+    """
+    后台加载函数: 加载模型并创建推理会话，再编码第一张图片
+
+    参数:
+        image_path: 第一张图片的路径
+        image: 已读取的图片（None 时从 image_path 读取）
+        recorder: run_report.StageRecorder，记录第一张图片的 read / encode 耗时（None 表示不记录）
+        session_kwargs: 传给 sam_backends.open_session 的参数
+
+    返回:
+        (session, embedding)，图片无法读取时 embedding 为 None
+    """
+    from contextlib import nullcontext
+
+    from image_io import read_image
+    from sam_backends import open_session
+
+    def timed(stage):
+        return recorder.time(image_path, stage) if recorder is not None else nullcontext()
+
+    session = open_session(**session_kwargs)
+    if image is None:
+        with timed("read"):
+            image, _ = read_image(image_path)
+    if image is None:
+        return session, None
+    with timed("encode"):
+        return session, session.encode(image, image_path)
@@ -0,0 +1,320 @@
+"""
+ONNX Runtime 后端 - 用导出的编码器和解码器两个 ONNX 图在 CPU 上推理
+
+  encoder.onnx  图像编码器: images (1, 3, S, S) -> features (1, 256, S/16, S/16)
+  decoder.onnx  提示编码器 + mask解码器: features, point_coords (B, P, 2), point_labels (B, P)
+                -> masks (B, 4, 256, 256), scores (B, 4)
+
+编码器和解码器分开调用，embedding 照常缓存和复用（见 SAMSession）。框按 SAM 的约定转换成
+标签为 2、3 的两个角点，没有框时补一个标签为 -1 的填充点，与 ultralytics 的提示编码器等价；
+预处理和mask后处理也与 ultralytics 的 SAM predictor 一致，两个后端的mask相同（浮点误差以内）。
+
+第一次使用时从 .pt 模型导出（需要 ultralytics 和 onnx），保存在模型旁边的 <模型名>_onnx/ 目录，
+之后只需要 onnxruntime。precision=int8 时另外用 onnxruntime 对编码器做动态 int8 量化。
+"""
+
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from manifest import file_sha1
+
+ENCODER_NAME = "encoder.onnx"
+DECODER_NAME = "decoder.onnx"
+ENCODER_INT8_NAME = "encoder.int8.onnx"
+META_NAME = "meta.json"
+
+PIXEL_MEAN = np.array([123.675, 116.28, 103.53], dtype=np.float32)
+PIXEL_STD = np.array([58.395, 57.12, 57.375], dtype=np.float32)
+
+
+def default_onnx_dir(model_path):
+    """导出目录的默认位置: 模型文件旁边的 <模型名>_onnx/"""
+    return os.path.splitext(model_path)[0] + "_onnx"
+
+
+def export_onnx(model_path, onnx_dir=None, imgsz=1024):
+    """
+    把 ultralytics SAM 模型导出为编码器和解码器两个 ONNX 文件
+
+    参数:
+        model_path: .pt 模型文件路径
+        onnx_dir: 输出目录（默认 default_onnx_dir）
+        imgsz: 编码器输入尺寸
+
+    返回:
+        输出目录
+    """
+    import types
+
+    from ultralytics import SAM
+    from ultralytics.nn.modules.transformer import LayerNorm2d
+
+    onnx_dir = onnx_dir or default_onnx_dir(model_path)
+    os.makedirs(onnx_dir, exist_ok=True)
+    stale = os.path.join(onnx_dir, ENCODER_INT8_NAME)
+    if os.path.exists(stale):
+        os.remove(stale)  # 从旧编码器量化得到，需要重新量化
+    print(f"正在导出 ONNX 模型: {model_path} -> {onnx_dir}")
+    start = time.perf_counter()
+
+    sam = SAM(model_path).model.eval()
+    sam.set_imgsz((imgsz, imgsz))
+    # LayerNorm2d 用 x.shape[1:2] 作为归一化维度，导出时会变成动态形状而失败，换成固定的通道数
+    for module in sam.modules():
+        if isinstance(module, LayerNorm2d):
+            module.forward = types.MethodType(_layer_norm_2d, module)
+
+    images = torch.randn(1, 3, imgsz, imgsz)
+    with torch.no_grad():
+        _export(sam.image_encoder, (images,), os.path.join(onnx_dir, ENCODER_NAME),
+                ["images"], ["features"], {})
+        features = sam.image_encoder(images)
+        coords = torch.tensor([[[100.0, 100.0], [300.0, 300.0]]])
+        labels = torch.tensor([[2.0, 3.0]])
+        _export(_PromptDecoder(sam), (features, coords, labels), os.path.join(onnx_dir, DECODER_NAME),
+                ["features", "point_coords", "point_labels"], ["masks", "scores"],
+                {"point_coords": {0: "prompts", 1: "points"}, "point_labels": {0: "prompts", 1: "points"},
+                 "masks": {0: "prompts"}, "scores": {0: "prompts"}})
+
+    meta = {"source": os.path.abspath(model_path), "source_sha1": file_sha1(model_path), "imgsz": imgsz,
+            "mask_threshold": float(sam.mask_threshold)}
+    with open(os.path.join(onnx_dir, META_NAME), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    print(f"✓ ONNX 模型已导出 ({time.perf_counter() - start:.1f}s)")
+    return onnx_dir
+
+
+def _export(module, args, path, input_names, output_names, dynamic_axes):
+    torch.onnx.export(module, args, path, input_names=input_names, output_names=output_names,
+                      dynamic_axes=dynamic_axes or None, opset_version=17, dynamo=False)
+
+
+def _layer_norm_2d(self, x):
+    """导出用的 LayerNorm2d.forward，与原实现相同"""
+    return F.layer_norm(x.permute(0, 2, 3, 1), (self.weight.shape[0],), self.weight, self.bias,
+                        self.eps).permute(0, 3, 1, 2)
+
+
+class _PromptDecoder(torch.nn.Module):
+    """导出用: 点（框的两个角点）的提示编码 + mask解码器，输出全部 4 个候选mask"""
+
+    def __init__(self, sam):
+        super().__init__()
+        self.prompt_encoder = sam.prompt_encoder
+        self.mask_decoder = sam.mask_decoder
+
+    def forward(self, features, point_coords, point_labels):
+        pe = self.prompt_encoder
+        embedding = pe.pe_layer.forward_with_coords(point_coords + 0.5, pe.input_image_size)
+        labels = point_labels.unsqueeze(-1)
+        embedding = embedding * (labels != -1)
+        embedding = embedding + pe.not_a_point_embed.weight * (labels == -1)
+        for i in range(len(pe.point_embeddings)):
+            embedding = embedding + pe.point_embeddings[i].weight * (labels == i)
+        n = point_coords.shape[0]
+        dense = pe.no_mask_embed.weight.reshape(1, -1, 1, 1).expand(n, -1, *pe.image_embedding_size)
+        return self.mask_decoder.predict_masks(features, pe.get_dense_pe(), embedding, dense)
+
+
+def quantize_encoder(onnx_dir):
+    """
+    用 onnxruntime 对编码器做动态 int8 量化，返回量化后的文件路径
+
+    与 cpu_fastpath 的 int8 一样只量化矩阵乘法（Linear 层），卷积保持 fp32。
+    """
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    path = os.path.join(onnx_dir, ENCODER_INT8_NAME)
+    if not os.path.exists(path):
+        print("正在量化 ONNX 编码器 (int8)...")
+        quantize_dynamic(os.path.join(onnx_dir, ENCODER_NAME), path, weight_type=QuantType.QInt8,
+                         op_types_to_quantize=["MatMul", "Gemm"])
+    return path
+
+
+class OnnxSAM:
+    """
+    ONNX Runtime 上的 SAM 模型，用法与 ultralytics SAM 模型相同: SAMSession(OnnxSAM.load(...))
+    """
+
+    def __init__(self, encoder_path, decoder_path, imgsz=1024, mask_threshold=0.0, threads=None):
+        """
+        参数:
+            encoder_path / decoder_path: 导出的 ONNX 文件
+            imgsz: 编码器输入尺寸（与导出时一致）
+            mask_threshold: mask logits 的二值化阈值
+            threads: ONNX Runtime 的 intra-op 线程数（默认与 torch 的线程数一致，见 --threads）
+        """
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads or torch.get_num_threads()
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        providers = ["CPUExecutionProvider"]
+        self.encoder = ort.InferenceSession(encoder_path, options, providers=providers)
+        self.decoder = ort.InferenceSession(decoder_path, options, providers=providers)
+        self.imgsz = imgsz
+        self.mask_threshold = mask_threshold
+        self.model = None  # 没有 PyTorch 模型（cpu_fastpath 的优化和线程调优不适用）
+
+    @classmethod
+    def load(cls, model_path, onnx_dir=None, precision="fp32"):
+        """
+        加载导出的 ONNX 模型，不存在或 .pt 模型已改变时先导出
+
+        参数:
+            model_path: .pt 模型文件路径
+            onnx_dir: 导出目录（默认 default_onnx_dir）
+            precision: fp32 / int8（bf16 不支持）
+        """
+        if precision not in ("fp32", "int8"):
+            raise ValueError(f"ONNX 后端不支持 {precision} 精度，可选 fp32 / int8")
+        onnx_dir = onnx_dir or default_onnx_dir(model_path)
+        meta = _load_meta(onnx_dir)
+        if meta is None or (os.path.exists(model_path) and meta.get("source_sha1") != file_sha1(model_path)):
+            export_onnx(model_path, onnx_dir)
+            meta = _load_meta(onnx_dir)
+        encoder = quantize_encoder(onnx_dir) if precision == "int8" else os.path.join(onnx_dir, ENCODER_NAME)
+        return cls(encoder, os.path.join(onnx_dir, DECODER_NAME), meta["imgsz"], meta["mask_threshold"])
+
+    def make_predictor(self, imgsz, conf):
+        """SAMSession 使用的 predictor（见 sam_backends）"""
+        if imgsz != self.imgsz:
+            raise ValueError(f"ONNX 模型按 {self.imgsz} 导出，不能使用 imgsz={imgsz}")
+        return OnnxPredictor(self)
+
+
+def _load_meta(onnx_dir):
+    try:
+        with open(os.path.join(onnx_dir, META_NAME), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class OnnxPredictor:
+    """与 ultralytics SAM predictor 相同接口的 ONNX Runtime 实现（SAMSession 用到的部分）"""
+
+    def __init__(self, model):
+        self.model = model
+        self.device = torch.device("cpu")
+        self.imgsz = [model.imgsz, model.imgsz]
+
+    def preprocess(self, images):
+        """左上对齐地等比缩放并填充到 imgsz，BGR 转 RGB 并归一化，与 ultralytics 一致"""
+        batch = []
+        for image in images:
+            h, w = image.shape[:2]
+            r = min(self.imgsz[0] / h, self.imgsz[1] / w)
+            new_w, new_h = round(w * r), round(h * r)
+            if (new_w, new_h) != (w, h):
+                image = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+            image = cv2.copyMakeBorder(image, 0, round(self.imgsz[0] - new_h + 0.1), 0,
+                                       round(self.imgsz[1] - new_w + 0.1), cv2.BORDER_CONSTANT,
+                                       value=(114, 114, 114))
+            rgb = image[..., ::-1].astype(np.float32)
+            batch.append(((rgb - PIXEL_MEAN) / PIXEL_STD).transpose(2, 0, 1))
+        return torch.from_numpy(np.ascontiguousarray(np.stack(batch)))
+
+    def get_im_features(self, batch):
+        """逐张运行编码器（导出的编码器批大小固定为1）"""
+        outputs = [self.model.encoder.run(None, {"images": x[None].numpy()})[0] for x in batch]
+        return torch.from_numpy(np.concatenate(outputs))
+
+    def inference_features(self, features, src_shape, dst_shape=None, bboxes=None, points=None, labels=None,
+                           masks=None, multimask_output=False):
+        """
+        运行解码器，参数和返回值同 ultralytics SAM predictor 的 inference_features
+
+        返回:
+            (masks, boxes): (N, H, W) bool 张量（None 表示没有mask）和 (N, 6) 张量 [x1, y1, x2, y2, 置信度, 序号]
+        """
+        if masks is not None:
+            raise ValueError("ONNX 后端不支持mask提示")
+        dst_shape = tuple(dst_shape or self.imgsz)
+        coords, point_labels = self._prompt_points(dst_shape, src_shape, bboxes, points, labels)
+        feats = features.numpy() if isinstance(features, torch.Tensor) else features
+        low_res, scores = self.model.decoder.run(None, {"features": np.ascontiguousarray(feats, dtype=np.float32),
+                                                        "point_coords": coords, "point_labels": point_labels})
+        select = slice(1, None) if multimask_output else slice(0, 1)
+        pred_masks = torch.from_numpy(low_res[:, select]).flatten(0, 1)
+        pred_scores = torch.from_numpy(scores[:, select]).flatten(0, 1)
+        if pred_masks.shape[0] == 0:
+            return None, torch.zeros((0, 6))
+
+        pred_masks = _scale_masks(pred_masks, src_shape, dst_shape) > self.model.mask_threshold
+        boxes = _masks_to_boxes(pred_masks)
+        cls = torch.arange(pred_masks.shape[0], dtype=torch.float32)
+        return pred_masks, torch.cat([boxes, pred_scores[:, None], cls[:, None]], dim=-1)
+
+    @staticmethod
+    def _prompt_points(dst_shape, src_shape, bboxes, points, labels):
+        """
+        把点和框转换成解码器的输入: 坐标缩放到编码器输入尺寸，框变成标签为 2、3 的两个角点，
+        没有框时补一个填充点（标签 -1），与 ultralytics 的提示编码器一致
+        """
+        r = min(dst_shape[0] / src_shape[0], dst_shape[1] / src_shape[1])
+        parts_coords, parts_labels = [], []
+        if points is not None:
+            points = np.asarray(points, dtype=np.float32)
+            points = points[None] if points.ndim == 1 else points
+            labels = np.ones(points.shape[:-1]) if labels is None else np.asarray(labels)
+            if points.ndim == 2:  # 每个点一个提示: (N, 2) -> (N, 1, 2)
+                points, labels = points[:, None, :], labels[:, None]
+            parts_coords.append(points * r)
+            parts_labels.append(labels.astype(np.float32))
+        if bboxes is not None:
+            bboxes = np.asarray(bboxes, dtype=np.float32).reshape(-1, 4)
+            parts_coords.append(bboxes.reshape(-1, 2, 2) * r)
+            parts_labels.append(np.tile(np.array([[2, 3]], dtype=np.float32), (len(bboxes), 1)))
+        elif points is not None:
+            n = parts_coords[0].shape[0]
+            parts_coords.append(np.zeros((n, 1, 2), dtype=np.float32))
+            parts_labels.append(-np.ones((n, 1), dtype=np.float32))
+        n = max(part.shape[0] for part in parts_coords)
+        coords = np.concatenate([np.broadcast_to(c, (n,) + c.shape[1:]) for c in parts_coords], axis=1)
+        point_labels = np.concatenate([np.broadcast_to(l, (n,) + l.shape[1:]) for l in parts_labels], axis=1)
+        return np.ascontiguousarray(coords, dtype=np.float32), np.ascontiguousarray(point_labels, dtype=np.float32)
+
+
+def _scale_masks(masks, src_shape, dst_shape):
+    """
+    低分辨率mask logits (N, h, w) 映射回原图尺寸 (N, H, W)，与 ultralytics 的 ops.scale_masks 一致:
+    去掉右侧和下方的填充后双线性插值；内容边界落在像素中间时按精确范围采样
+    """
+    gain = min(i / o for i, o in zip(dst_shape, src_shape))
+    ratio = [round(o * gain) * m / i / o for o, m, i in zip(src_shape, masks.shape[1:], dst_shape)]
+    (gain_h, gain_w), (im1_h, im1_w), (im0_h, im0_w) = ratio, masks.shape[1:], src_shape
+    masks = masks[None].float()
+    if (im1_h, im1_w) == (im0_h, im0_w):
+        return masks[0]
+    bottom, right = round(im0_h * gain_h), round(im0_w * gain_w)
+    if abs(im0_h * gain_h - bottom) + abs(im0_w * gain_w - right) > 1e-3:
+        sh, sw = im0_h * gain_h / im1_h, im0_w * gain_w / im1_w
+        theta = masks.new_tensor([[[sw, 0, sw - 1], [0, sh, sh - 1]]])
+        grid = F.affine_grid(theta, (1, 1, im0_h, im0_w), align_corners=False)
+        return F.grid_sample(masks, grid, mode="bilinear", padding_mode="border", align_corners=False)[0]
+    return F.interpolate(masks[..., :bottom, :right], (im0_h, im0_w), mode="bilinear")[0]
+
+
+def _masks_to_boxes(masks):
+    """bool mask (N, H, W) 的外接框 (N, 4) [x1, y1, x2, y2]，空mask为全0"""
+    n, h, w = masks.shape
+    rows, cols = masks.any(dim=2), masks.any(dim=1)
+    y = torch.arange(h, dtype=torch.float32)
+    x = torch.arange(w, dtype=torch.float32)
+    y2 = (rows * y).amax(dim=1)
+    x2 = (cols * x).amax(dim=1)
+    y1 = torch.where(rows, y, torch.full_like(y, h)).amin(dim=1)
+    x1 = torch.where(cols, x, torch.full_like(x, w)).amin(dim=1)
+    empty = ~rows.any(dim=1)
+    boxes = torch.stack([x1, y1, x2, y2], dim=1)
+    boxes[empty] = 0
+    return boxes
@@ -0,0 +1,193 @@
+"""
+多进程分片运行
+
+  - workers: 在本机启动 N 个进程，每个进程加载自己的模型并使用固定数量的线程
+  - shard:   只处理排序后图片列表的第 i 片（共 N 片），多台机器无需协调即可分担同一个文件夹
+"""
+
+import multiprocessing as mp
+import os
+import queue
+from contextlib import contextmanager
+from itertools import islice
+
+_THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS')
+
+
+def parse_shard(text):
+    """
+    解析分片参数 "i/N"（i 从 0 开始）
+
+    返回:
+        (i, N)
+    """
+    try:
+        index, count = (int(x) for x in text.split('/'))
+    except ValueError:
+        raise ValueError(f"分片格式应为 i/N，例如 0/4，实际为 '{text}'")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"分片编号应满足 0 <= i < N，实际为 '{text}'")
+    return index, count
+
+
+def select_shard(image_files, index, count):
+    """取出第 index 片（交错分配，各片的图片数最多相差1；流式输入返回生成器）"""
+    if not isinstance(image_files, list):
+        return islice(image_files, index, None, count)
+    return image_files[index::count]
+
+
+def default_threads(workers):
+    """每个进程默认分到的线程数"""
+    return max(1, _available_cpus() // workers)
+
+
+def run_parallel(image_files, output_folder, prompt_fn, workers, model_path="mobile_sam.pt",
+                 threads=None, verify="mtime", profile=False, stats_log=None, run_id=None,
+                 **generator_kwargs):
+    """
+    多进程处理图片列表
+
+    参数:
+        image_files: 图片路径列表
+        output_folder: 输出mask文件夹路径
+        prompt_fn: 可序列化的提示函数（例如 BatchMaskGenerator.auto_prompts 的 partial）
+        workers: 进程数
+        model_path: 模型文件路径
+        threads: 每个进程的 torch/OpenCV 线程数（默认: CPU核数/进程数）
+        verify: 完成清单判断输入是否改变的方式，见 RunManifest
+        profile: 每个进程用 cProfile 分析，结果保存为输出目录中的 profile_worker<i>.prof
+        stats_log: 阶段耗时日志路径，所有进程追加到同一个文件（None 表示不记录）
+        run_id: 阶段耗时日志中本次运行的标识，见 run_report.StageRecorder
+        generator_kwargs: 传给每个进程的 BatchMaskGenerator 的参数（batch_size、cache_dir 等）
+
+    返回:
+        合并后的统计字典 {'success', 'decode_count', 'decode_seconds'}
+    """
+    total = len(image_files)
+    threads = threads or default_threads(workers)
+    print(f"启动 {workers} 个进程, 每个进程 {threads} 个线程\n")
+
+    # spawn 启动的子进程各自初始化 torch，避免 fork 继承父进程的线程池
+    ctx = mp.get_context('spawn')
+    progress_q = ctx.Queue()
+    processes = {}
+    with _thread_env(threads):
+        for worker_id in range(workers):
+            files = image_files[worker_id::workers]
+            if not files:
+                continue
+            p = ctx.Process(target=_worker, daemon=True,
+                            args=(worker_id, files, output_folder, prompt_fn, model_path,
+                                  threads, verify, profile, stats_log, run_id, generator_kwargs,
+                                  progress_q))
+            p.start()
+            processes[worker_id] = p
+
+    # 合并各进程的进度
+    stats = {'success': 0, 'decode_count': 0, 'decode_seconds': 0.0}
+    done = 0
+    running = set(processes)
+    while running:
+        try:
+            msg = progress_q.get(timeout=1.0)
+        except queue.Empty:
+            # 进程异常退出时不会发送结束消息
+            for worker_id in [w for w in running if not processes[w].is_alive()]:
+                print(f"  ✗ 进程 {worker_id} 异常退出 (exit code {processes[worker_id].exitcode})")
+                running.discard(worker_id)
+            continue
+
+        kind, worker_id = msg[0], msg[1]
+        if kind == 'result':
+            _, _, name, ok, message = msg
+            done += 1
+            print(f"[{done}/{total}] {name}  {message}")
+        elif kind == 'done':
+            for key in stats:
+                stats[key] += msg[2][key]
+            running.discard(worker_id)
+        elif kind == 'error':
+            print(f"  ✗ 进程 {worker_id} 出错: {msg[2]}")
+            running.discard(worker_id)
+
+    for p in processes.values():
+        p.join()
+    return stats
+
+
+def _worker(worker_id, image_files, output_folder, prompt_fn, model_path, threads, verify, profile,
+            stats_log, run_id, generator_kwargs, progress_q):
+    """子进程入口：固定线程数，加载模型，处理分到的图片"""
+    try:
+        _pin_threads(worker_id, threads)
+
+        from batch_mask import BatchMaskGenerator, manifest_key
+        from contextlib import nullcontext
+        from manifest import RunManifest
+        from run_report import StageRecorder, profiled
+
+        # 线程数已由 _pin_threads 固定，不在各进程中调优（同时测量会互相干扰）
+        generator = BatchMaskGenerator(model_path, **{'num_readers': 1, 'num_writers': 1, **generator_kwargs,
+                                                      'autotune': False})
+        tiler = generator.tiler
+        tile = (tiler.tile_size, tiler.overlap) if tiler is not None else None
+        manifest = RunManifest(output_folder, model_path,
+                               manifest_key(prompt_fn, generator.combine, generator.output_format,
+                                            tile=tile, variant=generator.variant),
+                               verify=verify, image_prompt=getattr(prompt_fn, "digest", None))
+
+        def on_result(idx, image_path, ok, message):
+            progress_q.put(('result', worker_id, image_path.name, ok, message))
+
+        recorder = StageRecorder(stats_log, run_id) if stats_log else None
+        profile_path = os.path.join(output_folder, f"profile_worker{worker_id}.prof")
+        with profiled(profile_path, top=0) if profile else nullcontext():
+            stats = generator.process_files(image_files, output_folder, prompt_fn, on_result, manifest,
+                                            recorder)
+        progress_q.put(('done', worker_id, stats))
+    except Exception as e:
+        progress_q.put(('error', worker_id, str(e)))
+
+
+def _pin_threads(worker_id, threads):
+    """限制本进程的线程数，CPU 够用时把进程绑定到互不重叠的核心上"""
+    import cv2
+    import torch
+
+    if hasattr(os, 'sched_setaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+        start = worker_id * threads
+        if start + threads <= len(cpus):
+            os.sched_setaffinity(0, cpus[start:start + threads])
+
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # 已经开始过并行计算时不能再修改
+    cv2.setNumThreads(threads)
+
+
+def _available_cpus():
+    """当前进程可用的CPU核数"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+@contextmanager
+def _thread_env(threads):
+    """子进程启动期间设置线程数环境变量（子进程导入 torch 时生效）"""
+    saved = {k: os.environ.get(k) for k in _THREAD_ENV_VARS}
+    for k in _THREAD_ENV_VARS:
+        os.environ[k] = str(threads)
+    try:
+        yield
+    finally:
+        for k, v in saved.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
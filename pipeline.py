@@ -0,0 +1,240 @@
+"""
+流水线批量推理引擎
+
+三个阶段并行工作，阶段之间用有界队列连接（队列满时上游自动等待）:
+  0. 输入线程: 逐个取出输入项（可以是边枚举边产生的生成器，见 image_sources）
+  1. 读取线程池: 解码图片并预处理成编码器输入
+  2. 模型阶段: 按批次运行图像编码器，再逐张运行提示解码器
+  3. 写入线程池: 合并mask并保存（PNG 或分片格式，见 mask_sinks）
+"""
+
+import queue
+import threading
+import time
+
+import numpy as np
+
+from image_io import read_image
+from mask_combine import combine_masks, extract_masks
+from mask_sinks import PngSink
+
+_DONE = object()  # 队列结束标记
+
+
+def image_prompts(prompt_fn, image_path, w, h):
+    """
+    取出一张图片的提示参数
+
+    普通的提示函数只依赖图片尺寸 prompt_fn(w, h)；per_image 为 True 的提示函数
+    （例如 prompt_journal.JournalPrompts）每张图片不同，调用时额外传入图片。
+    """
+    if getattr(prompt_fn, "per_image", False):
+        return prompt_fn(w, h, image_path)
+    return prompt_fn(w, h)
+
+
+class MaskPipeline:
+    def __init__(self, session, batch_size=4, num_readers=2, num_writers=2, queue_size=16,
+                 combine="union"):
+        """
+        初始化流水线
+
+        参数:
+            session: SAMSession
+            batch_size: 每次编码器调用处理的图片数
+            num_readers: 读取线程数
+            num_writers: 写入线程数
+            queue_size: 阶段之间队列的容量
+            combine: 多个mask的合并方式，见 mask_combine.combine_masks
+        """
+        self.session = session
+        self.batch_size = max(1, batch_size)
+        self.num_readers = max(1, num_readers)
+        self.num_writers = max(1, num_writers)
+        self.queue_size = max(queue_size, self.batch_size)
+        self.combine = combine
+        self.decode_count = 0      # 上一次 run 解码成功的图片数
+        self.decode_seconds = 0.0  # 上一次 run 所有读取线程的解码耗时之和
+        self.input_count = 0       # 上一次 run 取出的输入项数
+
+    def run(self, image_files, output_folder, prompt_fn, on_result=None, on_saved=None, recorder=None,
+            sink=None):
+        """
+        处理图片列表
+
+        参数:
+            image_files: 图片路径列表，或逐个产生输入项的可迭代对象（见 image_sources.open_source），
+                         生成器边产生边处理，不需要先列出全部图片
+            output_folder: 输出mask文件夹路径
+            prompt_fn: prompt_fn(w, h) -> dict，返回传给 session.decode 的提示参数
+            on_result: 每张图片处理结束时的回调 on_result(idx, image_path, ok, message)，
+                       默认打印到控制台
+            on_saved: mask保存成功后的回调 on_saved(image_path, output_path)，在写入线程中调用
+            recorder: run_report.StageRecorder，记录每张图片各阶段的耗时（None 表示不记录）
+            sink: mask写入器，见 mask_sinks.make_sink（默认每张图片一个PNG），结束时关闭
+
+        返回:
+            成功保存的mask数量
+        """
+        total = len(image_files) if hasattr(image_files, '__len__') else None
+        task_q = queue.Queue(maxsize=self.queue_size)
+        read_q = queue.Queue(maxsize=self.queue_size)
+        write_q = queue.Queue(maxsize=self.queue_size)
+        self._lock = threading.Lock()
+        self._success_count = 0
+        self._on_result = on_result
+        self._on_saved = on_saved
+        self._recorder = recorder
+        self._sink = sink if sink is not None else PngSink(output_folder)
+        self.decode_count = 0
+        self.decode_seconds = 0.0
+        self.input_count = 0
+
+        feeder = threading.Thread(target=self._feed, args=(image_files, task_q), daemon=True)
+        readers = [threading.Thread(target=self._reader, args=(task_q, read_q, total), daemon=True)
+                   for _ in range(self.num_readers)]
+        writers = [threading.Thread(target=self._writer, args=(write_q, total), daemon=True)
+                   for _ in range(self.num_writers)]
+        for t in [feeder] + readers + writers:
+            t.start()
+
+        self._model_stage(read_q, write_q, prompt_fn, total)
+
+        for t in [feeder] + readers:
+            t.join()
+        for _ in range(self.num_writers):
+            write_q.put(_DONE)
+        for t in writers:
+            t.join()
+        self._sink.close()
+
+        return self._success_count
+
+    def _feed(self, image_files, task_q):
+        """输入线程：逐个取出输入项放入任务队列（队列满时等待，生成器不会被提前读完）"""
+        try:
+            for idx, image_path in enumerate(image_files, 1):
+                task_q.put((idx, image_path))
+                self.input_count = idx
+        except Exception as e:
+            print(f"  ✗ 读取输入出错，停止读取: {e}")
+        finally:
+            for _ in range(self.num_readers):
+                task_q.put(_DONE)
+
+    def _reader(self, task_q, read_q, total):
+        """读取线程：解码图片并预处理"""
+        while True:
+            task = task_q.get()
+            if task is _DONE:
+                read_q.put(_DONE)
+                return
+            idx, image_path = task
+            try:
+                image, seconds = read_image(image_path)
+                with self._lock:
+                    self.decode_seconds += seconds
+                    self.decode_count += image is not None
+                self._record(image_path, "read", seconds)
+                if image is None:
+                    self._report(idx, total, image_path, False, f"✗ 无法读取图片，跳过")
+                    continue
+                # 磁盘缓存命中的图片不需要编码器输入
+                key = self.session.cache_key(image_path)
+                start = time.perf_counter()
+                inputs = None if self.session.is_cached(key) else self.session.preprocess(image)
+                self._record(image_path, "preprocess", time.perf_counter() - start)
+                read_q.put((idx, image_path, image, inputs, key))
+            except Exception as e:
+                self._report(idx, total, image_path, False, f"✗ 错误: {e}")
+
+    def _report(self, idx, total, image_path, ok, message):
+        """报告一张图片的处理结果"""
+        if ok:
+            with self._lock:
+                self._success_count += 1
+        if self._recorder is not None:
+            self._recorder.finish(image_path, ok, message)
+        if self._on_result is not None:
+            self._on_result(idx, image_path, ok, message)
+        else:
+            progress = f"{idx}/{total}" if total is not None else idx
+            print(f"[{progress}] {image_path.name}  {message}")
+
+    def _record(self, image_path, stage, seconds):
+        """记录一个阶段的耗时"""
+        if self._recorder is not None:
+            self._recorder.add(image_path, stage, seconds)
+
+    def _model_stage(self, read_q, write_q, prompt_fn, total):
+        """模型阶段：攒够一批后编码，再逐张解码"""
+        finished_readers = 0
+        while finished_readers < self.num_readers:
+            batch = []
+            # 阻塞等待第一张，之后只取已经就绪的，不为凑满批次而等待
+            while len(batch) < self.batch_size and finished_readers < self.num_readers:
+                try:
+                    item = read_q.get(block=not batch)
+                except queue.Empty:
+                    break
+                if item is _DONE:
+                    finished_readers += 1
+                else:
+                    batch.append(item)
+            if batch:
+                self._process_batch(batch, write_q, prompt_fn, total)
+
+    def _process_batch(self, batch, write_q, prompt_fn, total):
+        """编码一批图片并为每张生成mask"""
+        try:
+            start = time.perf_counter()
+            embeddings = self.session.encode_batch(
+                [item[2] for item in batch],
+                [item[1] for item in batch],
+                inputs=[item[3] for item in batch],
+                keys=[item[4] for item in batch],
+            )
+        except Exception as e:
+            for idx, image_path, *_ in batch:
+                self._report(idx, total, image_path, False, f"✗ 错误: {e}")
+            return
+        encode_seconds = (time.perf_counter() - start) / len(batch)
+
+        for (idx, image_path, image, *_), embedding in zip(batch, embeddings):
+            try:
+                self._record(image_path, "encode", encode_seconds)
+                h, w = image.shape[:2]
+                start = time.perf_counter()
+                results = self.session.decode(embedding, **image_prompts(prompt_fn, image_path, w, h))
+                self._record(image_path, "decode", time.perf_counter() - start)
+                if results and len(results) > 0:
+                    masks, scores = extract_masks(results[0])
+                    if masks is not None:
+                        write_q.put((idx, image_path, masks, scores))
+                    else:
+                        self._report(idx, total, image_path, False, f"✗ 未检测到mask")
+                else:
+                    self._report(idx, total, image_path, False, f"✗ 处理失败")
+            except Exception as e:
+                self._report(idx, total, image_path, False, f"✗ 错误: {e}")
+
+    def _writer(self, write_q, total):
+        """写入线程：合并mask并保存"""
+        while True:
+            item = write_q.get()
+            if item is _DONE:
+                return
+            idx, image_path, masks, scores = item
+            try:
+                start = time.perf_counter()
+                binary_mask = combine_masks(masks, scores, self.combine)
+                self._record(image_path, "combine", time.perf_counter() - start)
+                start = time.perf_counter()
+                output_name = self._sink.write(image_path, binary_mask, self._on_saved)
+                self._record(image_path, "write", time.perf_counter() - start)
+                if self._recorder is not None:
+                    self._recorder.set(image_path, masks=len(masks),
+                                       mask_pixels=int(np.count_nonzero(binary_mask)))
+                self._report(idx, total, image_path, True, f"✓ 已保存: {output_name}")
+            except Exception as e:
+                self._report(idx, total, image_path, False, f"✗ 错误: {e}")
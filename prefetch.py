@@ -0,0 +1,106 @@
+"""
+后台预编码 - 用户标注当前图片时，提前读取并编码接下来的图片
+
+只使用一个后台线程（编码器本身已经是多线程的），预读取的张数和占用的内存都有上限。
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+from image_io import probe_image_size, read_image
+
+
+class ImagePrefetcher:
+    def __init__(self, session, image_files, depth=1, max_memory_mb=512, recorder=None):
+        """
+        初始化预编码器
+
+        参数:
+            session: SAMSession，用于编码图片
+            image_files: 图片路径列表
+            depth: 最多提前编码几张图片（0 表示关闭预编码）
+            max_memory_mb: 预编码结果最多占用的内存 (MB)
+            recorder: run_report.StageRecorder，记录每张图片的 read / encode 耗时（None 表示不记录）
+        """
+        self.session = session
+        self.image_files = image_files
+        self.depth = depth
+        self.max_memory = max_memory_mb * 1024 * 1024
+        self.recorder = recorder
+        self._executor = ThreadPoolExecutor(max_workers=1) if depth > 0 else None
+        self._pending = {}  # index -> Future
+        self._feature_bytes = 0  # 单张图片特征的大小，编码第一张后得到
+
+    def _load(self, index):
+        """读取并编码一张图片，读取失败返回 None"""
+        image_path = self.image_files[index]
+        with self._timed(image_path, "read"):
+            image, _ = read_image(image_path)
+        if image is None:
+            return None
+        with self._timed(image_path, "encode"):
+            embedding = self.session.encode(image, image_path)
+        self._feature_bytes = _embedding_bytes(embedding) - image.nbytes
+        return embedding
+
+    def _timed(self, image_path, stage):
+        return self.recorder.time(image_path, stage) if self.recorder is not None else nullcontext()
+
+    def get(self, index):
+        """
+        获取第 index 张图片的编码结果，并丢弃更早的预编码结果
+
+        已预编码的直接返回；正在编码的等待完成；未安排的在当前线程编码。
+        """
+        for stale in [i for i in self._pending if i < index]:
+            self._pending.pop(stale).cancel()
+
+        future = self._pending.pop(index, None)
+        if future is not None:
+            return future.result()
+        return self._load(index)
+
+    def prefetch(self, index):
+        """在后台安排编码 index 之后的图片"""
+        if self._executor is None:
+            return
+
+        pending_bytes = sum(self._estimate_bytes(i) for i in self._pending)
+        for ahead in range(1, self.depth + 1):
+            next_index = index + ahead
+            if next_index >= len(self.image_files):
+                break
+            if next_index in self._pending:
+                continue
+            # 内存上限：只读文件头估算图片大小，至少保留一张预编码
+            item_bytes = self._estimate_bytes(next_index)
+            if self._pending and pending_bytes + item_bytes > self.max_memory:
+                break
+            pending_bytes += item_bytes
+            self._pending[next_index] = self._executor.submit(self._load, next_index)
+
+    def _estimate_bytes(self, index):
+        """估算第 index 张图片编码结果的内存占用（解码后的BGR图像 + 特征）"""
+        size = probe_image_size(self.image_files[index])
+        image_bytes = size[0] * size[1] * 3 if size is not None else 0
+        return image_bytes + self._feature_bytes
+
+    def close(self):
+        """取消未开始的预编码并释放结果"""
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+
+def _embedding_bytes(embedding):
+    """估算一个编码结果占用的内存"""
+    total = embedding.image.nbytes
+    features = embedding.features
+    tensors = features.values() if isinstance(features, dict) else [features]
+    for t in tensors:
+        items = t if isinstance(t, (list, tuple)) else [t]
+        for x in items:
+            total += x.numel() * x.element_size()
+    return total
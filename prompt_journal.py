@@ -0,0 +1,152 @@
+"""
+提示日志 - 记录交互标注的提示，之后无需重新标注即可用新模型或新输出格式重新生成mask
+
+日志是一个只追加的 JSON-lines 文件（默认为输出目录中的 prompts.jsonl），每保存一个mask追加一行
+（mask写入成功后才记录；模型没有返回mask时也记录，带 "saved": false）:
+    {"image": "/abs/path/000001.png", "size": [w, h], "boxes": [[x1, y1, x2, y2], ...],
+     "points": [[x, y], ...], "labels": [1, 0, ...], "time": ...}
+
+坐标都是原图坐标；没有的字段省略。同一张图片以最后一行为准（重新标注会覆盖之前的提示）。
+
+回放: batch_mask.py --replay prompts.jsonl 读取日志，把其中的图片和提示送进批量流水线
+（可以配合 --workers 多进程、--format、--tile 等），无人值守地重新生成所有mask。
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+from image_sources import input_key
+
+JOURNAL_NAME = "prompts.jsonl"
+
+
+class PromptJournal:
+    def __init__(self, path):
+        """
+        参数:
+            path: 日志文件路径（不存在时在第一次记录时创建）
+        """
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, image_path, size, boxes=None, points=None, labels=None, saved=True):
+        """
+        追加一张图片的提示（线程安全，每条记录一次写入）
+
+        参数:
+            image_path: 图片路径
+            size: 原图 (宽, 高)，回放时图片尺寸不同会按比例换算坐标
+            boxes: [[x1, y1, x2, y2], ...]
+            points / labels: [[x, y], ...] 和对应的标签（1 前景，0 背景）
+            saved: 是否保存了mask（False 表示模型没有返回mask，记录 "saved": false，回放时照常处理）
+        """
+        entry = {"image": input_key(image_path), "size": [int(size[0]), int(size[1])]}
+        if boxes:
+            entry["boxes"] = [[int(v) for v in box] for box in boxes]
+        if points:
+            entry["points"] = [[int(v) for v in point] for point in points]
+            entry["labels"] = [int(v) for v in labels] if labels is not None else [1] * len(points)
+        if not saved:
+            entry["saved"] = False
+        entry["time"] = round(time.time(), 3)
+
+        line = (json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # O_APPEND 单次写入，与 manifest 相同
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+
+
+def load_journal(path):
+    """
+    读取日志
+
+    返回:
+        {图片标识: 记录}，同一张图片以最后一行为准；顺序为图片第一次出现的顺序
+    """
+    entries = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # 进程被杀时可能留下不完整的最后一行
+            if entry.get("boxes") or entry.get("points"):
+                entries[entry["image"]] = entry
+    return entries
+
+
+def journal_inputs(entries):
+    """
+    日志中的图片
+
+    返回:
+        (存在的图片 Path 列表, 不存在的图片路径列表)
+    """
+    found, missing = [], []
+    for key in entries:
+        (found if os.path.isfile(key) else missing).append(key)
+    return [Path(key) for key in found], missing
+
+
+def entry_prompts(entry, w, h):
+    """
+    把一条记录转换成 session.decode 的提示参数
+
+    图片尺寸与记录时不同（例如换成了缩放过的图片）时按比例换算坐标。
+    """
+    rw, rh = entry.get("size") or (w, h)
+    sx, sy = w / rw, h / rh
+    prompts = {}
+    if entry.get("boxes"):
+        prompts["bboxes"] = [[x1 * sx, y1 * sy, x2 * sx, y2 * sy] for x1, y1, x2, y2 in entry["boxes"]]
+    if entry.get("points"):
+        prompts["points"] = [[x * sx, y * sy] for x, y in entry["points"]]
+        prompts["labels"] = entry["labels"]
+    return prompts
+
+
+def prompt_digest(entry):
+    """一条记录中提示的摘要（不含时间），用于判断重新标注后是否需要重新生成"""
+    prompts = {k: entry[k] for k in ("size", "boxes", "points", "labels") if k in entry}
+    text = json.dumps(prompts, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+class JournalPrompts:
+    """
+    按图片取出日志中提示的提示函数（可序列化，可传给子进程）
+
+    与 BatchMaskGenerator.auto_prompts 等 prompt_fn(w, h) 不同，每张图片的提示不同，
+    per_image = True 告诉流水线调用时额外传入图片，见 pipeline.image_prompts。
+    """
+
+    per_image = True
+
+    def __init__(self, entries):
+        """
+        参数:
+            entries: load_journal 的返回值
+        """
+        self.entries = entries
+
+    def __call__(self, w, h, image_path):
+        entry = self.entries.get(input_key(image_path))
+        if entry is None:
+            raise ValueError(f"提示日志中没有这张图片: {image_path}")
+        return entry_prompts(entry, w, h)
+
+    def digest(self, image_path):
+        """图片提示的摘要，追加到完成清单的提示描述中（见 manifest.RunManifest 的 image_prompt）"""
+        entry = self.entries.get(input_key(image_path))
+        return prompt_digest(entry) if entry is not None else None
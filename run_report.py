@@ -0,0 +1,251 @@
+"""
+运行统计 - 记录每张图片各阶段的耗时，生成机器可读的运行报告
+
+每张图片处理结束时向 JSON-lines 日志追加一行:
+    {"run": ..., "input": ..., "ok": ..., "stages": {"read": ..., "encode": ...},
+     "masks": ..., "mask_pixels": ..., "peak_rss_mb": ..., "pid": ...}
+
+阶段:
+  read        读取并解码图片 (cv2.imread)
+  preprocess  预处理成编码器输入
+  encode      图像编码器（按批次运行，耗时平均分给批次中的每张图片）
+  decode      提示编码器 + mask解码器
+  combine     合并mask并转换为 numpy 数组（包括 .cpu().numpy()）
+  write       保存mask（PNG 或分片格式，见 mask_sinks）
+
+多个进程可以同时追加同一个日志，运行结束后由 summarize 读取日志汇总。
+"""
+
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from image_sources import input_key
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+STAGES = ("read", "preprocess", "encode", "decode", "combine", "write")
+STATS_LOG_NAME = "stats.jsonl"
+STATS_SUMMARY_NAME = "stats_summary.json"
+PROFILE_NAME = "profile.prof"
+
+
+class StageRecorder:
+    def __init__(self, log_path, run_id=None):
+        """
+        打开（或创建）统计日志
+
+        参数:
+            log_path: JSON-lines 日志路径
+            run_id: 本次运行的标识，多进程运行时所有进程使用同一个（默认自动生成）
+        """
+        self.log_path = log_path
+        self.run_id = run_id or new_run_id()
+        self._lock = threading.Lock()
+        self._records = {}  # 图片路径 -> 未完成的记录
+
+    def _record(self, image_path):
+        key = str(image_path)
+        record = self._records.get(key)
+        if record is None:
+            record = self._records[key] = {"stages": {}}
+        return record
+
+    def add(self, image_path, stage, seconds):
+        """记录一个阶段的耗时（同一阶段多次调用时累加）"""
+        with self._lock:
+            stages = self._record(image_path)["stages"]
+            stages[stage] = stages.get(stage, 0.0) + seconds
+
+    def set(self, image_path, **fields):
+        """记录其他字段，例如 masks / mask_pixels"""
+        with self._lock:
+            self._record(image_path).update(fields)
+
+    @contextmanager
+    def time(self, image_path, stage):
+        """计时上下文"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(image_path, stage, time.perf_counter() - start)
+
+    def finish(self, image_path, ok, message=""):
+        """图片处理结束：追加一行日志（线程安全，每条记录一次写入）"""
+        with self._lock:
+            record = self._records.pop(str(image_path), {"stages": {}})
+        entry = {
+            "run": self.run_id,
+            "input": input_key(image_path),
+            "ok": ok,
+            "message": message,
+            "stages": {k: round(v, 6) for k, v in record.pop("stages").items()},
+            **record,
+            "peak_rss_mb": peak_rss_mb(),
+            "pid": os.getpid(),
+            "time": time.time(),
+        }
+        line = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock:
+            # O_APPEND 单次写入，多个进程同时追加也不会交错
+            fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+
+
+def new_run_id():
+    """生成运行标识"""
+    return time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:8]
+
+
+def peak_rss_mb():
+    """本进程的峰值常驻内存 (MB)，不支持的平台返回 None"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位为 KB，macOS 为字节
+    if os.uname().sysname == "Darwin":
+        return round(peak / 1024 / 1024, 1)
+    return round(peak / 1024, 1)
+
+
+def percentile(sorted_values, q):
+    """已排序列表的百分位数（线性插值）"""
+    if not sorted_values:
+        return 0.0
+    pos = (len(sorted_values) - 1) * q / 100
+    lower = int(pos)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (pos - lower)
+
+
+def summarize(log_path, run_id, elapsed):
+    """
+    读取日志中属于 run_id 的记录，汇总各阶段耗时
+
+    参数:
+        log_path: JSON-lines 日志路径
+        run_id: 运行标识
+        elapsed: 整次运行的墙钟时间（秒），用于计算吞吐
+
+    返回:
+        汇总字典
+    """
+    entries = []
+    with open(log_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if entry.get("run") == run_id:
+                entries.append(entry)
+
+    stage_times = {}
+    for entry in entries:
+        for stage, seconds in entry["stages"].items():
+            stage_times.setdefault(stage, []).append(seconds)
+    ordered = [s for s in STAGES if s in stage_times] + sorted(set(stage_times) - set(STAGES))
+
+    stages = {}
+    for stage in ordered:
+        values = sorted(stage_times[stage])
+        stages[stage] = {
+            "count": len(values),
+            "total_s": round(sum(values), 4),
+            "mean_ms": round(sum(values) / len(values) * 1000, 2),
+            "p50_ms": round(percentile(values, 50) * 1000, 2),
+            "p95_ms": round(percentile(values, 95) * 1000, 2),
+            "p99_ms": round(percentile(values, 99) * 1000, 2),
+        }
+
+    ok = [e for e in entries if e["ok"]]
+    rss = [e["peak_rss_mb"] for e in entries if e.get("peak_rss_mb") is not None]
+    return {
+        "run": run_id,
+        "images": len(entries),
+        "success": len(ok),
+        "elapsed_s": round(elapsed, 3),
+        "images_per_s": round(len(entries) / elapsed, 3) if elapsed > 0 else 0.0,
+        "peak_rss_mb": max(rss) if rss else None,
+        "mask_pixels": sum(e.get("mask_pixels", 0) for e in ok),
+        "stages": stages,
+    }
+
+
+def print_report(summary):
+    """打印阶段耗时汇总"""
+    print(f"\n阶段耗时 (ms/张):")
+    print(f"  {'阶段':<12}{'次数':>6}{'平均':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'合计(s)':>10}")
+    for stage, s in summary["stages"].items():
+        print(f"  {stage:<12}{s['count']:>6}{s['mean_ms']:>10.1f}{s['p50_ms']:>10.1f}"
+              f"{s['p95_ms']:>10.1f}{s['p99_ms']:>10.1f}{s['total_s']:>10.2f}")
+    print(f"吞吐: {summary['images_per_s']:.2f} 张/秒")
+    if summary["peak_rss_mb"] is not None:
+        print(f"峰值内存 (单进程): {summary['peak_rss_mb']:.0f} MB")
+    print(f"mask像素总数: {summary['mask_pixels']}")
+
+
+def save_report(log_path, run_id, elapsed, output_folder):
+    """汇总本次运行的阶段耗时，保存到输出目录的 stats_summary.json 并打印；日志为空时返回 None"""
+    if not os.path.exists(log_path):
+        return None
+    summary = summarize(log_path, run_id, elapsed)
+    summary_path = os.path.join(output_folder, STATS_SUMMARY_NAME)
+    with open(summary_path, "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    print_report(summary)
+    print(f"阶段统计已保存: {log_path}, {summary_path}\n")
+    return summary
+
+
+@contextmanager
+def profiled(path, top=20):
+    """
+    用 cProfile 分析代码块，结果保存到 path，并打印累计耗时最多的函数
+
+    代码块中启动的线程（读取/写入线程、监视模式的扫描和处理线程）各用一个 cProfile，
+    结束时与当前线程的结果合并。只分析当前进程；多进程运行时每个进程各保存一个文件。
+    """
+    profiler = cProfile.Profile()
+    thread_profilers = []
+    lock = threading.Lock()
+
+    def start_thread_profiler(frame, event, arg):
+        # 新线程的第一个事件: 换成这个线程自己的 profiler（enable 替换掉本钩子）
+        sys.setprofile(None)
+        thread_profiler = cProfile.Profile()
+        try:
+            thread_profiler.enable()
+        except ValueError:
+            return  # Python 3.12+ 的 cProfile 基于 sys.monitoring，主 profiler 已经覆盖所有线程
+        with lock:
+            thread_profilers.append(thread_profiler)
+
+    threading.setprofile(start_thread_profiler)
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        threading.setprofile(None)
+        stats = pstats.Stats(profiler)
+        with lock:
+            for thread_profiler in thread_profilers:
+                stats.add(thread_profiler)  # 仍在运行的守护线程在这里停止记录
+        stats.dump_stats(path)
+        if top:
+            print(f"\n性能分析结果已保存: {path} (包括 {len(thread_profilers)} 个后台线程)")
+            stats.sort_stats("cumulative").print_stats(top)
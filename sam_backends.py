@@ -0,0 +1,159 @@
+"""
+推理后端 - SAMSession 背后可以替换的模型运行时
+
+SAMSession 只通过 predictor 的以下接口使用模型，任何提供这些接口的后端都可以替换:
+    predictor.device / predictor.imgsz
+    predictor.preprocess([image])                 -> 编码器输入 (1, 3, S, S)
+    predictor.get_im_features(batch)              -> 图像特征（embedding）
+    predictor.inference_features(features, src_shape, dst_shape, bboxes, points, labels,
+                                 multimask_output=...) -> (masks, boxes)
+ultralytics 模型由 SAMSession 直接创建 predictor，其他后端的模型对象提供 make_predictor(imgsz, conf)。
+
+可用的后端 (--backend):
+  ultralytics  默认，ultralytics SAM 的 PyTorch 模型，支持 cpu_fastpath 的 bf16 / int8 / channels_last
+  onnx         导出的编码器和解码器两个 ONNX 图，在 ONNX Runtime CPU 上运行，支持 int8，见 onnx_backend
+
+本模块不在顶层导入 torch / ultralytics，入口脚本可以先用 BACKENDS / PRECISIONS 检查参数，再加载模型。
+"""
+
+import time
+
+import numpy as np
+
+BACKENDS = ("ultralytics", "onnx")
+PRECISIONS = ("fp32", "bf16", "int8")
+
+
+def load_model(model_path, backend="ultralytics", precision="fp32", channels_last=False, onnx_dir=None):
+    """
+    加载模型，返回可以传给 SAMSession 的模型对象
+
+    参数:
+        model_path: .pt 模型文件路径（onnx 后端第一次使用时从它导出）
+        backend: ultralytics / onnx
+        precision: 图像编码器的精度 fp32 / bf16 / int8（onnx 后端不支持 bf16）
+        channels_last: 图像编码器使用 channels_last 内存布局（只对 ultralytics 后端有效）
+        onnx_dir: onnx 后端的导出目录（默认为模型旁边的 <模型名>_onnx/）
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"不支持的后端: {backend}，可选 {', '.join(BACKENDS)}")
+    if backend == "onnx":
+        from onnx_backend import OnnxSAM
+        return OnnxSAM.load(model_path, onnx_dir, precision)
+
+    from ultralytics import SAM
+    from cpu_fastpath import optimize_model
+    return optimize_model(SAM(model_path), precision, channels_last)
+
+
+def open_session(model_path, backend="ultralytics", precision="fp32", channels_last=False, autotune=False,
+                 onnx_dir=None, cache_dir=None, cache_size_mb=4096):
+    """
+    加载模型并创建推理会话（各入口脚本共用，可以在 model_loader.BackgroundLoader 的后台线程中运行）
+
+    参数:
+        model_path / backend / precision / channels_last / onnx_dir: 同 load_model
+        autotune: 启动时自动选择 torch 线程数（只用于 ultralytics 后端），见 cpu_fastpath
+        cache_dir: 磁盘embedding缓存目录（None 表示不使用缓存）
+        cache_size_mb: 磁盘embedding缓存的大小上限 (MB)
+
+    返回:
+        SAMSession
+    """
+    from cpu_fastpath import autotune_threads, describe
+    from embedding_cache import EmbeddingCache
+    from sam_session import SAMSession
+
+    model = load_model(model_path, backend, precision, channels_last, onnx_dir)
+    if backend != "ultralytics":
+        print(f"  推理后端: {backend} ({precision})")
+    elif precision != "fp32" or channels_last:
+        print(f"  CPU 加速: {describe(precision, channels_last)}")
+    if autotune and backend == "ultralytics":
+        autotune_threads(model, precision=precision, channels_last=channels_last)
+    elif autotune:
+        print(f"  {backend} 后端不支持线程自动调优，使用 --threads 指定线程数")
+    cache = EmbeddingCache(cache_dir, model_path, max_size_mb=cache_size_mb,
+                           variant=model_variant(precision, backend)) if cache_dir else None
+    return SAMSession(model, cache=cache)
+
+
+def model_variant(precision="fp32", backend="ultralytics"):
+    """
+    会改变编码结果的设置的标识，用于区分 embedding 缓存和完成清单（ultralytics + fp32 返回 None）
+
+    channels_last 只改变内存布局，结果与 fp32 一致，不计入。
+    """
+    parts = [p for p in (backend if backend != "ultralytics" else None,
+                         precision if precision != "fp32" else None) if p]
+    return "-".join(parts) or None
+
+
+def mask_iou(a, b):
+    """两个二值mask的IoU（都为空时为 1）"""
+    union = np.count_nonzero(a | b)
+    return np.count_nonzero(a & b) / union if union else 1.0
+
+
+def compare_sessions(reference, candidate, images, prompt_fn=None):
+    """
+    在同一批图片上比较两个推理会话（不同后端或精度）的速度和mask差异
+
+    参数:
+        reference / candidate: SAMSession
+        images: BGR图像列表
+        prompt_fn: prompt_fn(w, h) -> dict（默认用中心80%的框）
+
+    返回:
+        {'images', 'reference_encode_ms', 'candidate_encode_ms', 'reference_decode_ms', 'candidate_decode_ms',
+         'encode_speedup', 'decode_speedup', 'iou_mean', 'iou_min'}，耗时为每张图片的中位数
+    """
+    from mask_combine import combine_masks, extract_masks
+
+    if prompt_fn is None:
+        def prompt_fn(w, h):
+            return {"bboxes": [[w * 0.1, h * 0.1, w * 0.9, h * 0.9]]}
+
+    sessions = {"reference": reference, "candidate": candidate}
+    for session in sessions.values():
+        session.encode(images[0])  # 预热，排除首次调用的初始化开销
+    timings = {(name, stage): [] for name in sessions for stage in ("encode", "decode")}
+    ious = []
+    for image in images:
+        h, w = image.shape[:2]
+        masks = {}
+        for name, session in sessions.items():
+            start = time.perf_counter()
+            embedding = session.encode(image)
+            timings[name, "encode"].append(time.perf_counter() - start)
+            start = time.perf_counter()
+            result = session.decode(embedding, **prompt_fn(w, h))[0]
+            timings[name, "decode"].append(time.perf_counter() - start)
+            extracted, scores = extract_masks(result)
+            masks[name] = (combine_masks(extracted, scores, "union") > 0 if extracted is not None
+                           else np.zeros((h, w), dtype=bool))
+        ious.append(mask_iou(masks["reference"], masks["candidate"]))
+
+    report = {"images": len(images)}
+    for name, stage in timings:
+        report[f"{name}_{stage}_ms"] = round(float(np.median(timings[name, stage])) * 1000, 1)
+    for stage in ("encode", "decode"):
+        candidate_ms = report[f"candidate_{stage}_ms"]
+        report[f"{stage}_speedup"] = round(report[f"reference_{stage}_ms"] / candidate_ms, 3) if candidate_ms else None
+    report["iou_mean"] = round(float(np.mean(ious)), 4)
+    report["iou_min"] = round(float(np.min(ious)), 4)
+    return report
+
+
+def print_comparison(report, reference, candidate):
+    """
+    打印 compare_sessions 的结果
+
+    参数:
+        reference / candidate: 两个会话的名称
+    """
+    print(f"\n{candidate} 与 {reference} 比较 ({report['images']} 张):")
+    for stage, label in (("encode", "编码"), ("decode", "解码")):
+        print(f"  {label}耗时: {report[f'reference_{stage}_ms']:.1f} ms → {report[f'candidate_{stage}_ms']:.1f} ms/张 "
+              f"(加速 {report[f'{stage}_speedup']:.2f}x)")
+    print(f"  mask IoU: 平均 {report['iou_mean']:.4f}, 最低 {report['iou_min']:.4f}")
@@ -0,0 +1,328 @@
+"""
+SAM 推理会话 - 每张图片只运行一次图像编码器
+
+SAM 的推理由两部分组成:
+  - 图像编码器: 计算量大，只和图片有关
+  - 提示编码器 + mask解码器: 计算量小，和点/框提示有关
+
+SAMSession 把当前图片的 embedding 缓存起来，之后添加点、重画框、重置等
+提示变化都只运行解码器；切换到下一张图片时丢弃旧的 embedding。
+"""
+
+import os
+
+import numpy as np
+import torch
+from ultralytics.engine.results import Results
+from ultralytics.utils.checks import check_imgsz
+
+from mask_combine import mask_nms
+
+
+class ImageEmbedding:
+    """一张图片的编码结果"""
+
+    def __init__(self, image, features, image_path=None):
+        self.image = image            # 原始BGR图像 (H, W, 3)
+        self.features = features      # 图像编码器输出
+        self.image_path = image_path  # 图片路径（可选，仅用于结果显示）
+
+    @property
+    def orig_shape(self):
+        """原始图像尺寸 (h, w)"""
+        return self.image.shape[:2]
+
+
+class SAMSession:
+    def __init__(self, model, imgsz=1024, conf=0.25, cache=None):
+        """
+        初始化推理会话
+
+        参数:
+            model: 已加载的 ultralytics SAM 模型
+            imgsz: 编码器输入尺寸
+            conf: mask置信度阈值（与 SAM.predict 默认值一致）
+            cache: EmbeddingCache，编码前先查磁盘缓存（可选）
+        """
+        self.model = model
+        self.conf = conf
+        self.cache = cache
+        self.predictor = self._build_predictor(imgsz)
+        self.embedding = None  # 当前图片的 embedding
+
+    def _build_predictor(self, imgsz):
+        """
+        创建与 SAM 模型共享权重的 predictor
+
+        其他推理后端（例如 onnx_backend.OnnxSAM）通过 make_predictor 提供接口相同的 predictor，见 sam_backends。
+        """
+        if hasattr(self.model, "make_predictor"):
+            return self.model.make_predictor(imgsz, self.conf)
+        predictor_cls = self.model.task_map["segment"]["predictor"]
+        predictor = predictor_cls(overrides=dict(conf=self.conf, mode="predict", imgsz=imgsz,
+                                                 save=False, verbose=False))
+        predictor.setup_model(model=self.model.model, verbose=False)
+        # 不经过 setup_source，直接固定输入尺寸（较早的 ultralytics 版本 Predictor 没有 stride 属性）
+        predictor.imgsz = check_imgsz(imgsz, stride=getattr(predictor, "stride", 32), min_dim=2)
+        predictor.model.set_imgsz(predictor.imgsz)
+        return predictor
+
+    def preprocess(self, image):
+        """缩放并归一化图像，得到编码器输入 (1, 3, S, S)，可在读取线程中调用"""
+        with torch.inference_mode():
+            return self.predictor.preprocess([image])
+
+    def encode(self, image, image_path=None):
+        """
+        运行图像编码器（不修改会话状态，可在后台线程调用）
+
+        参数:
+            image: BGR图像 (H, W, 3)
+            image_path: 图片路径（可选）
+        """
+        return self.encode_batch([image], [image_path])[0]
+
+    def encode_batch(self, images, image_paths=None, inputs=None, keys=None):
+        """
+        一次编码器调用编码多张图片，磁盘缓存中已有的直接读取
+
+        参数:
+            images: BGR图像列表
+            image_paths: 图片路径列表（可选）
+            inputs: 已经 preprocess 过的编码器输入列表（可选，省去重复预处理，元素可为 None）
+            keys: 磁盘缓存键列表（可选，默认根据 image_paths 的文件内容计算）
+        """
+        n = len(images)
+        if image_paths is None:
+            image_paths = [None] * n
+        if inputs is None:
+            inputs = [None] * n
+        if keys is None:
+            keys = [self.cache_key(path) for path in image_paths]
+
+        features = [None] * n
+        if self.cache is not None:
+            for i, key in enumerate(keys):
+                if key is not None:
+                    cached = self.cache.get(key)
+                    if cached is not None:
+                        features[i] = cached.to(self.predictor.device)
+
+        missing = [i for i in range(n) if features[i] is None]
+        if missing:
+            with torch.inference_mode():
+                batch = torch.cat([inputs[i] if inputs[i] is not None else self.predictor.preprocess([images[i]])
+                                   for i in missing])
+                encoded = self.predictor.get_im_features(batch)
+            for j, i in enumerate(missing):
+                features[i] = _slice_features(encoded, j)
+                if self.cache is not None and keys[i] is not None:
+                    self.cache.put(keys[i], features[i])
+
+        return [ImageEmbedding(image, feats, path)
+                for image, feats, path in zip(images, features, image_paths)]
+
+    def cache_key(self, image_path):
+        """图片的磁盘缓存键，未启用缓存或没有路径时返回 None"""
+        if self.cache is None or image_path is None:
+            return None
+        return self.cache.key_for_file(image_path)
+
+    def is_cached(self, key):
+        """缓存中是否已有该图片的 embedding"""
+        return self.cache is not None and key is not None and self.cache.contains(key)
+
+    def set_image(self, image, image_path=None):
+        """编码新图片并设为当前图片"""
+        self.embedding = self.encode(image, image_path)
+        return self.embedding
+
+    def set_embedding(self, embedding):
+        """直接使用已编码好的 embedding 作为当前图片"""
+        self.embedding = embedding
+
+    def reset_image(self):
+        """丢弃当前图片的 embedding"""
+        self.embedding = None
+
+    def predict(self, points=None, labels=None, bboxes=None):
+        """使用当前图片的 embedding 生成mask，参数和返回值同 decode()"""
+        if self.embedding is None:
+            raise RuntimeError("请先调用 set_image() 编码图片")
+        return self.decode(self.embedding, points=points, labels=labels, bboxes=bboxes)
+
+    def decode(self, embedding, points=None, labels=None, bboxes=None, multimask_output=False,
+               per_point=False, min_score=0.8, nms_iou=0.7):
+        """
+        使用指定的 embedding 和提示生成mask，只运行提示编码器和解码器
+
+        参数:
+            embedding: encode() 返回的 ImageEmbedding
+            points: 点坐标 [[x, y], ...]，所有点共同构成一个提示
+            labels: 点标签 [1, 0, ...]，1为前景，0为背景
+            bboxes: 框坐标 [[x1, y1, x2, y2], ...]，每个框一个提示
+            multimask_output: 每个提示输出3个候选mask（配合 best 合并模式使用）
+            per_point: 每个点单独作为一个提示（网格分割物体），见 decode_per_point
+            min_score / nms_iou: per_point 模式的置信度阈值和去重IoU阈值
+
+        返回:
+            与 SAM.predict 相同的 Results 列表
+        """
+        if per_point:
+            return self.decode_per_point(embedding, points, multimask_output=multimask_output,
+                                         min_score=min_score, nms_iou=nms_iou)
+
+        bboxes, points, labels = self._prepare_prompts(points, labels, bboxes)
+        with torch.inference_mode():
+            masks, boxes = self.predictor.inference_features(
+                embedding.features,
+                embedding.orig_shape,
+                dst_shape=tuple(self.predictor.imgsz),
+                bboxes=bboxes,
+                points=points,
+                labels=labels,
+                multimask_output=multimask_output,
+            )
+
+        # 按 conf 过滤低置信度mask（自己过滤，不依赖 ultralytics 版本: 有的版本 SAM.predict 不过滤带提示的mask）
+        if masks is not None:
+            keep = boxes[:, 4] > self.conf
+            masks, boxes = masks[keep], boxes[keep]
+        return self._make_results(embedding, masks, boxes)
+
+    def decode_preview(self, embedding, points=None, labels=None, bboxes=None, low_res=256):
+        """
+        低分辨率快速解码，用于拖拽/悬停时的实时预览
+
+        mask 直接在长边 low_res 的尺寸下输出，不放大到原图，也不构造 Results。
+
+        参数:
+            embedding: encode() 返回的 ImageEmbedding
+            points / labels / bboxes: 原图坐标的提示，同 decode()
+            low_res: 预览mask的长边尺寸
+
+        返回:
+            (mask, score): (h, w) bool 数组（所有提示的mask并集）和最高置信度；没有mask时为 (None, 0.0)
+        """
+        bboxes, points, labels = self._prepare_prompts(points, labels, bboxes)
+        h, w = embedding.orig_shape
+        scale = min(1.0, low_res / max(h, w))
+        low_shape = (max(1, round(h * scale)), max(1, round(w * scale)))
+        with torch.inference_mode():
+            masks, boxes = self.predictor.inference_features(
+                embedding.features, low_shape, dst_shape=tuple(self.predictor.imgsz),
+                bboxes=bboxes * scale if bboxes is not None else None,
+                points=points * scale if points is not None else None,
+                labels=labels,
+            )
+            if masks is None:
+                return None, 0.0
+            keep = boxes[:, 4] > self.conf
+            if not keep.any():
+                return None, 0.0
+            return masks[keep].any(dim=0).cpu().numpy(), float(boxes[keep, 4].max())
+
+    def decode_per_point(self, embedding, points, multimask_output=False, min_score=0.8, nms_iou=0.7,
+                         chunk_size=64, low_res=128):
+        """
+        每个点单独作为一个提示，在一张图片的 embedding 上批量解码，得到多个物体的mask
+
+        先在低分辨率下解码全部点，过滤低置信度mask并用mask IoU去重，
+        只有保留下来的点才在原图分辨率下再解码一次。
+
+        参数:
+            embedding: encode() 返回的 ImageEmbedding
+            points: 点坐标 [[x, y], ...]，每个点一个提示（均为前景点）
+            multimask_output: 每个点输出3个候选mask，一起参与去重
+            min_score: 置信度阈值
+            nms_iou: 去重IoU阈值，与更高置信度mask的IoU超过该值的被去掉
+            chunk_size: 每次解码器调用的点数
+            low_res: 低分辨率解码的长边尺寸
+
+        返回:
+            与 SAM.predict 相同的 Results 列表，每个保留的物体一个mask
+        """
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+        h, w = embedding.orig_shape
+        scale = min(1.0, low_res / max(h, w))
+        low_shape = (max(1, round(h * scale)), max(1, round(w * scale)))
+        dst_shape = tuple(self.predictor.imgsz)
+        per = 3 if multimask_output else 1
+
+        with torch.inference_mode():
+            low_masks, scores = [], []
+            for start in range(0, len(points), chunk_size):
+                chunk = points[start:start + chunk_size]
+                masks, boxes = self.predictor.inference_features(
+                    embedding.features, low_shape, dst_shape=dst_shape,
+                    points=chunk * scale, labels=np.ones(len(chunk), dtype=np.int32),
+                    multimask_output=multimask_output,
+                )
+                low_masks.append(masks)
+                scores.append(boxes[:, 4])
+            low_masks = torch.cat(low_masks)
+            scores = torch.cat(scores)
+
+            # 过滤低置信度和空mask，再按mask IoU去重
+            candidates = ((scores > min_score) & low_masks.flatten(1).any(dim=1)).nonzero().flatten()
+            keep = candidates[mask_nms(low_masks[candidates], scores[candidates], nms_iou)]
+            if len(keep) == 0:
+                return self._make_results(embedding, None, torch.zeros((0, 6)))
+
+            # 只对保留的点在原图分辨率下解码
+            point_index = (keep // per).cpu().numpy()
+            masks, boxes = self.predictor.inference_features(
+                embedding.features, embedding.orig_shape, dst_shape=dst_shape,
+                points=points[point_index], labels=np.ones(len(point_index), dtype=np.int32),
+                multimask_output=multimask_output,
+            )
+            if per > 1:
+                select = torch.arange(len(keep), device=keep.device) * per + keep % per
+                masks, boxes = masks[select], boxes[select]
+        return self._make_results(embedding, masks, boxes)
+
+    @staticmethod
+    def _make_results(embedding, masks, boxes):
+        """把解码结果包装成 Results"""
+        if masks is not None and len(masks) == 0:
+            masks = None
+        names = dict(enumerate(str(i) for i in range(len(boxes))))
+        path = str(embedding.image_path) if embedding.image_path is not None else "image0.jpg"
+        return [Results(embedding.image, path=path, names=names, masks=masks, boxes=boxes)]
+
+    @staticmethod
+    def _prepare_prompts(points, labels, bboxes):
+        """整理提示格式：多个点合成一个提示，多个框时每个框都带上这些点"""
+        if points is not None and len(points) > 0:
+            points = np.asarray(points, dtype=np.float32).reshape(1, -1, 2)
+            if labels is None:
+                labels = np.ones(points.shape[1], dtype=np.int32)
+            labels = np.asarray(labels, dtype=np.int32).reshape(1, -1)
+        else:
+            points, labels = None, None
+
+        if bboxes is not None and len(bboxes) > 0:
+            bboxes = np.asarray(bboxes, dtype=np.float32).reshape(-1, 4)
+            if points is not None and len(bboxes) > 1:
+                points = np.repeat(points, len(bboxes), axis=0)
+                labels = np.repeat(labels, len(bboxes), axis=0)
+        else:
+            bboxes = None
+
+        return bboxes, points, labels
+
+
+def _slice_features(features, i):
+    """从批量编码结果中取出第 i 张图片的特征（保留 batch 维）"""
+    if isinstance(features, dict):  # SAM2 的多尺度特征
+        return {k: [x[i:i + 1] for x in v] if isinstance(v, (list, tuple)) else v[i:i + 1]
+                for k, v in features.items()}
+    return features[i:i + 1]
+
+
+def save_result_plot(result, image_path, save_dir="runs/segment/predict"):
+    """保存彩色结果图（替代 SAM.predict(save=True) 的输出）"""
+    os.makedirs(save_dir, exist_ok=True)
+    save_path = os.path.join(save_dir, os.path.basename(image_path))
+    result.save(filename=save_path)
+    return save_path
@@ -0,0 +1,164 @@
+"""
+序列模式 - 在连续帧之间传递提示
+
+第一帧由用户（或固定提示）给出框，之后每一帧:
+  1. 与参考帧比较缩小后的灰度图，平均差异不超过 reuse_diff 时直接复用参考帧的mask，不运行模型
+  2. 否则用参考帧中每个物体mask的外接框（向外扩 margin）作为提示，解码得到新的mask
+  3. 新mask与参考帧相比 IoU 低于 min_iou、面积变化超过 area_jump 倍或没有mask时，
+     认为该物体跟踪丢失，需要重新提示
+
+参考帧是最近一次运行过模型并被接受的帧；复用的帧不更新参考帧，缓慢的变化会累积到
+超过 reuse_diff 后触发一次跟踪，不会一直复用过时的mask。
+"""
+
+import cv2
+import numpy as np
+
+from mask_combine import extract_masks
+
+TRACK_REUSED = "reused"    # 画面几乎没变，复用参考帧的mask
+TRACK_TRACKED = "tracked"  # 由参考帧的mask得到提示，所有物体都跟踪成功
+TRACK_LOST = "lost"        # 至少一个物体跟踪丢失
+
+
+class TrackResult:
+    """一帧的跟踪结果"""
+
+    def __init__(self, status, masks, scores, boxes, lost, diff):
+        self.status = status  # TRACK_REUSED / TRACK_TRACKED / TRACK_LOST
+        self.masks = masks    # (N, H, W) bool 数组，跟踪丢失且没有mask的物体为全0
+        self.scores = scores  # (N,) 置信度
+        self.boxes = boxes    # 使用的提示框 [[x1, y1, x2, y2], ...]（复用时为参考帧的外接框）
+        self.lost = lost      # 跟踪丢失的物体序号
+        self.diff = diff      # 与参考帧的平均灰度差异 (0-255)
+
+
+class SequenceTracker:
+    def __init__(self, session, reuse_diff=2.0, margin=0.1, min_iou=0.5, area_jump=2.0, thumb_size=64):
+        """
+        参数:
+            session: SAMSession，用于解码
+            reuse_diff: 与参考帧的平均灰度差异不超过该值时复用mask（0 表示不复用）
+            margin: 提示框在mask外接框基础上每边外扩的比例（相对外接框宽高）
+            min_iou: 新mask与参考mask的 IoU 低于该值时认为跟踪丢失
+            area_jump: 新mask面积是参考mask的 area_jump 倍以上或 1/area_jump 以下时认为跟踪丢失
+            thumb_size: 比较帧差异时缩小到的长边尺寸
+        """
+        self.session = session
+        self.reuse_diff = reuse_diff
+        self.margin = margin
+        self.min_iou = min_iou
+        self.area_jump = area_jump
+        self.thumb_size = thumb_size
+        self.counts = {TRACK_REUSED: 0, TRACK_TRACKED: 0, TRACK_LOST: 0}
+        self.reset()
+
+    def reset(self):
+        """丢弃参考帧（例如切换到另一段序列）"""
+        self.masks = None
+        self.scores = None
+        self._thumb = None
+
+    @property
+    def active(self):
+        """是否有可跟踪的参考帧"""
+        return self.masks is not None
+
+    def set_reference(self, image, masks, scores=None):
+        """
+        把一帧及其mask设为参考帧（第一帧、重新提示后或跟踪成功并保存后调用）
+
+        参数:
+            image: BGR图像
+            masks: (N, H, W) 每个物体一个mask（张量或数组），空mask会被去掉
+            scores: (N,) 置信度
+        """
+        masks = _as_bool_array(masks)
+        scores = np.ones(len(masks), np.float32) if scores is None else _as_array(scores).astype(np.float32)
+        keep = masks.reshape(len(masks), -1).any(axis=1)
+        if not keep.any():
+            self.reset()
+            return
+        self.masks, self.scores = masks[keep], scores[keep]
+        self._thumb = self._thumbnail(image)
+
+    def difference(self, image):
+        """与参考帧的平均灰度差异 (0-255)，尺寸不同时返回 inf"""
+        thumb = self._thumbnail(image)
+        if self._thumb is None or thumb.shape != self._thumb.shape:
+            return float("inf")
+        return float(cv2.absdiff(thumb, self._thumb).mean())
+
+    def prompt_boxes(self):
+        """参考帧中每个物体mask的外接框，向外扩 margin 并限制在图像内"""
+        h, w = self.masks.shape[1:]
+        boxes = []
+        for mask in self.masks:
+            ys, xs = np.nonzero(mask.any(axis=1))[0], np.nonzero(mask.any(axis=0))[0]
+            x1, x2, y1, y2 = xs[0], xs[-1] + 1, ys[0], ys[-1] + 1
+            dx, dy = (x2 - x1) * self.margin, (y2 - y1) * self.margin
+            boxes.append([max(0, int(x1 - dx)), max(0, int(y1 - dy)),
+                          min(w, int(np.ceil(x2 + dx))), min(h, int(np.ceil(y2 + dy)))])
+        return boxes
+
+    def track(self, image, embedding_fn):
+        """
+        跟踪一帧（不修改参考帧，接受结果后由调用方调用 set_reference）
+
+        参数:
+            image: 当前帧的BGR图像
+            embedding_fn: 无参数函数，返回当前帧的 ImageEmbedding；复用mask时不会调用（不需要编码）
+
+        返回:
+            TrackResult
+        """
+        if not self.active:
+            raise RuntimeError("没有参考帧，请先调用 set_reference()")
+        diff = self.difference(image)
+        boxes = self.prompt_boxes()
+        if diff <= self.reuse_diff:
+            self.counts[TRACK_REUSED] += 1
+            return TrackResult(TRACK_REUSED, self.masks, self.scores, boxes, [], diff)
+
+        results = self.session.decode(embedding_fn(), bboxes=boxes)
+        n = len(self.masks)
+        masks = np.zeros((n,) + image.shape[:2], dtype=bool)
+        scores = np.zeros(n, np.float32)
+        found = np.zeros(n, dtype=bool)
+        new_masks, new_scores = extract_masks(results[0]) if results else (None, None)
+        if new_masks is not None:
+            # 低置信度的mask已被过滤，最后一列是mask对应的提示序号
+            index = results[0].boxes.cls.long().cpu().numpy()
+            masks[index] = _as_bool_array(new_masks)
+            scores[index] = _as_array(new_scores)
+            found[index] = True
+
+        lost = [i for i in range(n) if not found[i] or not self._consistent(self.masks[i], masks[i])]
+        status = TRACK_LOST if lost else TRACK_TRACKED
+        self.counts[status] += 1
+        return TrackResult(status, masks, scores, boxes, lost, diff)
+
+    def _consistent(self, previous, current):
+        """新mask是否与参考mask连续（IoU 和面积都没有突变）"""
+        area_prev, area_cur = int(previous.sum()), int(current.sum())
+        if area_cur == 0 or not 1 / self.area_jump <= area_cur / area_prev <= self.area_jump:
+            return False
+        inter = int(np.logical_and(previous, current).sum())
+        return inter / (area_prev + area_cur - inter) >= self.min_iou
+
+    def _thumbnail(self, image):
+        """缩小的灰度图（INTER_AREA 平均掉噪声）"""
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        h, w = gray.shape
+        scale = min(1.0, self.thumb_size / max(h, w))
+        size = (max(1, round(w * scale)), max(1, round(h * scale)))
+        return cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+
+
+def _as_array(x):
+    return x.cpu().numpy() if hasattr(x, "cpu") else np.asarray(x)
+
+
+def _as_bool_array(masks):
+    masks = _as_array(masks).astype(bool)
+    return masks[None] if masks.ndim == 2 else masks
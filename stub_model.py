@@ -0,0 +1,117 @@
+"""
+确定性的替身模型 - 不需要模型权重，用于离线测量读写和调度开销
+
+StubPredictor 实现 SAMSession 用到的 predictor 接口:
+  - preprocess:        与真实模型相同的缩放、填充和归一化
+  - get_im_features:   平均池化得到与 MobileSAM 形状相同的特征 (B, 256, 64, 64)
+  - inference_features: 根据提示直接画出mask（框 -> 填充矩形，点 -> 圆形区域）
+
+输出只取决于图片内容和提示，多次运行结果完全相同。
+"""
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from sam_session import SAMSession
+
+FEATURE_CHANNELS = 256
+FEATURE_SIZE = 64
+
+
+class StubPredictor:
+    def __init__(self, imgsz=1024):
+        self.imgsz = [imgsz, imgsz]
+        self.device = torch.device("cpu")
+
+    def preprocess(self, im):
+        """按长边缩放到 imgsz，右下填充，归一化为 (1, 3, S, S)"""
+        image = im[0]
+        size = self.imgsz[0]
+        h, w = image.shape[:2]
+        r = size / max(h, w)
+        resized = cv2.resize(image, (round(w * r), round(h * r)), interpolation=cv2.INTER_LINEAR)
+        padded = np.zeros((size, size, 3), dtype=np.uint8)
+        padded[:resized.shape[0], :resized.shape[1]] = resized
+        tensor = torch.from_numpy(padded[..., ::-1].copy()).permute(2, 0, 1)[None].float()
+        return tensor / 255.0
+
+    def get_im_features(self, im):
+        """平均池化 + 通道重复，得到 (B, 256, 64, 64) 特征"""
+        pooled = F.adaptive_avg_pool2d(im, FEATURE_SIZE)
+        repeats = -(-FEATURE_CHANNELS // pooled.shape[1])
+        return pooled.repeat(1, repeats, 1, 1)[:, :FEATURE_CHANNELS].contiguous()
+
+    def inference_features(self, features, src_shape, dst_shape=None, bboxes=None, points=None,
+                           labels=None, masks=None, multimask_output=False):
+        """
+        根据提示生成mask，坐标为 src_shape 上的像素坐标
+
+        返回:
+            (masks, boxes): (N, H, W) bool 张量和 (N, 6) 张量 [x1, y1, x2, y2, score, cls]
+        """
+        h, w = src_shape
+        prompts = []
+        if bboxes is not None:
+            bboxes = np.asarray(bboxes, dtype=np.float32).reshape(-1, 4)
+            prompts = [("box", box) for box in bboxes]
+        elif points is not None:
+            points = np.asarray(points, dtype=np.float32)
+            labels = np.ones(points.shape[:-1], dtype=np.int32) if labels is None else np.asarray(labels)
+            if points.ndim == 2:  # (N, 2): 每个点一个提示
+                points, labels = points[:, None], labels.reshape(-1, 1)
+            prompts = [("points", (p, l)) for p, l in zip(points, labels)]
+
+        radius = max(1, round(min(h, w) * 0.1))
+        scales = (0.5, 1.0, 1.5) if multimask_output else (1.0,)
+        out_masks, out_boxes = [], []
+        for kind, prompt in prompts:
+            for scale in scales:
+                mask = np.zeros((h, w), dtype=np.uint8)
+                if kind == "box":
+                    x1, y1, x2, y2 = prompt
+                    cx, cy = (x1 + x2) / 2, (y1 + y2) / 2
+                    hw, hh = (x2 - x1) / 2 * scale, (y2 - y1) / 2 * scale
+                    cv2.rectangle(mask, (round(cx - hw), round(cy - hh)), (round(cx + hw), round(cy + hh)), 1, -1)
+                    anchor = (cx, cy)
+                else:
+                    pts, lbls = prompt
+                    for (x, y), label in zip(pts, lbls):
+                        cv2.circle(mask, (round(x), round(y)), round(radius * scale), int(label > 0), -1)
+                    anchor = pts[0]
+                out_masks.append(mask)
+                out_boxes.append(self._box(mask, self._score(features, anchor, src_shape, scale),
+                                           len(out_boxes)))
+
+        if not out_masks:
+            return None, torch.zeros((0, 6))
+        return torch.from_numpy(np.stack(out_masks)).bool(), torch.tensor(np.stack(out_boxes))
+
+    @staticmethod
+    def _score(features, anchor, src_shape, scale):
+        """由提示位置的特征值得到确定性的置信度 (0.8 ~ 0.95)"""
+        h, w = src_shape
+        fx = min(FEATURE_SIZE - 1, max(0, int(anchor[0] / max(h, w) * FEATURE_SIZE)))
+        fy = min(FEATURE_SIZE - 1, max(0, int(anchor[1] / max(h, w) * FEATURE_SIZE)))
+        value = float(features[0, :3, fy, fx].mean())
+        return 0.8 + 0.1 * value + 0.05 * (scale == 1.0)
+
+    @staticmethod
+    def _box(mask, score, index):
+        # 与 ultralytics 相同，最后一列是mask的序号
+        ys, xs = np.nonzero(mask)
+        if len(xs) == 0:
+            return np.array([0, 0, 0, 0, score, index], dtype=np.float32)
+        return np.array([xs.min(), ys.min(), xs.max(), ys.max(), score, index], dtype=np.float32)
+
+
+class StubSession(SAMSession):
+    """使用 StubPredictor 的推理会话，接口与 SAMSession 相同"""
+
+    def __init__(self, imgsz=1024, conf=0.25, cache=None):
+        self.model = None
+        self.conf = conf
+        self.cache = cache
+        self.predictor = StubPredictor(imgsz)
+        self.embedding = None
@@ -0,0 +1,226 @@
+"""
+分块推理 - 超大图片按相互重叠的块分别编码，再拼接成原分辨率的mask
+
+MobileSAM 把输入缩放到长边 1024，8K~20K 的图片整张编码会丢失细小结构。分块模式:
+  1. 按 tile_size 把图片切成相互重叠 overlap 像素的块（tile_size=1024 时块内不缩放）
+  2. 把框和点提示映射到块坐标，只编码与提示相交的块
+  3. 每个块在块内解码，重叠区域按到块边缘的距离线性加权融合，消除接缝
+  4. 按水平条带逐条融合并输出；融合用的 float32 累加器只有一个条带大小，
+     全分辨率的mask不会以 float32 形式存在
+
+提示:
+  - 每个框是一个提示，与框相交的块各解码一次（框裁剪到块内，框内的点一起带上）
+  - 没有框时所有点共同构成一个提示，包含至少一个点的块各解码一次（只带块内的点）
+"""
+
+import time
+
+import numpy as np
+
+from mask_combine import combine_masks, extract_masks
+
+
+def tile_grid(w, h, tile_size=1024, overlap=128):
+    """
+    把 w x h 的图片切成相互重叠的块
+
+    返回:
+        [(x0, y0, x1, y1), ...]，按行排列；最后一行/列的块贴齐图片边缘
+    """
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        step = max(1, tile_size - overlap)
+        positions = list(range(0, length - tile_size, step))
+        return positions + [length - tile_size]
+
+    return [(x, y, min(x + tile_size, w), min(y + tile_size, h))
+            for y in starts(h) for x in starts(w)]
+
+
+def prompt_units(prompts):
+    """
+    把提示参数（prompt_fn 的返回值）拆成独立的提示
+
+    返回:
+        [{'box': [x1, y1, x2, y2] 或 None, 'points': (K, 2) 数组或 None, 'labels': (K,) 数组或 None}, ...]
+    """
+    if prompts.get('per_point'):
+        raise ValueError("分块模式不支持逐点分割物体 (objects 模式)")
+    points = prompts.get('points')
+    labels = prompts.get('labels')
+    if points is not None and len(points) > 0:
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+        labels = np.ones(len(points), np.int32) if labels is None else np.asarray(labels, np.int32).reshape(-1)
+    else:
+        points, labels = None, None
+    bboxes = prompts.get('bboxes')
+    if bboxes is not None and len(bboxes) > 0:
+        return [{'box': [float(v) for v in box], 'points': points, 'labels': labels}
+                for box in np.asarray(bboxes, dtype=np.float32).reshape(-1, 4)]
+    if points is None:
+        raise ValueError("没有框或点提示")
+    return [{'box': None, 'points': points, 'labels': labels}]
+
+
+def _local_prompt(unit, tile):
+    """
+    把一个提示映射到块坐标，与块不相交时返回 None
+
+    返回:
+        传给 session.decode 的参数字典
+    """
+    x0, y0, x1, y1 = tile
+    points, labels = unit['points'], unit['labels']
+    if points is not None:
+        inside = (points[:, 0] >= x0) & (points[:, 0] < x1) & (points[:, 1] >= y0) & (points[:, 1] < y1)
+        points, labels = points[inside] - (x0, y0), labels[inside]
+        if len(points) == 0:
+            points, labels = None, None
+
+    box = unit['box']
+    if box is None:
+        return None if points is None else {'points': points, 'labels': labels}
+    bx1, by1 = max(box[0], x0), max(box[1], y0)
+    bx2, by2 = min(box[2], x1), min(box[3], y1)
+    if bx2 <= bx1 or by2 <= by1:
+        return None
+    return {'bboxes': [[bx1 - x0, by1 - y0, bx2 - x0, by2 - y0]], 'points': points, 'labels': labels}
+
+
+def _edge_weights(start, end, length, overlap):
+    """块在一个方向上的融合权重: 与相邻块重叠的一侧从边缘线性升到1，贴着图片边缘的一侧为1"""
+    n = end - start
+    ramp = max(1, overlap)
+    weights = np.ones(n, np.float32)
+    i = np.arange(n, dtype=np.float32)
+    if start > 0:
+        weights = np.minimum(weights, (i + 1) / ramp)
+    if end < length:
+        weights = np.minimum(weights, (n - i) / ramp)
+    return weights
+
+
+class TiledSegmenter:
+    def __init__(self, session, tile_size=1024, overlap=128, batch_size=4):
+        """
+        参数:
+            session: SAMSession
+            tile_size: 块的边长（像素）
+            overlap: 相邻块重叠的像素数
+            batch_size: 每次编码器调用处理的块数
+        """
+        if not 0 <= overlap < tile_size:
+            raise ValueError(f"overlap 应满足 0 <= overlap < tile_size，实际为 {overlap}, {tile_size}")
+        self.session = session
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.batch_size = max(1, batch_size)
+
+    def segment(self, image, prompts):
+        """
+        分块编码和解码一张图片
+
+        参数:
+            image: BGR图像
+            prompts: 全图坐标的提示参数，与 session.decode 相同（bboxes / points / labels）
+
+        返回:
+            TiledMasks，用 strips() 逐条取出拼接后的mask
+        """
+        h, w = image.shape[:2]
+        tiles = tile_grid(w, h, self.tile_size, self.overlap)
+        units = prompt_units(prompts)
+
+        # 只编码与提示相交的块
+        work = {}
+        for t, tile in enumerate(tiles):
+            local = [(u, p) for u, p in ((u, _local_prompt(unit, tile)) for u, unit in enumerate(units))
+                     if p is not None]
+            if local:
+                work[t] = local
+
+        results = {}  # (块序号, 提示序号) -> (块内mask, 置信度)
+        encode_seconds = decode_seconds = 0.0
+        selected = list(work)
+        for i in range(0, len(selected), self.batch_size):
+            batch = selected[i:i + self.batch_size]
+            crops = [np.ascontiguousarray(image[tiles[t][1]:tiles[t][3], tiles[t][0]:tiles[t][2]])
+                     for t in batch]
+            start = time.perf_counter()
+            embeddings = self.session.encode_batch(crops)
+            encode_seconds += time.perf_counter() - start
+            start = time.perf_counter()
+            for t, embedding in zip(batch, embeddings):
+                for u, local in work[t]:
+                    decoded = self.session.decode(embedding, **local)
+                    masks, scores = extract_masks(decoded[0]) if decoded else (None, None)
+                    if masks is None:
+                        results[(t, u)] = (None, 0.0)
+                    else:
+                        results[(t, u)] = (masks.any(dim=0).cpu().numpy(), float(scores.max()))
+            decode_seconds += time.perf_counter() - start
+        tiled = TiledMasks(w, h, tiles, len(units), results, self.overlap)
+        tiled.encode_seconds, tiled.decode_seconds = encode_seconds, decode_seconds
+        return tiled
+
+
+class TiledMasks:
+    """分块解码的结果，按条带融合成原分辨率的mask"""
+
+    def __init__(self, width, height, tiles, num_prompts, results, overlap):
+        self.width = width
+        self.height = height
+        self.tiles = tiles
+        self.num_prompts = num_prompts
+        self.results = results
+        self.overlap = overlap
+        self.encoded_tiles = len({t for t, _ in results})
+        self.encode_seconds = 0.0  # 编码器和解码器耗时，由 TiledSegmenter.segment 填写
+        self.decode_seconds = 0.0
+
+    def prompt_scores(self):
+        """每个提示的置信度（各块中有mask的置信度平均值），用于 label / best 合并"""
+        scores = np.zeros(self.num_prompts, np.float32)
+        for u in range(self.num_prompts):
+            values = [s for (t, v), (m, s) in self.results.items() if v == u and m is not None]
+            scores[u] = np.mean(values) if values else 0.0
+        return scores
+
+    def strips(self, combine="union", strip_height=512):
+        """
+        逐条融合并合并mask
+
+        参数:
+            combine: 多个提示的合并方式，见 mask_combine.combine_masks
+            strip_height: 每个条带的行数
+
+        返回:
+            生成器，产生 (y0, 条带)；条带是 (rows, W) 数组，数据类型与 combine_masks 的输出相同
+        """
+        scores = self.prompt_scores()
+        n, w = self.num_prompts, self.width
+        weights = [(_edge_weights(x0, x1, self.width, self.overlap),
+                    _edge_weights(y0, y1, self.height, self.overlap)) for x0, y0, x1, y1 in self.tiles]
+        for y0 in range(0, self.height, strip_height):
+            y1 = min(self.height, y0 + strip_height)
+            acc = np.zeros((n, y1 - y0, w), np.float32)
+            total = np.zeros((n, y1 - y0, w), np.float32)
+            for (t, u), (mask, _) in self.results.items():
+                tx0, ty0, tx1, ty1 = self.tiles[t]
+                r0, r1 = max(y0, ty0), min(y1, ty1)
+                if r0 >= r1:
+                    continue
+                wx, wy = weights[t]
+                weight = wy[r0 - ty0:r1 - ty0, None] * wx[None, :]
+                total[u, r0 - y0:r1 - y0, tx0:tx1] += weight
+                if mask is not None:
+                    acc[u, r0 - y0:r1 - y0, tx0:tx1] += weight * mask[r0 - ty0:r1 - ty0]
+            # 加权投票超过一半为前景；没有块覆盖的像素 total 为0，结果为背景
+            masks = acc > total * 0.5
+            del acc, total
+            yield y0, combine_masks(masks, scores, combine)
+
+    def to_array(self, combine="union", strip_height=512):
+        """拼成完整的mask（combine_masks 输出的数据类型，不经过 float32 的全图）"""
+        return np.concatenate([strip for _, strip in self.strips(combine, strip_height)])
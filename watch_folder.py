@@ -0,0 +1,473 @@
+"""
+监视文件夹 - 常驻进程持续处理新到达的图片
+
+相机全天往一个目录里写图片，用定时任务反复运行 batch_mask.py 需要每次重新加载模型、
+重新扫描整个目录。监视模式（batch_mask.py --watch）让模型常驻内存:
+  1. 监视线程每隔 interval 秒检查一次目录。Linux 上用 inotify 只检查有事件的文件，目录里
+     积累了多少图片都不影响检查的开销；其他平台（或 --no-inotify）每次用 os.scandir 完整扫描，
+     网络盘上也可用
+  2. 新文件或修改过的文件的大小和修改时间连续 settle 秒不变，才认为已经写完（去抖动），
+     写到一半的文件不会被处理；文件再次改变时重新处理
+  3. 写完的文件放入有界队列，队列满时留在监视线程里等待（积压），不会无限占用内存
+  4. 流水线从队列中逐个取出图片立即处理，从文件到达到mask保存通常只需几秒
+
+完成清单（manifest）照常记录，重启后已处理且未改变的图片不会重复处理。
+吞吐、积压和延迟等计数定期打印，并写到输出目录的 watch_status.json 供外部监控读取。
+"""
+
+import collections
+import ctypes
+import ctypes.util
+import json
+import os
+import queue
+import struct
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from image_sources import SourceItem, input_file, input_key, is_image_file
+
+WATCH_STATUS_NAME = "watch_status.json"
+
+_STOP = object()  # 队列结束标记
+
+
+class FolderWatcher:
+    def __init__(self, folder, recursive=False, settle=1.0, use_inotify=True, rescan_interval=60.0):
+        """
+        参数:
+            folder: 监视的文件夹
+            recursive: 是否包含子文件夹（mask按相对路径保存，见 image_sources.iter_tree）
+            settle: 文件大小和修改时间连续不变多少秒才认为已经写完
+            use_inotify: Linux 上用 inotify 只检查改变过的文件（不可用时自动改为定时扫描）
+            rescan_interval: 使用 inotify 时每隔多少秒仍完整扫描一次（网络盘上收不到其他机器的事件）
+        """
+        self.folder = folder
+        self.recursive = recursive
+        self.settle = settle
+        self.rescan_interval = rescan_interval
+        self._root = os.path.abspath(folder)
+        self._seen = {}   # 图片标识 -> [(大小, 修改时间), 第一次看到该状态的时间, 输入项]
+        self._done = {}   # 图片标识 -> 已交给处理的 (大小, 修改时间)
+        self.first_seen = {}  # 图片标识 -> 第一次发现文件（或文件改变）的时间，用于计算延迟
+        self._inotify = _Inotify.create() if use_inotify else None
+        self._last_scan = None
+
+    @property
+    def mode(self):
+        """检查方式: inotify 或 poll"""
+        return "inotify" if self._inotify is not None else "poll"
+
+    def poll(self, now=None):
+        """
+        检查一次目录
+
+        定时扫描时每次完整扫描目录；使用 inotify 时只检查有事件的文件和还在写入的文件，
+        事件队列溢出、出现新的子文件夹或到了 rescan_interval 时才完整扫描。
+
+        返回:
+            已经写完、尚未处理（或处理后又改变）的输入项列表
+        """
+        now = time.time() if now is None else now
+        full = (self._inotify is None or self._last_scan is None
+                or now - self._last_scan >= self.rescan_interval)
+        changed = set()
+        if self._inotify is not None:
+            changed, overflow = self._inotify.read()
+            full = full or overflow
+        if full:
+            self._last_scan = now
+            return self._update(self._scan(), now, full=True)
+        # 只检查有事件的文件和还在写入的文件，其他文件不 stat
+        candidates = {key: entry[2] for key, entry in self._seen.items()}
+        for path in changed:
+            item = self._item(path)
+            if item is not None:
+                candidates.setdefault(input_key(item), item)
+        found = []
+        for key, item in candidates.items():
+            try:
+                st = os.stat(input_file(item))
+            except OSError:
+                self._forget(key)  # 被删除或改名
+                continue
+            found.append((item, key, (st.st_size, st.st_mtime_ns)))
+        return self._update(found, now)
+
+    def _update(self, found, now, full=False):
+        """根据文件状态更新去抖动计时，返回已经写完的输入项"""
+        ready = []
+        present = set()
+        for item, key, state in found:
+            present.add(key)
+            if self._done.get(key) == state:
+                continue
+            seen = self._seen.get(key)
+            if seen is None or seen[0] != state:
+                # 新文件或还在写入: 重新开始计时
+                self._seen[key] = [state, now, item]
+                self.first_seen.setdefault(key, now)
+                continue
+            if state[0] > 0 and now - seen[1] >= self.settle:
+                ready.append(item)
+                self._done[key] = state
+                del self._seen[key]
+        if full:
+            # 被删除的文件不再跟踪
+            for key in [k for k in self._seen if k not in present]:
+                self._forget(key)
+            for key in [k for k in self._done if k not in present]:
+                del self._done[key]
+        ready.sort(key=input_key)
+        return ready
+
+    def _forget(self, key):
+        self._done.pop(key, None)
+        if self._seen.pop(key, None) is not None:
+            self.first_seen.pop(key, None)
+
+    def _scan(self):
+        """
+        完整扫描，产生 (输入项, 标识, (大小, 修改时间))
+
+        直接使用 os.scandir 返回的 DirEntry.stat()（Windows 上不需要额外的系统调用），不排序。
+        使用 inotify 时同时为扫描到的每个文件夹添加监视。
+        """
+        stack = [self._root]
+        while stack:
+            current = stack.pop()
+            if self._inotify is not None:
+                self._inotify.watch(current)
+            try:
+                with os.scandir(current) as it:
+                    entries = list(it)
+            except OSError as e:
+                if current == self._root:
+                    raise
+                print(f"  ✗ 无法读取文件夹 {current}: {e}")
+                continue
+            for entry in entries:
+                try:
+                    if self.recursive and entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                        continue
+                    if not is_image_file(entry.name) or not entry.is_file():
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue  # 扫描后被删除或改名
+                item = self._item(entry.path)
+                yield item, input_key(item), (st.st_size, st.st_mtime_ns)
+
+    def _item(self, path):
+        """磁盘路径对应的输入项（与 list_images / iter_tree 产生的相同），不是图片时返回 None"""
+        if not is_image_file(path):
+            return None
+        rel = os.path.relpath(path, self._root)
+        if not self.recursive:
+            return Path(self.folder) / rel if os.sep not in rel else None
+        rel = rel.replace(os.sep, "/")
+        return SourceItem(rel, os.path.splitext(rel)[0], path, path=Path(path))
+
+    @property
+    def settling(self):
+        """已发现但还在写入（或等待 settle）的文件数"""
+        return len(self._seen)
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+
+class _Inotify:
+    """Linux inotify（通过 ctypes 调用 libc），只用来知道哪些文件可能改变了"""
+
+    # <sys/inotify.h>
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+                  | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+    _EVENT = struct.Struct("iIII")  # wd, mask, cookie, len
+
+    def __init__(self, libc, fd):
+        self._libc = libc
+        self._fd = fd
+        self._dirs = {}  # watch descriptor -> 文件夹
+        self._watched = set()
+
+    @classmethod
+    def create(cls):
+        """创建 inotify 实例，不是 Linux 或创建失败时返回 None"""
+        if not sys.platform.startswith("linux"):
+            return None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(cls.IN_NONBLOCK | cls.IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        return cls(libc, fd) if fd >= 0 else None
+
+    def watch(self, folder):
+        """监视文件夹（已经在监视时不重复添加）"""
+        if folder in self._watched:
+            return
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(folder), self.WATCH_MASK)
+        if wd < 0:
+            print(f"  ✗ 无法监视文件夹 {folder}: {os.strerror(ctypes.get_errno())}")
+            return
+        self._dirs[wd] = folder
+        self._watched.add(folder)
+
+    def read(self):
+        """
+        取出全部待处理的事件
+
+        返回:
+            (可能改变了的文件路径集合, 是否需要完整扫描)
+        """
+        changed = set()
+        rescan = False
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = self._EVENT.unpack_from(data, offset)
+                offset += self._EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                if mask & self.IN_Q_OVERFLOW:
+                    rescan = True  # 事件丢失
+                    continue
+                folder = self._dirs.get(wd)
+                if folder is None:
+                    continue
+                if mask & (self.IN_IGNORED | self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                    # 文件夹被删除或移走: 不再监视，完整扫描一次核对
+                    if mask & self.IN_IGNORED:
+                        del self._dirs[wd]
+                        self._watched.discard(folder)
+                    rescan = True
+                elif mask & self.IN_ISDIR:
+                    rescan = rescan or bool(mask & (self.IN_CREATE | self.IN_MOVED_TO))  # 新的子文件夹
+                elif name:
+                    changed.add(os.path.join(folder, name))
+        return changed, rescan
+
+    def close(self):
+        os.close(self._fd)
+
+
+class WatchStats:
+    """监视模式的计数，线程安全"""
+
+    def __init__(self, window=60.0):
+        """
+        参数:
+            window: 计算吞吐的时间窗口（秒）
+        """
+        self.window = window
+        self.started = time.time()
+        self.queued = 0        # 交给处理的图片数
+        self.skipped = 0       # 清单中已完成、跳过的图片数
+        self.succeeded = 0
+        self.failed = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self._recent = collections.deque()  # 最近完成的时间，用于计算吞吐
+        self._lock = threading.Lock()
+
+    def finish(self, ok, latency=None):
+        """记录一张图片处理结束"""
+        now = time.time()
+        with self._lock:
+            if ok:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+            if latency is not None:
+                self.latency_sum += latency
+                self.latency_max = max(self.latency_max, latency)
+            self._recent.append(now)
+            while self._recent and now - self._recent[0] > self.window:
+                self._recent.popleft()
+
+    def snapshot(self, backlog=0, settling=0):
+        """
+        当前计数
+
+        参数:
+            backlog: 已写完、等待处理的图片数
+            settling: 还在写入的文件数
+        """
+        now = time.time()
+        with self._lock:
+            finished = self.succeeded + self.failed
+            recent = sum(1 for t in self._recent if now - t <= self.window)
+            return {
+                "uptime_seconds": round(now - self.started, 1),
+                "queued": self.queued,
+                "skipped": self.skipped,
+                "succeeded": self.succeeded,
+                "failed": self.failed,
+                "backlog": backlog,
+                "settling": settling,
+                "throughput_per_minute": round(recent * 60.0 / min(self.window, max(now - self.started, 1e-9)), 2),
+                "latency_mean_seconds": round(self.latency_sum / finished, 3) if finished else None,
+                "latency_max_seconds": round(self.latency_max, 3),
+                "time": now,
+            }
+
+
+def status_line(status):
+    """一行状态文本"""
+    latency = status["latency_mean_seconds"]
+    return (f"[监视] 成功 {status['succeeded']}, 失败 {status['failed']}, 积压 {status['backlog']}, "
+            f"写入中 {status['settling']}, 吞吐 {status['throughput_per_minute']:.1f} 张/分钟, "
+            f"延迟 平均 {latency if latency is not None else '-'}s / 最大 {status['latency_max_seconds']}s")
+
+
+def write_status(path, status):
+    """原子地写入状态文件（临时文件 + os.replace，读取方不会看到写了一半的文件）"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix=".watch_status.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(status, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class WatchQueue:
+    """
+    把监视线程发现的图片交给流水线
+
+    监视线程调用 run()，流水线迭代 stream()；stop() 后 stream() 在队列取空后结束。
+    """
+
+    def __init__(self, watcher, manifest=None, interval=1.0, queue_size=64, stats=None,
+                 status_path=None, status_interval=10.0):
+        """
+        参数:
+            watcher: FolderWatcher
+            manifest: RunManifest，已完成且未改变的图片不再处理（None 表示不检查）
+            interval: 扫描间隔（秒）
+            queue_size: 队列容量，满时多出的图片在监视线程中积压
+            stats: WatchStats（默认新建）
+            status_path: 状态文件路径（None 表示不写）
+            status_interval: 打印状态和写状态文件的间隔（秒）
+        """
+        self.watcher = watcher
+        self.manifest = manifest
+        self.interval = interval
+        self.stats = stats or WatchStats()
+        self.status_path = status_path
+        self.status_interval = status_interval
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._pending = collections.deque()  # 队列满时积压的图片
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    @property
+    def backlog(self):
+        """已写完、还没有处理完的图片数"""
+        with self._lock:
+            return len(self._pending) + self._in_flight
+
+    def status(self):
+        return self.stats.snapshot(self.backlog, self.watcher.settling)
+
+    def run(self):
+        """监视线程: 定期扫描，把写完的图片放入队列"""
+        last_status = time.time()
+        while not self._stop.is_set():
+            try:
+                for item in self.watcher.poll():
+                    if self.manifest is not None and self.manifest.is_done(item):
+                        self.stats.skipped += 1
+                        continue
+                    with self._lock:
+                        self._pending.append(item)
+            except OSError as e:
+                print(f"  ✗ 扫描文件夹出错: {e}")
+            self._drain()
+            if time.time() - last_status >= self.status_interval:
+                self.report()
+                last_status = time.time()
+            self._stop.wait(self.interval)
+        self.watcher.close()
+        self._queue.put(_STOP)
+
+    def _drain(self):
+        """把积压的图片放入队列，直到队列满"""
+        with self._lock:
+            while self._pending:
+                try:
+                    self._queue.put_nowait(self._pending[0])
+                except queue.Full:
+                    return
+                self._pending.popleft()
+                self._in_flight += 1
+                self.stats.queued += 1
+
+    def stream(self):
+        """流水线的输入: 逐个产生队列中的图片，stop() 后结束"""
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            self._drain()  # 队列腾出了位置
+            yield item
+
+    def finish(self, image_path, ok):
+        """
+        一张图片处理结束（在流水线的结果回调中调用）
+
+        返回:
+            从发现文件到处理结束的延迟（秒），未知时为 None
+        """
+        first_seen = self.watcher.first_seen.pop(input_key(image_path), None)
+        latency = time.time() - first_seen if first_seen is not None else None
+        with self._lock:
+            self._in_flight = max(0, self._in_flight - 1)
+        self.stats.finish(ok, latency)
+        return latency
+
+    def report(self):
+        """打印状态，写状态文件"""
+        status = self.status()
+        print(status_line(status))
+        if self.status_path is not None:
+            try:
+                write_status(self.status_path, status)
+            except OSError as e:
+                print(f"  ✗ 无法写入状态文件: {e}")
+        return status
+
+    def stop(self):
+        """停止扫描；已放入队列的图片处理完后 stream() 结束"""
+        self._stop.set()